@@ -1,42 +1,63 @@
 /*
- * Report back if device is at/beyond a threshold distance.
+ * Read the distance and report it to the host in framed binary packets.
+ *
+ * FRAME (multi-byte fields are little-endian):
+ *   SOH | VER | LEN | SEQ (2) | N (1) | N x [ T (4, ms) | D (2, mm) ] | CHK
+ *
+ *   - LEN is the payload length (3 + 6*N)
+ *   - SEQ is the sequence number of the first sample in the frame, so
+ *     the host can count dropped samples from gaps in the sequence
+ *   - T is millis() at the time of the reading
+ *   - CHK is the sum of VER..last payload byte (mod 256)
+ *
+ * Up to BATCH samples are packed per frame to cut per-sample overhead
+ * on both ends. The in-range threshold is applied by the host.
  */
 
-uint8_t crnt_reading = 0;                                 // Current readings flag
-uint8_t prvs_reading = 0;                                 // Previous readings flag
+#define   HEADER_SIZE   3                                 // SOH, VER, LEN
+#define   PREFIX_SIZE   3                                 // SEQ, N
+#define   SAMPLE_SIZE   6                                 // T, D
+
+uint8_t   frame[ HEADER_SIZE + PREFIX_SIZE + BATCH*SAMPLE_SIZE + 1 ];
+uint8_t   n_samples     = 0;                              // Samples in the current frame
+uint16_t  seq_no        = 0;                              // Sequence number of the first sample
+
+void send_frame() {
+  uint8_t payload = PREFIX_SIZE + n_samples*SAMPLE_SIZE;  // Payload length
+  uint8_t chk     = 0;                                    // Checksum
+
+  frame[0] = SOH;                                         // Header
+  frame[1] = PROTOCOL_VER;                                // ...
+  frame[2] = payload;                                     // ...
+  frame[3] = seq_no & 0xFF;                               // Sequence number
+  frame[4] = seq_no >> 8;                                 // ...
+  frame[5] = n_samples;                                   // Number of samples
+
+  for( uint8_t i = 1; i < HEADER_SIZE + payload; i++ )    // Checksum covers VER..payload
+    chk += frame[i];
+  frame[ HEADER_SIZE + payload ] = chk;
+
+  Serial.write( frame, HEADER_SIZE + payload + 1 );       // Send frame in one go
+  seq_no   += n_samples;                                  // Next frame starts here
+  n_samples = 0;                                          // Start a new batch
+}
 
 void get_dist() {
   uint8_t read_status = vl.readRangeStatus();             // Get status of readings
 
   if ( read_status == VL6180X_ERROR_NONE )                // If no errors are reported back, proceed
   {
-    uint8_t range = vl.readRange();                       // Read the distance
-    Serial.print( F("Range: ") ); Serial.println( range );// Print readings
-
-    if ( range <= THRESHOLD )                             // Send true ONCE in case the state changes
-    {
-      crnt_reading = 1;                                   // Assign a value of true (1) to variable
-      if ( crnt_reading != prvs_reading )                 // This makes sure that the status is only sent once
-      {
-        Serial.print( true );                             // Indicate that we are at/beyond threshold
-        delay( 100 );                                     // Delay for stability
-        prvs_reading = crnt_reading;                      // Update "previous values holder" with the current value
-      }
-    }
-
-    else if (range > THRESHOLD)                           // Else, send false ONCE in case the state changes
-    {
-      crnt_reading = 0;                                   // Same ...
-      if ( crnt_reading != prvs_reading )                 // as ...
-      {
-        Serial.print( false );                            // above ...
-        delay( 100 );                                     // ...
-        prvs_reading = crnt_reading;                      // ...
-      }
-    }
-
-    // Else, dunno...
-    else Serial.println( "ERROR" );
+    uint32_t stamp  = millis();                           // Time of reading
+    uint16_t range  = vl.readRange();                     // Read the distance
+    uint8_t *sample = &frame[ HEADER_SIZE + PREFIX_SIZE + n_samples*SAMPLE_SIZE ];
+
+    sample[0] = stamp       & 0xFF;                       // Pack timestamp
+    sample[1] = stamp >>  8 & 0xFF;                       // ...
+    sample[2] = stamp >> 16 & 0xFF;                       // ...
+    sample[3] = stamp >> 24 & 0xFF;                       // ...
+    sample[4] = range       & 0xFF;                       // Pack distance
+    sample[5] = range >>  8 & 0xFF;                       // ...
+
+    if ( ++n_samples >= BATCH ) send_frame();             // Send once the batch is full
   }
 }
-
@@ -15,7 +15,9 @@
 // Define various parameters
 #define   BAUD          115200                            // Serial communications baudrate
 #define   RETRIES       5                                 // Number of retries to initialize sensor
-#define   THRESHOLD     15                                // Distance threshold we need to pass
+#define   PROTOCOL_VER  1                                 // Framed protocol version (see get_dist.h)
+#define   BATCH         4                                 // Samples per frame (1 = no batching)
+#define   DEVICE_NAME   "VL6180"                          // Reply to the 'n' name query (host port discovery)
 
 // Define communication bytes
 #define   SOH           0x01                              // Start of Header
@@ -25,6 +27,7 @@
 #define   DC1           0x21                              // Device Control 1: Reboot system
 
 Adafruit_VL6180X vl = Adafruit_VL6180X();                 // Instantiate sensor
+bool      streaming     = false;                          // Frames are sent only after the '2' start command
 
 #include  "get_dist.h"                                    // Get distance function
 #include  "parseByte.h"                                   // Parse byte function
@@ -63,6 +66,6 @@ void setup() {
 }
 
 void loop() {
-  get_dist();                                             // Perform readings
+  if( streaming ) get_dist();                             // Perform readings once started
   if( Serial.available() ) parseByte();                   // Check on serial for incoming data
 }
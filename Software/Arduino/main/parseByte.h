@@ -18,6 +18,18 @@ void parseByte( ) {
       Serial.write( ACK ); delay( SHORT_WAIT );
       ESP.restart();
       break;
+
+    // Device Name (usbProtocol.py port discovery/identification)
+    case 'n':
+      Serial.print( F(DEVICE_NAME) ); Serial.print( '\n' );
+      break;
+
+    // Start Readings (live feed start sequence): reply before the
+    // first frame so the host reads the 'y' cleanly
+    case '2':
+      Serial.write( 'y' );
+      streaming = true;
+      break;
       
     default:
       Serial.write( NAK ); delay( SHORT_WAIT );
@@ -34,6 +34,7 @@ from    threading                   import  Thread          # Used to thread pro
 from    Queue                       import  Queue           # Used to queue input/output
 from    timeStamp                   import  fullStamp       # Show date/time on console output
 from    usbProtocol                 import  createUSBPort   # Create USB Port
+from    usbProtocol                 import  FrameDecoder    # Framed ToF protocol
 
 # ************************************************************************
 # =====================> CONSTRUCT ARGUMENT PARSER <=====================
@@ -158,17 +159,25 @@ def getDist():
     # No need to reevaluate in the main function at every iteration
     global ToF_Dist
 
+    # The sensor sends framed binary samples (mm); keeps partial frames
+    decoder = FrameDecoder()
+
     # Listen to serial port as long as port is open
     while ( ToF.is_open ):
 
-        # Do the reading iff there is something available at serial port
-        if ToF.in_waiting > 0:
-            ToF_Dist = int( (ToF.read(size=1).strip('\0')).strip('\n') )
+        # Wait for the next byte (up to the port timeout), then drain the rest
+        try:
+            data = ToF.read( size=max(1, ToF.in_waiting) )
+        except Exception:           # Port closed under us at shutdown
+            break
+
+        samples = decoder.feed( data )
+        if samples:
+            # Within scan distance? (threshold applied on the host)
+            ToF_Dist = int( samples[-1][2] <= ToF_Threshold )
             # If debug flag is invoked
             if args["debug"]:
-                print( ToF_Dist )
-        else:
-            pass
+                print( samples[-1][2] )
 
 
 # ******************************************************
@@ -296,20 +305,19 @@ cv2.createTrackbar( "GaussianBlur", "AI_View", 0, 50, placeholder )
 
 # Initialize ToF sensor
 deviceName, port, baudRate = "VL6180", 0, 115200
-ToF = createUSBPort( deviceName, port, baudRate, 3 )
-if ToF.is_open == False:
-    ToF.open()
-    sleep( 0.5 )
+ToF = createUSBPort( deviceName, port, baudRate, 3 )     # Returned open, device identified
+ToF.write('2')
+inChar = ''
+while inChar is not 'y':
     inChar = (ToF.read(size=1).strip('\0')).strip('\n')
-    ToF.write('2')
-    while inChar is not 'y':
-        inChar = (ToF.read(size=1).strip('\0')).strip('\n')
-        # If debug flag is invoked
-        if args["debug"]:
-            print( inChar )
-    print( fullStamp() + " Distance Readings Initiated" )
+    # If debug flag is invoked
+    if args["debug"]:
+        print( inChar )
+print( fullStamp() + " Distance Readings Initiated" )
 
-ToF_Dist = 0    # Initialize to OFF
+ToF.timeout = 0.5      # getDist() re-checks the port this often
+ToF_Threshold = 15     # Scan distance (mm)
+ToF_Dist = 0           # Initialize to OFF
 
 # Create a queue for retrieving data from thread
 Q_B_procFrame = Queue( maxsize=0 )
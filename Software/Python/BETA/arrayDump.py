@@ -0,0 +1,142 @@
+'''
+* arrayDump.py
+*
+* Dump image arrays (e.g. calibrate.py's thresholded frame) for
+* debugging, and view them again.
+*
+* Every format is written with a single vectorized call, instead of
+* one open()/write() per pixel:
+*   - .npy  : raw array (np.save); with mmap=True it is written through
+*             a memory map and load_array( mmap=True ) maps it back
+*   - .npz  : compressed archive (np.savez_compressed), key "array"
+*   - .bits : packed-bit text, binarized (non-zero = 1). A header line
+*             "# bits <rows> <cols>" and then every row as the hex of
+*             np.packbits(row), i.e. 8 pixels per 2 characters
+*   - .txt  : one "0"/"1" digit per pixel, one row per line (the old
+*             numpyArray.txt layout)
+*
+* USAGE:
+*   dump_array( thresholded, "~/Desktop/thresholded.npz" )
+*   array = load_array( "~/Desktop/thresholded.npz" )
+*   python arrayDump.py ~/Desktop/thresholded.bits     # Viewer
+'''
+
+import  os, argparse
+import  numpy                                               as  np
+
+FORMATS = [ ".npy", ".npz", ".bits", ".txt" ]
+
+# ************************************************************************
+# ===============================> DUMP <=================================
+# ************************************************************************
+
+def dump_array( array, path, mmap=False ):
+    '''
+    Write an array in the format given by the file extension.
+
+    INPUTS:-
+        - array     : 2D array (binarized for .bits/.txt: non-zero = 1)
+        - path      : Destination, one of FORMATS ("~" is expanded)
+        - mmap      : .npy only, write through a memory map
+
+    OUTPUT:-
+        - path      : Expanded path written
+    '''
+
+    path = os.path.expanduser( path )
+    ext  = _extension( path )
+    folder = os.path.dirname( path )
+    if( folder and not os.path.exists(folder) ):
+        os.makedirs( folder )
+
+    array = np.asarray( array )
+    if( ext == ".npy" and mmap ):
+        out = np.lib.format.open_memmap( path, mode="w+", dtype=array.dtype, shape=array.shape )
+        out[...] = array
+        out.flush()
+        del out
+    elif( ext == ".npy" ):
+        np.save( path, array )
+    elif( ext == ".npz" ):
+        np.savez_compressed( path, array=array )
+    elif( ext == ".bits" ):
+        rows, cols = array.shape
+        packed = np.packbits( array != 0, axis=1 )
+        with open( path, "w" ) as f:
+            f.write( "# bits {} {}\n".format(rows, cols) )
+            f.write( "\n".join( row.tobytes().encode("hex") for row in packed ) + "\n" )
+    else:
+        np.savetxt( path, (array != 0).astype(np.uint8), fmt="%d", delimiter="" )
+
+    return( path )
+
+# ************************************************************************
+# ===============================> LOAD <=================================
+# ************************************************************************
+
+def load_array( path, mmap=False ):
+    '''
+    Read back an array written by dump_array().
+
+    INPUTS:-
+        - path      : File, one of FORMATS
+        - mmap      : .npy only, map the file read-only instead of loading
+
+    OUTPUT:-
+        - array     : The array (.bits/.txt as 0/1 uint8)
+    '''
+
+    path = os.path.expanduser( path )
+    ext  = _extension( path )
+
+    if( ext == ".npy" ):
+        return( np.load( path, mmap_mode="r" if mmap else None ) )
+    if( ext == ".npz" ):
+        return( np.load( path )["array"] )
+    if( ext == ".bits" ):
+        with open( path, "r" ) as f:
+            header = f.readline().split()
+            rows, cols = int( header[2] ), int( header[3] )
+            packed = np.frombuffer( f.read().replace("\n", "").decode("hex"), dtype=np.uint8 )
+        return( np.unpackbits( packed.reshape(rows, -1), axis=1 )[:, :cols] )
+
+    with open( path, "r" ) as f:
+        lines = f.read().split()
+    return( ( np.array( [ bytearray(line) for line in lines ], dtype=np.uint8 ) - ord("0") ) )
+
+# ------------------------------------------------------------------------
+
+def _extension( path ):
+    ext = os.path.splitext( path )[1].lower()
+    if( ext not in FORMATS ):
+        raise ValueError( "Unknown format {}, expected one of {}".format(ext, FORMATS) )
+    return( ext )
+
+# ************************************************************************
+# ==============================> VIEWER <================================
+# ************************************************************************
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser( description="View an array dumped by arrayDump.dump_array()" )
+
+    ap.add_argument( "path", help="Dump file (.npy/.npz/.bits/.txt)" )
+    ap.add_argument( "-s", "--scale", type=float, default=2.0,
+                     help="Display scale. Default=2" )
+
+    args = vars( ap.parse_args() )
+
+    import  cv2
+    array = load_array( args["path"], mmap=True )
+    print( "{}: shape {}, dtype {}, {:.1f}% non-zero".format(
+           args["path"], array.shape, array.dtype, 100.0*np.count_nonzero(array)/array.size) )
+
+    view = np.asarray( array )
+    if( view.dtype == np.bool_ or view.max() <= 1 ):        # Binary: make it visible
+        view = ( view != 0 ).astype( np.uint8 ) * 255
+    view = cv2.resize( view.astype(np.uint8), None, fx=args["scale"], fy=args["scale"],
+                       interpolation=cv2.INTER_NEAREST )
+
+    cv2.imshow( os.path.basename(args["path"]), view )
+    cv2.waitKey( 0 )
+    cv2.destroyAllWindows()
@@ -1,54 +1,256 @@
-from    usbProtocol                 import  createUSBPort   # Create USB Port
-from    threading                   import  Thread          # Used to thread processes
-from    Queue                       import  LifoQueue       # Used to queue input/output
-from    time                        import  sleep, time, clock
-
-# number of samples
-n = 2500
-
-# Initialize ToF sensor
-deviceName, port, baudRate = "VL6180", 0, 115200
-ToF = createUSBPort( deviceName, port, baudRate, 3 )
-if ToF.is_open == False:
-    ToF.open()
-ToF.close()
-
-print('Benchmark: START')
-print('Sampling %i data points' %n)
-print('=====================================\n')
-
-if ToF.is_open == False:
-    ToF.open()
-
-now = clock()
-dist1 = []
-for i in range(1, n):
-    dist1.append(int( ( ToF.read(size=2).strip('\0') ).strip('\n') ))
-elapsed = ( clock()-now )
-
-print( 'PySerial: %f' %elapsed )
-print( 'Length  : %i' %len(dist1) )
-#print( 'Type    : %s' %type(dist))
-#print( 'Value   : %i' %dist )
-ToF.close()
-
-print('\n=====================================\n')
-
-if ToF.is_open == False:
-    ToF.open()
-
-now = clock()
-dist2 = []
-for i in range(1, n):
-    dist2.append( int( (ToF.readline()[:-1]).strip('\0') ) )
-elapsed = ( clock()-now )
-
-print( 'I/O     : %f' %elapsed )
-print( 'Length  : %i' %len(dist2) )
-#print( 'Type    : %s' %type(dist))
-#print( 'Value   : %i' %dist )
-ToF.close()
-
-print('\n=====================================')
-print('\nBenchmark: END')
+'''
+* benchmarkTool.py
+*
+* Benchmark the ways of reading the ToF sensor's serial stream.
+*
+* Every read strategy is run at every (baud rate, sample rate) pair and
+* reports throughput, per-sample latency percentiles and the CPU time
+* the reading thread burned, so the cheapest reader can be picked with
+* data rather than by eye.
+*
+* STRATEGIES:
+*   - read1     : port.read(1), one byte per call
+*   - bulk      : port.read(port.in_waiting), drain whatever is pending
+*   - read_until: port.read_until("\n")            (line formats only)
+*   - readline  : port.readline()                  (line formats only)
+*   - os_read   : select() + os.read() on the port's file descriptor
+*
+* By default every case runs against a fresh tofEmulator.py pty that is
+* throttled to the baud rate under test and records when each sample was
+* taken, which gives true per-sample latency. With --port the cases run
+* against a real device instead; latency is then not available and only
+* throughput and CPU are reported (the device must already stream in
+* --format, at the baud rate it was built for).
+*
+* USAGE:
+*   python benchmarkTool.py                                 # Emulator, defaults
+*   python benchmarkTool.py -b 9600,115200 -r 100,1000 -n 2000
+*   python benchmarkTool.py --format frames -s bulk,os_read
+*   python benchmarkTool.py --port 0 -b 115200 --format frames
+'''
 
+import  os, select, argparse, csv
+import  serial
+import  numpy                                               as  np
+from    collections                 import  OrderedDict
+from    time                        import  time
+from    timeStamp                   import  fullStamp       # Show date/time on console output
+from    usbProtocol                 import  usbPortPath, FrameDecoder
+from    tofEmulator                 import  ToFEmulator, sweep_trace
+
+# ************************************************************************
+# ===========================> READ STRATEGIES <=========================
+# ************************************************************************
+
+def read_one( port ):
+    return( port.read(1) )
+
+def read_bulk( port ):
+    return( port.read( max(1, port.in_waiting) ) )
+
+def read_until( port ):
+    return( port.read_until("\n") )
+
+def read_line( port ):
+    return( port.readline() )
+
+def read_fd( port ):
+    ready, _, _ = select.select( [port.fileno()], [], [], port.timeout )
+    if( not ready ):
+        return( "" )
+    return( os.read( port.fileno(), 4096 ) )
+
+STRATEGIES = OrderedDict( [ ( "read1"     , read_one   ),
+                            ( "bulk"      , read_bulk  ),
+                            ( "read_until", read_until ),
+                            ( "readline"  , read_line  ),
+                            ( "os_read"   , read_fd    ) ] )
+
+LINE_ONLY = [ "read_until", "readline" ]                    # Meaningless on binary frames
+
+# ************************************************************************
+# ==============================> PARSERS <==============================
+# ************************************************************************
+
+class LineCounter( object ):
+    '''
+    Count complete decimal readings ("mm\\n") in a byte stream.
+    '''
+
+    def __init__( self ):
+        self.partial = ""
+
+    def feed( self, data ):
+        lines = ( self.partial + data ).split( "\n" )
+        self.partial = lines.pop()
+        return( sum( 1 for line in lines if line.strip("\0").isdigit() ) )
+
+class FrameCounter( object ):
+    '''
+    Count samples decoded from framed binary packets.
+    '''
+
+    def __init__( self ):
+        self.decoder = FrameDecoder()
+
+    def feed( self, data ):
+        return( len( self.decoder.feed(data) ) )
+
+# ************************************************************************
+# ============================> MEASUREMENT <============================
+# ************************************************************************
+
+def thread_cpu():
+    '''
+    CPU time (user+sys, sec) consumed by the calling (main) thread only,
+    so an in-process emulator does not count against the reader.
+    '''
+
+    with open( "/proc/self/task/{}/stat".format(os.getpid()), "r" ) as f:
+        fields = f.read().rsplit( ")", 1 )[1].split()
+
+    return( ( int(fields[11]) + int(fields[12]) ) / float( os.sysconf("SC_CLK_TCK") ) )
+
+# ------------------------------------------------------------------------
+
+def run_case( strategy, n, baud, rate, fmt, port=None, batch=4 ):
+    '''
+    Read n samples with one strategy.
+
+    INPUTS:-
+        - strategy  : Key of STRATEGIES
+        - n         : Number of samples to read
+        - baud      : Baud rate
+        - rate      : Emulator sample rate (Hz, 0 = as fast as possible)
+        - fmt       : "lines" or "frames"
+        - port      : Real port (number or path), None for the emulator
+        - batch     : Samples per frame (emulator, "frames" only)
+
+    OUTPUT:-
+        - result    : Dict of measurements
+    '''
+
+    emulator = None
+    if( port is None ):
+        emulator = ToFEmulator( sweep_trace(), rate=rate, fmt=fmt, batch=batch,
+                                wait_start=True, baud=baud, record=True )
+        path = emulator.start()
+    else:
+        path = usbPortPath( port )
+
+    ser     = serial.Serial( port=path, baudrate=baud, timeout=1.0 )
+    read    = STRATEGIES[ strategy ]
+    counter = LineCounter() if fmt == "lines" else FrameCounter()
+
+    try:
+        if( emulator is not None ):                         # Start sequence; samples follow the 'y'
+            ser.write( "2" )
+            ser.read_until( "y" )
+        else:
+            ser.reset_input_buffer()                        # Only time fresh samples
+
+        deadline = time() + 5.0 + ( 2.0*n/rate if rate else 10.0 )
+        received = []                                       # Receive time of every sample
+        cpu0, t0 = thread_cpu(), time()
+
+        while( len(received) < n and time() < deadline ):
+            data = read( ser )
+            if( not data ):
+                continue
+            now = time()
+            received.extend( [now] * counter.feed(data) )
+
+        elapsed, cpu = time() - t0, thread_cpu() - cpu0
+
+    finally:
+        ser.close()
+        if( emulator is not None ):
+            emulator.stop()
+
+    received = received[:n]
+    result = OrderedDict( [ ( "strategy"  , strategy ),
+                            ( "baud"      , baud     ),
+                            ( "rate"      , rate if port is None else "device" ),
+                            ( "samples"   , len(received) ),
+                            ( "throughput", len(received) / elapsed if elapsed else 0.0 ),
+                            ( "cpu_pct"   , 100.0 * cpu / elapsed if elapsed else 0.0 ),
+                            ( "p50_ms"    , None ),
+                            ( "p95_ms"    , None ),
+                            ( "p99_ms"    , None ) ] )
+
+    if( emulator is not None and received ):
+        m       = min( len(received), len(emulator.emitted) )
+        latency = 1000.0 * ( np.array(received[:m]) - np.array(emulator.emitted[:m]) )
+        result["p50_ms"], result["p95_ms"], result["p99_ms"] = np.percentile( latency, [50, 95, 99] )
+
+    return( result )
+
+# ************************************************************************
+# =============================> REPORTING <=============================
+# ************************************************************************
+
+def print_result( r ):
+    def ms( v ):
+        return( "     n/a" if v is None else "{:8.2f}".format(v) )
+
+    print( "{:<10} {:>7} {:>6} {:>7} {:>10.1f} {:>6.1f}% {} {} {}".format(
+           r["strategy"], r["baud"], r["rate"], r["samples"], r["throughput"],
+           r["cpu_pct"], ms(r["p50_ms"]), ms(r["p95_ms"]), ms(r["p99_ms"])) )
+
+def print_header():
+    print( "{:<10} {:>7} {:>6} {:>7} {:>10} {:>7} {:>8} {:>8} {:>8}".format(
+           "strategy", "baud", "rate", "samples", "samples/s", "cpu", "p50 ms", "p95 ms", "p99 ms") )
+    print( "-"*84 )
+
+# ************************************************************************
+# ===========================> RUN BENCHMARK <===========================
+# ************************************************************************
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser( description="Benchmark serial read strategies for the ToF sensor" )
+
+    ap.add_argument( "-n", "--samples", type=int, default=1000,
+                     help="Samples per case. Default=1000" )
+    ap.add_argument( "-b", "--bauds", default="9600,115200,921600",
+                     help="Comma separated baud rates. Default=9600,115200,921600" )
+    ap.add_argument( "-r", "--rates", default="500,2000",
+                     help="Comma separated emulator sample rates (Hz, 0 = max). Default=500,2000" )
+    ap.add_argument( "-s", "--strategies", default=",".join(STRATEGIES.keys()),
+                     help="Comma separated strategies. Default=all" )
+    ap.add_argument( "-f", "--format", default="lines", choices=[ "lines", "frames" ],
+                     help="Stream format. Default=lines" )
+    ap.add_argument( "--batch", type=int, default=4,
+                     help="Samples per frame for --format frames. Default=4" )
+    ap.add_argument( "-p", "--port", default=None,
+                     help="Benchmark a real device (port number or path) instead of the emulator" )
+    ap.add_argument( "-o", "--output", default=None,
+                     help="Also write the results to this CSV file" )
+
+    args = vars( ap.parse_args() )
+
+    bauds       = [ int(b) for b in args["bauds"].split(",") ]
+    rates       = [ float(r) for r in args["rates"].split(",") ] if args["port"] is None else [ 0 ]
+    strategies  = [ s for s in args["strategies"].split(",")
+                    if not ( args["format"] == "frames" and s in LINE_ONLY ) ]
+
+    print( "{} Benchmark: START ({} samples per case, {})".format(
+           fullStamp(), args["samples"], args["port"] or "emulator") )
+    print_header()
+
+    results = []
+    for baud in bauds:
+        for rate in rates:
+            for strategy in strategies:
+                r = run_case( strategy, args["samples"], baud, rate, args["format"],
+                              port=args["port"], batch=args["batch"] )
+                print_result( r )
+                results.append( r )
+
+    if( args["output"] is not None ):
+        with open( args["output"], "w" ) as f:
+            writer = csv.DictWriter( f, fieldnames=results[0].keys() )
+            writer.writeheader()
+            writer.writerows( results )
+
+    print( "{} Benchmark: END".format(fullStamp()) )
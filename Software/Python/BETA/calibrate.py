@@ -15,6 +15,16 @@
 #    1- Reduced memory footprint
 #    2- Tweaked HoughCircles parameters
 #    3- Print thresholded array to file for debugging purposes
+#    4- Dump thresholded array with arrayDump (one vectorized write)
+#    5- Batch calibration (--batch): every image of a folder, across a
+#       process pool, least-squares distance model saved as a profile
+#    6- Marker radius range is an option (--radius); degenerate or poor
+#       fits are refused instead of written
+#
+# USAGE:
+#    python calibrate.py                                   # Single reference image
+#    python calibrate.py --batch ../../../Images/Calibration
+#    python calibrate.py --batch ../../../Images/Calibration --radius 10:200 --max-rms 25
 #
 '''
 
@@ -25,9 +35,22 @@ import imutils
 
 import  sys
 import  os
+import  re
+import  json
+import  argparse
 from    os.path                import expanduser
+from    multiprocessing        import Pool, cpu_count
+from    timeStamp              import fullStamp
+from    arrayDump              import dump_array
+
+# Debug dump of the thresholded array (.npz/.npy/.bits/.txt, None = off)
+# View with: python arrayDump.py <file>
+DUMP_DIR = os.path.join(expanduser("~"), "Desktop")
+DUMP_FORMAT = ".npz"
  
-def find_marker(image):
+def find_marker(image, name="numpyArray", show=True, radius=None):
+    # radius: (min, max) marker radius in px, max 0 = no limit
+    (minRadius, maxRadius) = RADIUS_RANGE if radius is None else radius
 
     # Convert into grayscale because HoughCircle only accepts grayscale images
     bgr2gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -66,46 +89,27 @@ def find_marker(image):
         cv2.imshow(titles[i], cv2.resize(images[i], (936, 714)))
     '''
     
-    # Print data on device-specific text files
-    print("Writing array to datafile...\nPlease wait...")
-    rows = bgr2gray.shape[0]
-    columns = bgr2gray.shape[1]
-    array=bgr2gray.copy()
-
-    dataFileDir = "/home/pi/Desktop" 
-
-    if os.path.exists(dataFileDir) == False:
-        os.makedirs(dataFileDir)
-
-    dataFileName = "/numpyArray.txt"
-    dataFilePath = dataFileDir + dataFileName
-
-    for i in range(rows):
-        for j in range(columns):
-            if array[i][j]==255:
-                array[i][j]=1
-       
-
-    for i in range(rows):
-        for j in range(columns):
-            with open(dataFilePath, "a") as dataFile:
-                dataFile.write(str(array[i][j]))
-        with open(dataFilePath, "a") as dataFile:
-            dataFile.write('\n')
-    print("Done!!")
+    # Dump data for debugging (binary, single write)
+    if DUMP_FORMAT is not None:
+        dataFilePath = dump_array(bgr2gray, os.path.join(DUMP_DIR, name + DUMP_FORMAT))
+        print("Thresholded array written to " + dataFilePath)
     # ___END___
     
     
-    # Find circle outline
+    # Find circle outline (by keyword: the 5th positional argument is the
+    # output array, which silently shifted every parameter by one, so the
+    # positional call really ran with param1=43, param2=50, minRadius=70;
+    # those thresholds are kept, the radius range is now a parameter)
     circles = cv2.HoughCircles(bgr2gray, cv2.HOUGH_GRADIENT, 14, 396,
-                               191, 43, 50, 70)
+                               param1=43, param2=50, minRadius=minRadius, maxRadius=maxRadius)
     '''
     ORIGINAL:
     circles = cv2.HoughCircles(bgr2gray, cv2.HOUGH_GRADIENT, 16, 1000,
                                191, 43, 50, 150)
     '''
     # For debugging purposes only
-    cv2.imshow("thresholded", bgr2gray.copy())
+    if show:
+        cv2.imshow("thresholded", bgr2gray.copy())
 
     if circles is not None:
             circles = numpy.round(circles[0,:]).astype("int")
@@ -120,8 +124,9 @@ def find_marker(image):
                 cv2.putText(image, pos, (x - 20, y - 20),
                             cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
 
-            cv2.imshow("image", image)
-            cv2.waitKey(0)
+            if show:
+                cv2.imshow("image", image)
+                cv2.waitKey(0)
             return(x,y,r)
 
         
@@ -139,29 +144,177 @@ KNOWN_WIDTH = 2.0
  
 # Load the images we are going to use
 IMAGE_PATHS = ["images/3.5inch.png"]
- 
-# Load the reference scale image and obtain the required
-# parameters (focal length) from it by using the known variables
-image = cv2.resize(cv2.imread(IMAGE_PATHS[0]), (360, 276))
-marker = find_marker(image)
-focalLength = (marker[2] * KNOWN_DISTANCE) / KNOWN_WIDTH
-
-# Used for development purposes
-# Loop over the images
-for imagePath in IMAGE_PATHS:
-
-    # Load the image, find the marker (circles) in the image, then
-    # compute the distance to the marker from the camera
-    image = cv2.resize(cv2.imread(imagePath, cv2.IMREAD_UNCHANGED), (360, 276))
-    marker = find_marker(image)
+
+# Size every image is resized to before detection
+IMAGE_SIZE = (360, 276)
+
+# Marker radius (px at IMAGE_SIZE) searched for, max 0 = no limit. Must
+# span the whole distance set: the marker is ~110 px at 3.5in, ~30 px at 4ft
+RADIUS_RANGE = (10, 0)
+
+# Largest RMS residual (mm) of a fit that is still written as a profile
+MAX_RMS = 25.0
+
+# Calibration profile read by the live feeds (see Stable/calibration.py)
+PROFILE_VERSION = 1
+PROFILE_PATH = os.path.join(expanduser("~"), ".ophthalmoscope", "calibration.json")
+
+# Distance encoded in a calibration image name, e.g. 3in.png, 3.5inch.png, 2ft.png
+DISTANCE_NAME = re.compile(r"(\d+(?:\.\d+)?)\s*(in|inch|ft)")
+
+
+def distance_from_name(imagePath):
+    # Distance (inches) from the file name, None if it has none
+    match = DISTANCE_NAME.search(os.path.basename(imagePath).lower())
+    if match is None:
+        return None
+    value = float(match.group(1))
+    return value*12 if match.group(2) == "ft" else value
+
+
+def measure(job):
+    # Process pool worker: job = (image path, radius range)
+    # returns (image path, distance in inches, (x, y, r) or None)
+    (imagePath, radius) = job
+    image = cv2.imread(imagePath)
+    if image is None:
+        return (imagePath, distance_from_name(imagePath), None)
+    image = cv2.resize(image, IMAGE_SIZE)
+    name = os.path.basename(imagePath).replace(".", "_")                # 4ft.png and 4ft.jpg both kept
+    return (imagePath, distance_from_name(imagePath), find_marker(image, name, show=False, radius=radius))
+
+
+def fit_profile(samples):
+    # Least-squares fit of distance = a/radius + b (pinhole camera, plus an
+    # offset for the lens-to-stand distance) over (distance mm, radius px) pairs.
+    # Raises ValueError if the samples cannot determine both a and b
+    distances = numpy.array([d for (d, r) in samples], dtype=float)
+    radii = numpy.array([r for (d, r) in samples], dtype=float)
+    if len(set(distances)) < 2 or len(set(radii)) < 2:
+        raise ValueError("need at least 2 distinct distances and 2 distinct radii, got %d and %d"
+                         %(len(set(distances)), len(set(radii))))
+    A = numpy.column_stack((1.0/radii, numpy.ones(len(radii))))
+    (solution, residues, rank, sv) = numpy.linalg.lstsq(A, distances, rcond=None)
+    if rank < 2:                                                    # lstsq would return a minimum-norm guess
+        raise ValueError("rank-deficient fit (rank %d)" %rank)
+    (a, b) = solution
+    if a <= 0:                                                      # Distance must fall as the marker grows
+        raise ValueError("non-physical fit, a = %.1f" %a)
+    fitted = a/radii + b
+    return (a, b, fitted, distances - fitted)
+
+
+def batch_calibrate(folder, output, jobs, radius=RADIUS_RANGE, maxRms=MAX_RMS):
+    # Run find_marker over every image in folder across a process pool,
+    # fit the radius-to-distance model and write the calibration profile
+    # (nothing is written if the fit is degenerate or its RMS exceeds maxRms)
+    imagePaths = sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                        if os.path.splitext(f)[1].lower() in (".png", ".jpg", ".jpeg"))
+
+    pool = Pool(processes=jobs)
+    try:
+        results = pool.map(measure, [(p, radius) for p in imagePaths])
+    finally:
+        pool.close()
+        pool.join()
+
+    used = []
+    for (imagePath, inches, marker) in results:
+        if inches is None or marker is None:
+            print(fullStamp() + " Skipped %s (%s)" %(imagePath, "no distance in name" if inches is None else "no marker found"))
+            continue
+        used.append((imagePath, inches*25.4, marker))
+
+    if len(used) == 0:
+        print(fullStamp() + " No usable calibration images in " + folder)
+        return None
+
+    for (imagePath, d, marker) in used:
+        print(fullStamp() + " %s: %.1f mm, radius %d px" %(os.path.basename(imagePath), d, marker[2]))
+
+    try:
+        (a, b, fitted, residuals) = fit_profile([(d, marker[2]) for (imagePath, d, marker) in used])
+    except ValueError as error:
+        print(fullStamp() + " Calibration refused: %s (try another --radius range)" %error)
+        return None
+    rms = float(numpy.sqrt(numpy.mean(residuals**2)))
+
+    profile = {"version"        : PROFILE_VERSION,
+               "created"        : fullStamp(),
+               "image_size"     : list(IMAGE_SIZE),
+               "known_width_mm" : KNOWN_WIDTH*25.4,
+               "focal_px"       : float(a/(KNOWN_WIDTH*25.4)),
+               "model"          : {"type": "inverse", "a": float(a), "b": float(b)},
+               "rms_mm"         : rms,
+               "samples"        : [{"image"       : os.path.basename(imagePath),
+                                    "distance_mm" : d,
+                                    "radius_px"   : int(marker[2]),
+                                    "fitted_mm"   : float(f),
+                                    "residual_mm" : float(e)}
+                                   for ((imagePath, d, marker), f, e) in zip(used, fitted, residuals)]}
+
+    print("%-24s %12s %10s %12s %12s" %("image", "distance mm", "radius px", "fitted mm", "residual mm"))
+    for sample in profile["samples"]:
+        print("%-24s %12.1f %10d %12.1f %12.1f" %(sample["image"], sample["distance_mm"], sample["radius_px"],
+                                                   sample["fitted_mm"], sample["residual_mm"]))
+    print(fullStamp() + " distance_mm = %.1f / radius_px + %.1f (focal %.1f px, RMS %.1f mm)" %(a, b, profile["focal_px"], rms))
+
+    if rms > maxRms:
+        print(fullStamp() + " Calibration refused: RMS %.1f mm over the %.1f mm limit, profile not written" %(rms, maxRms))
+        return None
+
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, "w") as f:
+        json.dump(profile, f, indent=4, sort_keys=True)
+
+    print(fullStamp() + " Profile written to " + output)
+    return profile
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser(description="Calibrate camera distance from images of the scale buck")
+    ap.add_argument("-b", "--batch", default=None,
+                    help="calibrate from every image in this folder (distance in the file name)")
+    ap.add_argument("-o", "--output", default=PROFILE_PATH,
+                    help="calibration profile to write. default=" + PROFILE_PATH)
+    ap.add_argument("-j", "--jobs", type=int, default=cpu_count(),
+                    help="worker processes for --batch. default=CPU count")
+    ap.add_argument("-r", "--radius", default="%d:%d" %RADIUS_RANGE,
+                    help="marker radius range MIN:MAX in px at %dx%d, MAX 0 = no limit. default=%d:%d"
+                         %(IMAGE_SIZE + RADIUS_RANGE))
+    ap.add_argument("--max-rms", type=float, default=MAX_RMS,
+                    help="refuse fits with a larger RMS residual (mm). default=%.0f" %MAX_RMS)
+    args = vars(ap.parse_args())
+    radius = tuple(int(n) for n in args["radius"].split(":"))
+
+    if args["batch"] is not None:
+        sys.exit(0 if batch_calibrate(args["batch"], args["output"], args["jobs"],
+                                      radius, args["max_rms"]) else 1)
+
+    # Load the reference scale image and obtain the required
+    # parameters (focal length) from it by using the known variables
+    image = cv2.resize(cv2.imread(IMAGE_PATHS[0]), (360, 276))
+    marker = find_marker(image, "reference", radius=radius)
+    focalLength = (marker[2] * KNOWN_DISTANCE) / KNOWN_WIDTH
+
+    # Used for development purposes
+    # Loop over the images
+    for imagePath in IMAGE_PATHS:
+
+        # Load the image, find the marker (circles) in the image, then
+        # compute the distance to the marker from the camera
+        image = cv2.resize(cv2.imread(imagePath, cv2.IMREAD_UNCHANGED), (360, 276))
+        marker = find_marker(image, os.path.splitext(os.path.basename(imagePath))[0], radius=radius)
         
-    inches = distance_to_camera(KNOWN_WIDTH, focalLength, marker[2])
-
-    # Draw detected circle and print distance
-    cv2.circle(image, (marker[0], marker[1]), marker[2],(0,255,0),4)
-    cv2.putText(image, "%.2fft" % (inches / 12),
-            (image.shape[1] - 100, image.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX,
-            1.0, (0, 255, 0), 3)
-    # Display Image
-    cv2.imshow("image", image)
-    cv2.waitKey(0)
+        inches = distance_to_camera(KNOWN_WIDTH, focalLength, marker[2])
+
+        # Draw detected circle and print distance
+        cv2.circle(image, (marker[0], marker[1]), marker[2],(0,255,0),4)
+        cv2.putText(image, "%.2fft" % (inches / 12),
+                (image.shape[1] - 100, image.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX,
+                1.0, (0, 255, 0), 3)
+        # Display Image
+        cv2.imshow("image", image)
+        cv2.waitKey(0)
@@ -0,0 +1,193 @@
+'''
+* lensCalibrate.py
+*
+* Estimate the camera intrinsics and lens distortion from a set of
+* checkerboard or circle-grid images, and write the lens profile that
+* the live feeds undistort with (see Stable/lens.py).
+*
+* Take the images with the camera at its live-feed resolution (full
+* capture, NOT cropped), the target filling different parts of the
+* view, the edge of the aperture especially. Pattern detection runs
+* across a process pool, one image per worker.
+*
+* USAGE:
+*   python lensCalibrate.py <folder> -p chessboard -g 9x6
+*   python lensCalibrate.py <folder> -p acircles -g 4x11 -o lens.json
+*   python lensCalibrate.py <folder> -v            # Show every detection
+'''
+
+import  os, json, argparse
+import  numpy                                               as  np
+import  cv2
+from    multiprocessing             import  Pool, cpu_count
+from    timeStamp                   import  fullStamp       # Show date/time on console output
+
+LENS_VERSION    = 1                                         # Must match Stable/lens.py
+LENS_PATH       = os.path.join( os.path.expanduser("~"), ".ophthalmoscope", "lens.json" )
+PATTERNS        = [ "chessboard", "circles", "acircles" ]
+EXTENSIONS      = ( ".png", ".jpg", ".jpeg", ".bmp" )
+
+# ************************************************************************
+# =============================> DETECTION <==============================
+# ************************************************************************
+
+def object_points( pattern, grid, spacing=1.0 ):
+    '''
+    INPUTS:-
+        - pattern   : One of PATTERNS
+        - grid      : (cols, rows) of inner corners/circles
+        - spacing   : Square/circle spacing (any unit, only scales the
+                      reported extrinsics)
+
+    OUTPUT:-
+        - (cols*rows, 3) float32 target co-ordinates, z = 0
+    '''
+
+    cols, rows = grid
+    points = np.zeros( (rows*cols, 3), np.float32 )
+    if( pattern == "acircles" ):                            # Every other row shifted by half a step
+        points[:, :2] = [ ( (2*c + r % 2)*spacing, r*spacing ) for r in range(rows) for c in range(cols) ]
+    else:
+        points[:, :2] = np.mgrid[ 0:cols, 0:rows ].T.reshape( -1, 2 ) * spacing
+    return( points )
+
+# ------------------------------------------------------------------------
+
+def find_pattern( job ):
+    '''
+    Process pool worker.
+
+    INPUTS:-
+        - job       : (image path, pattern, grid)
+
+    OUTPUT:-
+        - (image path, (w, h) or None, (N, 1, 2) image points or None)
+    '''
+
+    imagePath, pattern, grid = job
+    gray = cv2.imread( imagePath, cv2.IMREAD_GRAYSCALE )
+    if( gray is None ):
+        return( imagePath, None, None )
+    size = ( gray.shape[1], gray.shape[0] )
+
+    if( pattern == "chessboard" ):
+        found, corners = cv2.findChessboardCorners( gray, grid,
+                                                    flags=cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE )
+        if( found ):
+            criteria = ( cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001 )
+            corners  = cv2.cornerSubPix( gray, corners, (5, 5), (-1, -1), criteria )
+    else:
+        flags = cv2.CALIB_CB_ASYMMETRIC_GRID if pattern == "acircles" else cv2.CALIB_CB_SYMMETRIC_GRID
+        found, corners = cv2.findCirclesGrid( gray, grid, flags=flags )
+
+    return( imagePath, size, corners if found else None )
+
+# ************************************************************************
+# ============================> CALIBRATION <=============================
+# ************************************************************************
+
+def calibrate_lens( folder, pattern, grid, spacing, output, jobs, view=False ):
+    '''
+    Detect the pattern in every image of folder, calibrate the camera and
+    write the lens profile.
+
+    OUTPUT:-
+        - The profile (dict), None if too few images were usable
+    '''
+
+    imagePaths = sorted( os.path.join(folder, f) for f in os.listdir(folder)
+                         if os.path.splitext(f)[1].lower() in EXTENSIONS )
+
+    pool = Pool( processes=jobs )
+    try:
+        results = pool.map( find_pattern, [ (p, pattern, grid) for p in imagePaths ] )
+    finally:
+        pool.close()
+        pool.join()
+
+    target = object_points( pattern, grid, spacing )
+    used, objectPoints, imagePoints, size = [], [], [], None
+    for ( imagePath, imageSize, corners ) in results:
+        if( corners is None ):
+            print( fullStamp() + " Skipped {} ({})".format(imagePath, "unreadable" if imageSize is None else "no pattern found") )
+            continue
+        if( size is not None and imageSize != size ):
+            print( fullStamp() + " Skipped {} ({}x{}, expected {}x{})".format(imagePath, imageSize[0], imageSize[1], size[0], size[1]) )
+            continue
+
+        size = imageSize
+        used.append( imagePath )
+        objectPoints.append( target )
+        imagePoints.append( corners )
+
+        if( view ):
+            image = cv2.imread( imagePath )
+            cv2.drawChessboardCorners( image, grid, corners, True )
+            cv2.imshow( "lensCalibrate", image )
+            cv2.waitKey( 0 )
+
+    if( len(used) < 3 ):
+        print( fullStamp() + " {} usable image(s) in {}, need at least 3".format(len(used), folder) )
+        return( None )
+
+    rms, K, coeffs, rvecs, tvecs = cv2.calibrateCamera( objectPoints, imagePoints, size, None, None )
+
+    # Per-image reprojection error, to spot a bad detection
+    errors = []
+    for ( points, corners, rvec, tvec ) in zip( objectPoints, imagePoints, rvecs, tvecs ):
+        projected, _ = cv2.projectPoints( points, rvec, tvec, K, coeffs )
+        errors.append( float( np.sqrt( np.mean( np.sum( (projected - corners)**2, axis=2 ) ) ) ) )
+
+    profile = { "version"       : LENS_VERSION,
+                "created"       : fullStamp(),
+                "image_size"    : list( size ),
+                "pattern"       : pattern,
+                "grid"          : list( grid ),
+                "camera_matrix" : K.tolist(),
+                "dist_coeffs"   : coeffs.ravel().tolist(),
+                "rms_px"        : float( rms ),
+                "images"        : [ { "image": os.path.basename(p), "rms_px": e } for p, e in zip(used, errors) ] }
+
+    folder = os.path.dirname( output )
+    if( folder and not os.path.exists(folder) ):
+        os.makedirs( folder )
+    with open( output, "w" ) as f:
+        json.dump( profile, f, indent=4, sort_keys=True )
+
+    print( "{:<32} {:>10}".format("image", "RMS px") )
+    for image in profile["images"]:
+        print( "{:<32} {:>10.3f}".format(image["image"], image["rms_px"]) )
+    print( fullStamp() + " f = {:.1f}, {:.1f} px  c = {:.1f}, {:.1f} px  k = {}".format(
+           K[0,0], K[1,1], K[0,2], K[1,2], np.round( coeffs.ravel(), 4 ).tolist()) )
+    print( fullStamp() + " RMS reprojection error {:.3f} px over {} images".format(rms, len(used)) )
+    print( fullStamp() + " Lens profile written to " + output )
+    return( profile )
+
+# ************************************************************************
+# ===============================> MAIN <=================================
+# ************************************************************************
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser( description="Calibrate the lens from checkerboard/circle-grid images" )
+
+    ap.add_argument( "folder", help="Folder of calibration images (full capture resolution)" )
+    ap.add_argument( "-p", "--pattern", choices=PATTERNS, default="chessboard",
+                     help="Calibration target. Default=chessboard" )
+    ap.add_argument( "-g", "--grid", default="9x6",
+                     help="Inner corners (chessboard) or circles per row x rows. Default=9x6" )
+    ap.add_argument( "-s", "--spacing", type=float, default=1.0,
+                     help="Square/circle spacing (mm). Default=1" )
+    ap.add_argument( "-o", "--output", default=LENS_PATH,
+                     help="Lens profile to write. Default=" + LENS_PATH )
+    ap.add_argument( "-j", "--jobs", type=int, default=cpu_count(),
+                     help="Worker processes. Default=CPU count" )
+    ap.add_argument( "-v", "--view", action="store_true",
+                     help="Show every detected pattern" )
+
+    args = vars( ap.parse_args() )
+    grid = tuple( int(n) for n in args["grid"].lower().split("x") )
+
+    profile = calibrate_lens( args["folder"], args["pattern"], grid, args["spacing"],
+                              args["output"], args["jobs"], args["view"] )
+    raise SystemExit( 0 if profile else 1 )
@@ -0,0 +1,336 @@
+'''
+* tofEmulator.py
+*
+* Pseudo-terminal emulator of the ESP32/VL6180 ToF sensor, so anything
+* that goes through createUSBPort() (getDist/ToFReader, usbConnectionCheck,
+* sendUntilRead, benchmarkTool.py) can be tested and profiled without
+* the hardware.
+*
+* The emulator speaks the same handshake as Arduino/main/main.ino:
+*   - SOH + "[INFO] SENSOR INITIALIZED" once ready (and after a reboot)
+*   - ENQ --> ACK, DC1 --> ACK + reboot, anything unknown --> NAK
+*   - 'n' --> device name + newline        (usbConnectionCheck)
+*   - '2' --> 'y', start streaming         (live feed start sequence;
+*                                            nothing streams before it)
+* and streams a distance trace at a configurable rate in one of:
+*   - frames: framed binary protocol (usbProtocol.encodeFrame), batched
+*   - flags : legacy '0'/'1' character whenever the threshold is crossed
+*   - lines : legacy decimal millimetres, one reading per line
+*
+* TRACES:
+*   - "sweep" (default): triangle wave between 5 and 50 mm
+*   - a text/CSV file with one "mm" or "t_ms,mm" reading per line
+*   - a .npy/.npz file holding an array of mm readings ("mm" key)
+*
+* USAGE:
+*   python tofEmulator.py --rate 100 --batch 4          # Prints the pty path
+*   python tofEmulator.py --trace session.csv --format lines --link /tmp/ttyToF
+*   createUSBPort( "VL6180", "/tmp/ttyToF", 115200, 3 )  # From a client
+'''
+
+import  os, pty, tty, select, argparse
+import  numpy                                               as  np
+from    threading                   import  Thread, Event
+from    time                        import  sleep, time
+from    timeStamp                   import  fullStamp       # Show date/time on console output
+from    usbProtocol                 import  encodeFrame     # Framed ToF protocol
+from    usbProtocol                 import  SOH, ENQ, ACK, NAK, DC1
+
+FORMATS = [ "frames", "flags", "lines" ]
+
+# ************************************************************************
+# ============================> EMULATOR <===============================
+# ************************************************************************
+
+class ToFEmulator( object ):
+    '''
+    VL6180 ToF sensor behind a pseudo-terminal.
+    '''
+
+    def __init__( self, trace, rate=100.0, fmt="frames", batch=4, name="VL6180",
+                  threshold=15, loop=True, wait_start=True, link=None,
+                  baud=None, record=False ):
+        '''
+        INPUTS:-
+            - trace     : Sequence of distances (mm), one per sample
+            - rate      : Samples per second (0 = as fast as possible)
+            - fmt       : "frames", "flags" or "lines"
+            - batch     : Samples per frame ("frames" only)
+            - name      : Reply to the 'n' name query
+            - threshold : In-range distance ("flags" only)
+            - loop      : Replay the trace forever
+            - wait_start: Only stream after the '2' start command, like
+                          the firmware (False = stream from boot)
+            - link      : Optional symlink to the pty (e.g. /tmp/ttyToF)
+            - baud      : Throttle writes to this line rate (8N1, 10 bits
+                          per byte); a pty is otherwise unlimited
+            - record    : Keep the time() each sample was taken, in
+                          order, in self.emitted (for latency benchmarks)
+        '''
+
+        if( fmt not in FORMATS ):
+            raise ValueError( "Unknown format {}, expected one of {}".format(fmt, FORMATS) )
+
+        self.trace      = [ int(d) for d in trace ]
+        self.rate       = rate
+        self.fmt        = fmt
+        self.batch      = max( 1, int(batch) )
+        self.name       = name
+        self.threshold  = threshold
+        self.loop       = loop
+        self.wait_start = wait_start
+        self.link       = link
+        self.baud       = baud
+        self.emitted    = [] if record else None
+
+        self.master     = None
+        self.slave      = None
+        self.path       = None
+        self.streaming  = not wait_start
+        self.stopped    = Event()
+        self.thread     = None
+
+        self.index      = 0                                 # Next sample in the trace
+        self.seq        = 0                                 # Sequence number of the next sample
+        self.pending    = []                                # Samples waiting for a full batch
+        self.state      = None                              # Last reported flag ("flags" only)
+        self.t0         = None                              # "Device boot" time, for millis()
+
+        self.sent       = 0                                 # Samples sent
+        self.nbytes     = 0                                 # Bytes written
+
+    # --------------------------------------------------------------------
+
+    def start( self ):
+        '''
+        Create the pty and start the device thread.
+
+        OUTPUT:-
+            - path      : Device path clients should open
+        '''
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw( self.slave )                            # No line buffering/echo, like a real tty
+        self.path = os.ttyname( self.slave )
+
+        if( self.link is not None ):
+            if( os.path.islink(self.link) ):
+                os.remove( self.link )
+            os.symlink( self.path, self.link )
+            self.path = self.link
+
+        self.stopped.clear()
+        self.thread = Thread( target=self._run, name="ToFEmulator" )
+        self.thread.daemon = True
+        self.thread.start()
+
+        return( self.path )
+
+    # --------------------------------------------------------------------
+
+    def stop( self, timeout=5.0 ):
+        self.stopped.set()
+        if( self.thread is not None ):
+            self.thread.join( timeout )
+
+        for fd in ( self.master, self.slave ):
+            if( fd is not None ):
+                os.close( fd )
+        self.master = self.slave = None
+
+        if( self.link is not None and os.path.islink(self.link) ):
+            os.remove( self.link )
+
+    # --------------------------------------------------------------------
+
+    def _run( self ):
+        self._boot()
+        period  = 1.0/self.rate if self.rate else 0.0
+        due     = time()
+
+        while( not self.stopped.is_set() ):
+            wait = max( 0.0, due - time() ) if self.streaming else 0.1
+            ready, _, _ = select.select( [self.master], [], [], wait )
+            if( ready ):
+                self._command( os.read(self.master, 64) )
+                continue
+
+            if( not self.streaming ):
+                continue
+
+            if( not self._sample() ):                       # Trace exhausted
+                self._flush()
+                self.streaming = False
+                continue
+
+            due = max( due + period, time() - period )      # Don't try to catch up after a stall
+
+    # --------------------------------------------------------------------
+
+    def _boot( self ):
+        self.t0 = time()
+        self.state = None
+        self.seq = 0                                        # The sketch restarts its count
+        self.pending = []
+        self.streaming = not self.wait_start
+        self._write( SOH )
+        self._write( "[INFO] SENSOR INITIALIZED\n" )
+
+    # --------------------------------------------------------------------
+
+    def _command( self, data ):
+        for c in data:
+            if( c == ENQ ):
+                self._write( ACK )
+            elif( c == DC1 ):
+                self._write( ACK )
+                self._boot()                                # ESP.restart()
+            elif( c == "n" ):
+                self._write( self.name + "\n" )
+            elif( c == "2" ):
+                self._write( "y" )
+                self.streaming = True
+            else:
+                self._write( NAK )
+                self._write( "INVALID COMMAND\n" )
+
+    # --------------------------------------------------------------------
+
+    def _sample( self ):
+        '''
+        Emit the next reading of the trace.
+
+        OUTPUT:-
+            - False once the trace is exhausted (and loop is off)
+        '''
+
+        if( self.index >= len(self.trace) ):
+            if( not self.loop or len(self.trace) == 0 ):
+                return( False )
+            self.index = 0
+
+        mm = self.trace[ self.index ]
+        self.index += 1
+        if( self.emitted is not None ):
+            self.emitted.append( time() )
+
+        if( self.fmt == "frames" ):
+            stamp = int( (time() - self.t0) * 1000 )        # millis()
+            self.pending.append( (stamp, mm) )
+            if( len(self.pending) >= self.batch ):
+                self._flush()
+
+        elif( self.fmt == "flags" ):
+            state = int( mm <= self.threshold )
+            if( state != self.state ):                      # Only sent when it changes
+                self._write( str(state) )
+                self.state = state
+
+        else:
+            self._write( "{}\n".format(mm) )
+
+        self.sent += 1
+        return( True )
+
+    # --------------------------------------------------------------------
+
+    def _flush( self ):
+        if( self.pending ):
+            self._write( encodeFrame(self.seq, self.pending) )
+            self.seq = ( self.seq + len(self.pending) ) & 0xFFFF
+            self.pending = []
+
+    # --------------------------------------------------------------------
+
+    def _write( self, data ):
+        try:
+            os.write( self.master, data )
+            self.nbytes += len( data )
+        except OSError:                                     # pty torn down while stopping
+            return
+
+        if( self.baud ):
+            sleep( len(data) * 10.0 / self.baud )           # Time on the wire
+
+# ************************************************************************
+# =============================> TRACES <================================
+# ************************************************************************
+
+def sweep_trace( low=5, high=50 ):
+    '''
+    Triangle wave between low and high (mm), one sample per mm.
+    '''
+
+    up = list( range(low, high) )
+    return( up + list( range(high, low, -1) ) )
+
+# ------------------------------------------------------------------------
+
+def load_trace( path ):
+    '''
+    Load a recorded trace of distances (mm).
+
+    INPUTS:-
+        - path      : .npy/.npz array, or a text file with one "mm" or
+                      "t_ms,mm" reading per line
+
+    OUTPUT:-
+        - trace     : List of distances (mm)
+    '''
+
+    ext = os.path.splitext( path )[1].lower()
+    if( ext == ".npy" ):
+        return( np.load( path ).astype(int).ravel().tolist() )
+    if( ext == ".npz" ):
+        return( np.load( path )["mm"].astype(int).ravel().tolist() )
+
+    trace = []
+    with open( path, "r" ) as f:
+        for line in f:
+            fields = line.strip().split( "," )
+            if( fields[-1].strip().isdigit() ):             # Skips headers/comments
+                trace.append( int(fields[-1]) )
+
+    return( trace )
+
+# ************************************************************************
+# ===========================> RUN EMULATOR <============================
+# ************************************************************************
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser( description="VL6180 ToF sensor emulator on a pseudo-terminal" )
+
+    ap.add_argument( "-t", "--trace", default="sweep",
+                     help="\"sweep\" or a recorded trace (.csv/.txt/.npy/.npz)" )
+    ap.add_argument( "-r", "--rate", type=float, default=100.0,
+                     help="Samples per second (0 = as fast as possible). Default=100" )
+    ap.add_argument( "-f", "--format", default="frames", choices=FORMATS,
+                     help="Output format. Default=frames" )
+    ap.add_argument( "-b", "--batch", type=int, default=4,
+                     help="Samples per frame. Default=4" )
+    ap.add_argument( "-l", "--link", default=None,
+                     help="Symlink the pty to this path (e.g. /tmp/ttyToF)" )
+    ap.add_argument( "--no-wait", action="store_true",
+                     help="Stream from boot instead of after the '2' start command" )
+    ap.add_argument( "--baud", type=int, default=None,
+                     help="Throttle output to this baud rate. Default=unthrottled" )
+    ap.add_argument( "--once", action="store_true",
+                     help="Play the trace once instead of looping" )
+
+    args = vars( ap.parse_args() )
+
+    trace = sweep_trace() if args["trace"] == "sweep" else load_trace( args["trace"] )
+    emulator = ToFEmulator( trace, rate=args["rate"], fmt=args["format"], batch=args["batch"],
+                            loop=not args["once"], wait_start=not args["no_wait"],
+                            link=args["link"], baud=args["baud"] )
+
+    print( "{} Emulating VL6180 on {}".format(fullStamp(), emulator.start()) )
+    try:
+        while( True ):
+            sleep( 1.0 )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        print( "{} Sent {} samples ({} bytes)".format(fullStamp(), emulator.sent, emulator.nbytes) )
@@ -8,6 +8,22 @@
 *   -o/--overlay: Specify overlay file
 *   -a/--alpha: Specify transperancy level (0.0 - 1.0)
 *   -d/--debug: toggle to enable debugging mode (DEVELOPER ONLY!!!)
+*   -s/--source: picamera (default), image directory, video or .npz session
+*   -f/--fps: replay rate for non-camera sources (default: unthrottled),
+*             PiCam framerate for picamera (default: 32)
+*   -t/--track: ROI tracking, full-frame search after N misses (0 = off)
+*   -n/--detect-every: detect on 1 of every N frames, track in between
+*   -u/--usb: ToF port: auto (default), number, device path (e.g. a
+*             tofEmulator.py pty) or socket:// URL
+*   -k/--calibration: distance calibration profile (BETA/calibrate.py --batch),
+*             also gates the overlay from the pupil radius while the
+*             ToF sensor is silent
+*   -w/--target-width: diameter (mm) of the ranged circle, the profile is
+*             fitted on the 2" marker (default: 11.8, average iris)
+*   -l/--lens: lens profile to undistort frames with (BETA/lensCalibrate.py)
+*   -r/--redetect: locate the optical aperture again instead of using the
+*             one cached for this camera
+*   -g/--gate: skip all CV stages while the ToF sensor is out of range
 *
 * VERSION: 0.9.6
 *   - Threads now safely exit at program shutdown
@@ -30,6 +46,7 @@
 *
 * RIGHT CLICK: Shutdown Program.
 * LEFT CLICK: Toggle view.
+* MIDDLE CLICK: Reboot ToF sensor.
 '''
 
 ver = "TFT Live Feed Ver0.9.6"
@@ -37,13 +54,26 @@ print __doc__
 
 # Import necessary modules
 import  numpy, cv2, argparse                                # Various Stuff
-from    imutils.video.pivideostream import  PiVideoStream   # Import threaded PiCam module
+from    frameSource                 import  open_source     # PiCam or replay frame source
+from    frameBuffer                 import  FrameRing       # Preallocated BGRA frame buffers
+from    overlay                     import  OverlayCache, premultiply, composite
+from    tracking                    import  ROITracker      # Tracked-ROI detection
+from    tracking                    import  PupilTracker, DetectionScheduler
 from    imutils.video               import  FPS             # Benchmark FPS
 from    time                        import  sleep           # Sleep for stability
-from    threading                   import  Thread          # Used to thread processes
-from    Queue                       import  Queue           # Used to queue input/output
+from    threading                   import  Event, Lock     # Tracking restart flag, tracker lock
+from    tofReader                   import  ToFReader, FrameParser
+from    serialLink                  import  SerialLink      # Auto-reconnecting serial link
+from    pipeline                    import  Pipeline        # Persistent worker pipeline
 from    timeStamp                   import  fullStamp       # Show date/time on console output
+from    fusion                      import  ToFFusion       # Time-aligned ToF/frame fusion
+from    tofFilter                   import  DistanceFilter  # Median/EMA/outlier ToF filter
+from    calibration                 import  load_profile, PROFILE_PATH, IRIS_MM
+from    calibration                 import  RadiusTable     # Pupil radius --> distance lookup
+from    lens                        import  load_lens, Undistorter, LENS_PATH
+from    aperture                    import  locate_aperture # Aperture crop + mask
 from    usbProtocol                 import  createUSBPort   # Create USB Port
+from    usbProtocol                 import  CommandChannel, DC1
 
 # ************************************************************************
 # =====================> CONSTRUCT ARGUMENT PARSER <=====================
@@ -56,6 +86,26 @@ ap.add_argument("-a", "--alpha", type=float, default=0.85,
                 help="set alpha level (smaller = more transparent).\ndefault=0.85")
 ap.add_argument("-d", "--debug", action='store_true',
                 help="invoke flag to enable debugging")
+ap.add_argument("-s", "--source", default="picamera",
+                help="frame source: picamera, image directory, video file or recorded .npz session")
+ap.add_argument("-f", "--fps", type=float, default=None,
+                help="replay rate for non-camera sources (default: as fast as possible), PiCam framerate (default: 32)")
+ap.add_argument("-t", "--track", type=int, default=0,
+                help="search only around the last pupil; full-frame search after TRACK misses (0 = off)")
+ap.add_argument("-n", "--detect-every", type=int, default=1,
+                help="run detection on 1 of every N frames and track the pupil in between. default=1")
+ap.add_argument("-u", "--usb", default="auto",
+                help="ToF sensor port: auto (probe /dev/ttyUSB*, /dev/ttyACM*), /dev/ttyUSB<N> number, device path or socket:// URL. default=auto")
+ap.add_argument("-k", "--calibration", default=PROFILE_PATH,
+                help="camera distance calibration profile (calibrate.py --batch). default=" + PROFILE_PATH)
+ap.add_argument("-w", "--target-width", type=float, default=IRIS_MM,
+                help="diameter (mm) of the circle ranged with the calibration. default=%.1f (average iris)" % IRIS_MM)
+ap.add_argument("-l", "--lens", default=LENS_PATH,
+                help="lens profile to undistort frames with (lensCalibrate.py). default=" + LENS_PATH)
+ap.add_argument("-r", "--redetect", action='store_true',
+                help="locate the optical aperture again instead of using the cached one")
+ap.add_argument("-g", "--gate", action='store_true',
+                help="skip preprocessing/detection and show raw frames while the ToF sensor is out of range")
 
 args = vars( ap.parse_args() )
 
@@ -76,24 +126,28 @@ def control( event, x, y, flags, param ):
             fps.stop()
             print( fullStamp() + " [INFO] Elapsed time: {:.2f}".format(fps.elapsed()) )
             print( fullStamp() + " [INFO] Approx. FPS : {:.2f}".format(fps.fps()) )
+            print( fullStamp() + " [INFO] ToF skew ms : {}".format(fusion.skew_stats()) )
+            print( fullStamp() + " [INFO] Camera gated: {} frames".format(fusion.fallbacks) )
+            print( fullStamp() + " [INFO] ToF link    : {}".format(link.health()) )
+            print( fullStamp() + " [INFO] ToF commands: {} sent, {} ACK, {} NAK, {} timed out".format(
+                   commands.sent, commands.acks, commands.naks, commands.timeouts) )
+            print( fullStamp() + " [INFO] Dropped     : {}".format(pipe.dropped()) )
 
         # Do some shutdown clean up
         try:
-            if ( t_scan4circles.isAlive() ):
-                t_scan4circles.join(5.0)    # Terminate circle scanning thread
+            if ( pipe.stop(5.0) ):          # Terminate procFrame/scan4circles workers
                 if args["debug"]:           # If debug flag is invoked, display message
-                    print( fullStamp() + " scan4circles: Terminated" )
-                
-            if ( t_procFrame.isAlive() ):
-                t_procFrame.join(5.0)       # Terminate image processing thread
+                    print( fullStamp() + " pipeline: Terminated" )
+
+            if ( tof.stop(5.0) ):           # Terminate serial port reader thread
                 if args["debug"]:           # If debug flag is invoked, display message
-                    print( fullStamp() + " procFrame: Terminated" )
+                    print( fullStamp() + " ToFReader: Terminated" )
+
+            commands.stop(5.0)              # Fail any pending sensor commands
 
-            ToF.close()                     # Close port
-            if ( t_getDist.isAlive() ):
-                t_getDist.join(5.0)         # Terminate serial port pooling thread
+            if ( link.stop(5.0) ):          # Stop reconnecting, close port
                 if args["debug"]:           # If debug flag is invoked, display message
-                    print( fullStamp() + " getDist: Terminated" )
+                    print( fullStamp() + " SerialLink: Terminated" )
 
         except Exception as e:
             print( "Caught Error: %s" %str( type(e) ) )
@@ -107,6 +161,11 @@ def control( event, x, y, flags, param ):
     elif event == cv2.EVENT_LBUTTONDOWN:
         normalDisplay=not( normalDisplay )
 
+    # Middle button reboots the ToF sensor (never blocks the feed,
+    # the link reconnects once the sensor goes quiet)
+    elif event == cv2.EVENT_MBUTTONDOWN:
+        commands.send( DC1, callback=rebooted )
+
 
 # ****************************************************
 # Define a placeholder function for trackbar. This is
@@ -116,10 +175,62 @@ def placeholder( x ):
     pass
 
 
+# ****************************************************
+# Open the ToF sensor and start streaming
+# (called by the SerialLink on every (re)connect)
+# ****************************************************
+def connectToF():
+
+    ToF = createUSBPort( deviceName, port, baudRate, 3 )     # Returned open, device identified
+    ToF.timeout = 1.0
+    ToF.write('2')
+    inChar = ''
+    while inChar is not 'y':
+        raw = ToF.read(size=1)
+        if not raw:
+            ToF.close()
+            raise IOError( "no reply to start command" )
+        inChar = (raw.strip('\0')).strip('\n')
+        # If debug flag is invoked
+        if args["debug"]:
+            print( inChar )
+    print( fullStamp() + " Distance Readings Initiated" )
+
+    return( ToF )
+
+
+# ****************************************************
+# Report the outcome of a ToF reboot request
+# (runs on the ToF reader/command thread)
+# ****************************************************
+def rebooted( cmd ):
+
+    print( fullStamp() + " ToF reboot #{}: {}".format( cmd.seq, "ACK" if cmd.acked() else "no reply" ) )
+
+
 # ****************************************************
 # Define function to apply required filters to image
+# (pipeline stage: (slot, gray, in_range) --> (slot, processed, detect, restart, in_range))
 # ****************************************************
-def procFrame(bgr2gray, Q_procFrame):
+def procFrame( packet ):
+
+    slot, bgr2gray, in_range = packet
+
+    # Decide here, on the frames that actually reach the detectors,
+    # whether this one runs them (from scratch after gating)
+    restart = rescan.is_set()
+    if restart:
+        rescan.clear()
+    with pupil_lock:
+        locked = pupil.locked() and not restart
+    detect = scheduler.due( locked )
+
+    # Nothing to detect on this frame, pass it straight through
+    if not detect:
+        return( slot, bgr2gray, detect, restart, in_range )
+
+    # Flatten the vignette outside the aperture so nothing is found there
+    aperture.fill( bgr2gray )
 
     # Dissolve noise while maintaining edge sharpness 
     bgr2gray = cv2.bilateralFilter( bgr2gray, 5, 17, 17 )
@@ -131,65 +242,85 @@ def procFrame(bgr2gray, Q_procFrame):
     kernel = cv2.getStructuringElement( cv2.MORPH_RECT, ( 10, 10 ) )
     bgr2gray = cv2.erode( cv2.dilate( thresholded, kernel, iterations=1 ), kernel, iterations=1 )
 
-    # Place processed image in queue for retrieval
-    Q_procFrame.put(bgr2gray)
+    # Hand processed image to the next stage
+    return( slot, bgr2gray, detect, restart, in_range )
 
 # ******************************************************
-# Define a function to get distance from ToF sensor
+# Define a function to run HoughCircles on an image (or ROI)
+# and return the circles found as a list of (x, y, r)
 # ******************************************************
-def getDist():
+def houghCircles( img ):
 
-    # No need to reevaluate in the main function at every iteration
-    global ToF_Dist
+    circles = cv2.HoughCircles( img, cv2.HOUGH_GRADIENT, 34, 396,
+                                316, 236, 7, 14 )
 
-    # Listen to serial port as long as port is open
-    while ( ToF.is_open ):
-
-        # Do the reading iff there is something available at serial port
-        if ToF.in_waiting > 0:
-            ToF_Dist = int( (ToF.read(size=1).strip('\0')).strip('\n') )
-            # If debug flag is invoked
-            if args["debug"]:
-                print( ToF_Dist )
-        else:
-            pass
+    if circles is None:
+        return( [] )
+    return( numpy.round( circles[0,:] ).astype( "int" ).tolist() )
 
 
 # ******************************************************
 # Define a function to scan for circles from camera feed
+# (pipeline stage: (slot, processed, detect, restart, in_range) --> (output, processed))
 # ******************************************************
-def scan4circles( bgr2gray, overlay, overlayImg, frame, Q_scan4circles ):
+def scan4circles( packet ):
+    global processed
+
+    slot, bgr2gray, detect, restart, in_range = packet
+    frame = slot.frame
+    output = frame
 
     # Error handling in case a non-allowable integer is chosen (1)
     try:
-        # Scan for circles
-        circles = cv2.HoughCircles( bgr2gray, cv2.HOUGH_GRADIENT, 34, 396,
-                                    316, 236, 7, 14 )
-
-        # If circles are found draw them
-        if circles is not None:
-            circles = numpy.round( circles[0,:] ).astype( "int" )
-            for ( x, y, r ) in circles:
-
-                # Resize watermark image
-                resized = cv2.resize( overlayImg, ( 2*r, 2*r ),
-                                      interpolation = cv2.INTER_AREA )
-
-                # Retrieve overlay location
-                y1 = y-r
-                y2 = y+r
-                x1 = x-r
-                x2 = x+r
-
-            # If within scan distance display found circles
-            if ToF_Dist == 1:
+        # First frame back in range after gating: the pupil may be
+        # anywhere by now, so restart the search from scratch
+        if restart:
+            tracker.reset()
+            with pupil_lock:
+                pupil.reset()
+
+        # Scan for circles (around the last pupil when tracking)
+        found = None
+        if detect:
+            circles = tracker.detect( bgr2gray, houghCircles )
+            if len( circles ) > 0:
+                found = circles[-1]
+
+        # Smooth/gate the detection, or predict the pupil's position
+        # on frames where detection was skipped or failed
+        with pupil_lock:
+            pupil_pos = pupil.step( found )
+            coasting  = pupil.coasting
+
+        # Lock (or widen) the search window
+        if detect and not coasting:
+            tracker.confirm( pupil_pos )
+
+            # Camera-only distance (used by the gate while the ToF is silent)
+            if ranging is not None:
+                fusion.add_estimate( slot.stamp, ranging.distance( pupil_pos[2] ) )
+        elif detect:
+            tracker.miss()
+
+        # If a pupil is known draw it
+        if pupil_pos is not None:
+            ( x, y, r ) = pupil_pos
+
+            # Fetch pre-resized watermark image
+            resized = overlays.get( r )
+
+            # Retrieve overlay location
+            y1 = y-r
+            y2 = y+r
+            x1 = x-r
+            x2 = x+r
+
+            # If within scan distance (at this frame's capture time) display found circles
+            if in_range:
                 # Check whether overlay location is within window resolution
                 if x1>0 and x1<w and x2>0 and x2<w and y1>0 and y1<h and y2>0 and y2<h:
-                    # Place overlay image inside circle
-                    overlay[ y1:y2, x1:x2 ] = resized
-
-                    # Join overlay with live feed and apply specified transparency level
-                    output = cv2.addWeighted( overlay, args["alpha"], frame, 1.0, 0 )
+                    # Blend overlay image into the circle's bounding box (in place)
+                    output = composite( frame, resized, x1, y1 )
                     
                     # If debug flag is invoked
                     if args["debug"]:
@@ -200,17 +331,19 @@ def scan4circles( bgr2gray, overlay, overlayImg, frame, Q_scan4circles ):
                 else:
                     output = frame
 
-                # Place output in queue for retrieval by main thread
-                if Q_scan4circles.full() is False:
-                    Q_scan4circles.put( output )
+        # Hand output to the main thread for display (frames that
+        # skipped detection show the last processed image)
+        if detect or processed is None:
+            processed = bgr2gray
+        return( output, processed )
 
     # Error handling in case a non-allowable integer is chosen (2)
     except Exception as instance:
         print( fullStamp() + " Exception or Error Caught" )
         print( fullStamp() + " Error Type %s" %str(type(instance)) )
 
-        # Exit function and re-loop
-        return()
+        # Drop this frame and re-loop
+        return( None )
 
 # ************************************************************************
 # ===========================> SETUP PROGRAM <===========================
@@ -230,41 +363,89 @@ G = cv2.bitwise_and( G, G, mask=A )
 R = cv2.bitwise_and( R, R, mask=A )
 overlayImg = cv2.merge( [B, G, R, A] )
 
+# Pre-render the overlay (premultiplied by the transparency level)
+# for every radius HoughCircles may report
+overlays = OverlayCache( transform=lambda img: premultiply( img, args["alpha"] ) )
+overlays.load( args["overlay"] or "Overlay.png", overlayImg, 7, 14 )
+
 # Setup camera
-stream = PiVideoStream( resolution=(384, 288) ).start()
+stream = open_source( args["source"], resolution=(384, 288), fps=args["fps"] ).start()
 normalDisplay = True
 sleep( 1.0 )
 
+# Crop to the optical aperture (detected once per camera, then cached)
+aperture = locate_aperture( stream, args["source"], redetect=args["redetect"], debug=args["debug"] )
+print( fullStamp() + " [INFO] {}".format(aperture) )
+
 # Setup window and mouseCallback event
 cv2.namedWindow( ver, cv2.WND_PROP_FULLSCREEN )
 cv2.setWindowProperty( ver, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN )
 cv2.setMouseCallback( ver, control )
 
-# Initialize ToF sensor
-deviceName, port, baudRate = "VL6180", 0, 115200
-ToF = createUSBPort( deviceName, port, baudRate, 3 )
-if ToF.is_open == False:
-    ToF.open()
-    sleep( 0.5 )
-    inChar = (ToF.read(size=1).strip('\0')).strip('\n')
-    ToF.write('2')
-    while inChar is not 'y':
-        inChar = (ToF.read(size=1).strip('\0')).strip('\n')
-        # If debug flag is invoked
-        if args["debug"]:
-            print( inChar )
-    print( fullStamp() + " Distance Readings Initiated" )
-
-ToF_Dist = 0    # Initialize to OFF
-
-# Create a queue for retrieving data from thread
-Q_procFrame     = Queue( maxsize=0 )
-Q_scan4circles  = Queue( maxsize=0 )
-
-# Start listening to serial port
-t_getDist = Thread( target=getDist, args=() )
-t_getDist.daemon = True
-t_getDist.start()
+# Load the camera distance calibration (fitted offline, never recalibrated here)
+calibration = load_profile( args["calibration"] )
+if calibration is None:
+    print( fullStamp() + " [INFO] No calibration profile at " + args["calibration"] )
+elif args["debug"]:
+    print( fullStamp() + " [INFO] Calibration: {}".format(calibration) )
+
+# Pupil radius --> distance for every radius the trackbars allow (radii are
+# measured on frames cropped from the full 384x288 capture)
+ranging = None
+if calibration is not None:
+    ranging = RadiusTable( calibration, max_radius=250, size=aperture.size,
+                           target_mm=args["target_width"] )
+
+# Undistortion maps for the cropped frame, built once (one remap per frame)
+lens = load_lens( args["lens"] )
+undistort = None
+if lens is None:
+    print( fullStamp() + " [INFO] No lens profile at " + args["lens"] + ", frames not undistorted" )
+else:
+    undistort = Undistorter( lens, size=aperture.size, crop=aperture.crop )
+    if args["debug"]:
+        print( fullStamp() + " [INFO] Lens: {}".format(lens) )
+
+# Initialize ToF sensor: the link connects (and reconnects after a
+# dropped cable) in the background, the frame loop never waits on it
+deviceName, port, baudRate = "VL6180", args["usb"], 115200
+link = SerialLink( connectToF, name=deviceName, debug=args["debug"] ).start()
+
+# Asynchronous sensor commands (replies are picked out of the ToF stream)
+commands = CommandChannel( link=link ).start()
+
+# Create persistent worker pipeline (capture --> procFrame --> scan4circles)
+# Stale frames are dropped rather than queued so latency/memory stay flat
+pipe = Pipeline( maxsize=1, latest=True, debug=args["debug"] )
+pipe.add_stage( "procFrame"   , procFrame, keep=lambda packet: packet[2] )     # Never drop detect frames
+pipe.add_stage( "scan4circles", scan4circles )
+pipe.start()
+
+# Restrict detection to a window around the last pupil (if enabled)
+tracker = ROITracker( max_misses=args["track"] )
+
+# Smooth/predict the pupil and decide which frames run the detectors
+pupil     = PupilTracker( max_coast=max( 5, 2*args["detect_every"] ) )
+scheduler = DetectionScheduler( every=args["detect_every"] )    # Only used by procFrame
+pupil_lock = Lock()                                             # pupil: procFrame reads, scan4circles writes
+processed  = None                                               # Last processed image (AI view)
+
+# Set when detection resumes after the ToF gate skipped frames (--gate)
+rescan = Event()
+gated  = False
+
+# Preallocated frame/overlay buffers, sized on the first captured frame
+# (must hold more frames than can be in flight in the pipeline)
+ring = None
+
+# Start listening to serial port (blocks in select(), no busy-wait;
+# I/O errors or 2s of silence hand the port back to the link)
+# Samples are filtered (outliers, median of 5, EMA) and time-aligned with frames:
+# overlay turns on at <= 15mm, off above 18mm
+fusion = ToFFusion( enter=15, exit=18, smooth=DistanceFilter( window=5, alpha=0.5, reject=3.0 ) )
+tof = ToFReader( link=link, parse=FrameParser( threshold=15, listener=fusion.add_samples,
+                                               replies=commands.feed ),
+                 initial=0, debug=args["debug"], idle=2.0 ).start()
 
 # If debug flag is invoked
 if args["debug"]:
@@ -280,35 +461,63 @@ if args["debug"]:
 # Infinite loop
 while True:
     
-    # Get image from stream
-    frame = stream.read()[36:252, 48:336]
-    output = frame
+    # Get image from stream, stamped by the source when it was grabbed
+    capture, stamp = stream.read_stamped()
+
+    # Replay source exhausted: shut down as on a right-click
+    if capture is None:
+        control( cv2.EVENT_RBUTTONDOWN, 0, 0, 0, None )
 
-    # Add a 4th dimension (Alpha) to the captured frame
+    # Crop to the aperture, removing lens distortion on the way
+    # (precomputed fixed-point maps, remapped from the full capture)
+    if undistort is not None:
+        frame = undistort.apply( capture )
+    else:
+        frame = aperture.cut( capture )
+
+    # Copy into a preallocated BGRA slot
     (h, w) = frame.shape[:2]
-    frame = numpy.dstack( [frame, numpy.ones( ( h, w ), dtype="uint8" ) * 255] )
+    if ring is None:
+        ring = FrameRing( ( h, w ), size=8, overlay=False )
+    slot = ring.acquire( frame, stamp )
+    frame = slot.frame
+
+    # Within scan distance at this frame's capture time (hysteresis-gated)
+    in_range, mm, skew = fusion.gate( stamp )
+
+    # Out of range: no overlay will be drawn, so skip every CV stage
+    # and show the raw frame at full camera rate. Only the ToF can say
+    # so: the camera estimate needs detection running to stay current
+    if args["gate"] and not in_range and ( ranging is None or fusion.source == "tof" ):
+        gated = True
+        pipe.get()                          # Discard results still in flight
+
+        # If debug flag is invoked
+        if args["debug"]:
+           fps.update()
+
+        cv2.imshow(ver, frame)
+        key = cv2.waitKey(1) & 0xFF
+        continue
+
+    # Back in range: procFrame restarts tracking and detects on the
+    # next frame it takes
+    if gated:
+        gated = False
+        rescan.set()
 
-    # Create an overlay layer
-    overlay = numpy.zeros( ( h, w, 4 ), "uint8" )
-    
     # Convert into grayscale because HoughCircle only accepts grayscale images
     bgr2gray = cv2.cvtColor( frame, cv2.COLOR_BGR2GRAY )
 
-    # Start thread to process image and apply required filters to detect circles
-    t_procFrame = Thread( target=procFrame, args=( bgr2gray, Q_procFrame ) )
-    t_procFrame.start()
+    # Feed the pipeline (never blocks, replaces any stale frame)
+    pipe.put( ( slot, bgr2gray, in_range ) )
 
-    # Check if queue has something available for retrieval
-    if Q_procFrame.qsize() > 0:
-        bgr2gray = Q_procFrame.get()
-    
-    # Start thread to scan for circles
-    t_scan4circles = Thread( target=scan4circles, args=( bgr2gray, overlay, overlayImg, frame, Q_scan4circles ) )
-    t_scan4circles.start()
-
-    # Check if queue has something available for retrieval
-    if Q_scan4circles.qsize() > 0:
-        output = Q_scan4circles.get()
+    # Check if the pipeline has something available for display
+    result = pipe.get()
+    if result is None:
+        key = cv2.waitKey(1) & 0xFF
+        continue
+    output, bgr2gray = result
 
     # If debug flag is invoked
     if args["debug"]:
@@ -10,6 +10,10 @@
 *   -o/--overlay: Specify overlay file
 *   -a/--alpha  : Specify transperancy level (0.0 - 1.0)
 *   -d/--debug  : Enable debugging
+*   -s/--source : picamera (default), image directory, video or .npz session
+*   -f/--fps    : Replay rate for non-camera sources (default: unthrottled),
+*                 PiCam framerate for picamera (default: 32)
+*   -r/--redetect: Locate the optical aperture again (ignore the cache)
 *
 * VERSION: 1.1.1a
 *   - ADDED   : Overlay an image/pathology
@@ -42,7 +46,9 @@ print __doc__
 import  cv2                                                                     # OpenCV, the meat & potatoes
 import  numpy                                                       as  np      # Image manipulation
 from    timeStamp                       import  fullStamp           as  FS      # Show date/time on console output
-from    imutils.video.pivideostream     import  PiVideoStream                   # Import threaded PiCam module
+from    frameSource                     import  open_source                     # PiCam or replay frame source
+from    aperture                        import  locate_aperture                 # Aperture crop + mask
+from    detectors                       import  blob_detector                   # Cached SimpleBlobDetectors
 from    imutils.video                   import  FPS                             # Benchmark FPS
 from    argparse                        import  ArgumentParser                  # Pass flags/parameters to script
 from    LEDRing                         import  *                               # Let there be light
@@ -70,6 +76,15 @@ ap.add_argument( "-a", "--alpha", type=float, default=0.85,
 ap.add_argument( "-d", "--debug", action='store_true',
                  help="Enable debugging" )
 
+ap.add_argument( "-s", "--source", default="picamera",
+                 help="Frame source: picamera, image directory, video or .npz session" )
+
+ap.add_argument( "-f", "--fps", type=float, default=None,
+                 help="Replay rate for non-camera sources (Default=as fast as possible),\nPiCam framerate (Default=32)" )
+
+ap.add_argument( "-r", "--redetect", action='store_true',
+                 help="Locate the optical aperture again instead of using the cached one" )
+
 args = vars( ap.parse_args() )
 
 ##args["debug"] = True
@@ -145,40 +160,10 @@ def setup_detector():
         - NONE
 
     OUTPUT:-
-        - parameters: BLOB detector's parameters
-        - detector  : BLOB detector
+        - detector  : BLOB detector (shared, see detectors.DetectorCache)
     '''
-    
-    parameters = cv2.SimpleBlobDetector_Params()                                # Parameters
-	 
-    # Filter by Area.
-    parameters.filterByArea = True                                              # ...
-    parameters.minArea = np.pi * 15**2                                          # ...
-    parameters.maxArea = np.pi * 45**2                                          # ...
-
-    # Filter by color
-    parameters.filterByColor = True                                             # ...
-    parameters.blobColor = 0                                                    # ...
-
-    # Filter by Circularity
-    parameters.filterByCircularity = True                                       # ...
-    parameters.minCircularity = 0.42                                            # ...
-     
-    # Filter by Convexity
-    parameters.filterByConvexity = True                                         # ...
-    parameters.minConvexity = 0.43                                              # ...
-             
-    # Filter by Inertia
-    parameters.filterByInertia = True                                           # ...
-    parameters.minInertiaRatio = 0.41                                           # ...
-
-    # Distance Between Blobs
-    parameters.minDistBetweenBlobs = 2000                                       # ...
-             
-    # Create a detector with the parameters
-    detector = cv2.SimpleBlobDetector_create( parameters )                      # Create detector
 
-    return( parameters, detector )
+    return( blob_detector( 15, 45, 0.42, 0.43, 0.41, min_dist=2000 ) )       # r_min, r_max, circ., conv., inertia
     
 # ------------------------------------------------------------------------
 
@@ -209,6 +194,7 @@ def procFrame( image ):
         
         # Dissolve noise while maintaining edge sharpness
         processed = cv2.inRange( image, lower_bound, upper_bound )
+        processed = aperture.clear( processed )                                 # Zero everything outside aperture
         processed = cv2.bilateralFilter( processed, 5, 17, 17 )
         processed = cv2.GaussianBlur( processed, (5, 5), GaussianBlur )
         
@@ -520,8 +506,12 @@ counter     = 0
 overlayImg  = prepare_overlay( args["overlay"] )                                # Prepare and process overlay
 
 # Setup camera (x,y)
-stream = PiVideoStream( resolution=(384, 288) ).start()                         # Start PiCam
+stream = open_source( args["source"], resolution=(384, 288),                    # Start PiCam
+                      fps=args["fps"] ).start()                                 # (or replay source)
 sleep( 0.25 )                                                                   # Sleep for stability
+aperture = locate_aperture( stream, args["source"],                             # Crop to the optical aperture
+                            redetect=args["redetect"] )                         # (detected once, then cached)
+print( "{} [INFO] {}".format(FS(), aperture) )                                  # ...
 realDisplay = True                                                              # Start with a normal display
 colorWipe( strip, Color(255, 255, 255, 255), 0 )                                # Turn ON LED ring
 
@@ -529,8 +519,8 @@ colorWipe( strip, Color(255, 255, 255, 255), 0 )
 setup_windows()                                                                 # Create window and trackbars
 
 # Setup BlobDetector
-global detector, params
-params, detector = setup_detector()                                             # Create BLOB detector + define params
+global detector
+detector = setup_detector()                                                     # Create BLOB detector
 
 
 ######
@@ -540,8 +530,9 @@ global ROI, startTime
 startTime = time()
 timeout = 1.00
 dx, dy, dROI = 35, 35, 65
-ROI_0 = [ (144-dROI, 108-dROI), (144+dROI, 108+dROI) ]
-ROI   = [ (144-dROI, 108-dROI), (144+dROI, 108+dROI) ]
+cx, cy = aperture.center                                                        # Centred on the aperture
+ROI_0 = [ (cx-dROI, cy-dROI), (cx+dROI, cy+dROI) ]
+ROI   = [ (cx-dROI, cy-dROI), (cx+dROI, cy+dROI) ]
 
 # ************************************************************************
 # =========================> MAKE IT ALL HAPPEN <=========================
@@ -565,7 +556,10 @@ upper_bound = np.array( [180, 255,  30], dtype = np.uint8 )
 
 while( True ):
     # Capture frame
-    frame = stream.read()[36:252, 48:336]                                       # Capture frame and crop it
+    capture = stream.read()                                                     # Capture frame
+    if( capture is None ):                                                      # Replay source exhausted:
+        control( cv2.EVENT_RBUTTONDOWN, 0, 0, 0, None )                         # shut down as on right-click
+    frame = aperture.cut( capture )                                             # Crop to the aperture
     image = frame                                                               # Save a copy of captured frame
 
     # Add a 4th dimension (Alpha) to the captured frame
@@ -0,0 +1,290 @@
+'''
+* aperture.py
+*
+* Locate the circular optical aperture in the camera view.
+*
+* The live feeds used to cut every frame with the magic slice
+* [36:252, 48:336], tuned by hand for one scope at 384x288. At startup
+* locate_aperture() now averages a few frames, thresholds away the black
+* vignette and fits a circle to the edge of the lit area (the parts of
+* the edge clipped by the frame border are left out of the fit). The
+* resulting Aperture gives:
+*   - crop      : (y1, y2, x1, x2) bounding box of the circle, clipped
+*                 to the frame
+*   - center    : Circle centre in cropped-frame co-ordinates
+*   - mask      : Binary (255 inside) mask of the cropped frame
+* and is cached per device (source + resolution), so later runs start
+* straight away. If no aperture is found the old crop is used, scaled
+* to the capture resolution.
+*
+* USAGE:
+*   aperture = locate_aperture( stream, "picamera" )   # Cached after the first run
+*   frame    = aperture.cut( stream.read() )            # Per frame
+*   aperture.fill( gray )                               # Flatten the vignette (in place)
+*   binary   = aperture.clear( binary )                 # Zero it (thresholded images)
+'''
+
+import  os, json
+import  numpy                                               as  np
+import  cv2
+from    time                        import  sleep
+from    timeStamp                   import  fullStamp       # Show date/time on console output
+
+APERTURE_CACHE  = os.path.join( os.path.expanduser("~"), ".ophthalmoscope", "aperture.json" )
+
+LEGACY_SIZE     = ( 384, 288 )                              # Capture size the old crop was tuned at
+LEGACY_CROP     = ( 36, 252, 48, 336 )                      # (y1, y2, x1, x2)
+
+# ************************************************************************
+# ==============================> APERTURE <=============================
+# ************************************************************************
+
+class Aperture( object ):
+    '''
+    Aperture circle of one camera and the crop/mask derived from it.
+    '''
+
+    def __init__( self, size, circle=None, crop=None, margin=2 ):
+        '''
+        INPUTS:-
+            - size      : (w, h) of the full capture
+            - circle    : (cx, cy, r) in capture co-ordinates (None = not
+                          found: no mask, crop below)
+            - crop      : (y1, y2, x1, x2) used without a circle (None =
+                          LEGACY_CROP scaled to size)
+            - margin    : Pixels the mask stays inside the fitted edge
+        '''
+
+        w, h = self.size = tuple( int(n) for n in size )
+        self.circle = tuple( float(n) for n in circle ) if circle is not None else None
+        self.margin = margin
+
+        if( self.circle is not None ):
+            cx, cy, r = self.circle
+            self.crop = ( max( 0, int(cy - r) ), min( h, int(np.ceil(cy + r)) ),
+                          max( 0, int(cx - r) ), min( w, int(np.ceil(cx + r)) ) )
+        elif( crop is not None ):
+            self.crop = tuple( crop )
+        else:
+            sx, sy = float( w ) / LEGACY_SIZE[0], float( h ) / LEGACY_SIZE[1]
+            y1, y2, x1, x2 = LEGACY_CROP
+            self.crop = ( int(y1*sy), int(y2*sy), int(x1*sx), int(x2*sx) )
+
+        y1, y2, x1, x2 = self.crop
+        self.shape = ( y2 - y1, x2 - x1 )
+
+        if( self.circle is not None ):
+            self.center = ( int( round(cx - x1) ), int( round(cy - y1) ) )
+            self.radius = int( r )
+            self.mask   = np.zeros( self.shape, dtype=np.uint8 )
+            cv2.circle( self.mask, self.center, max( 1, self.radius - margin ), 255, -1 )
+            self.outside = self.mask == 0
+        else:
+            self.center = ( self.shape[1] // 2, self.shape[0] // 2 )
+            self.radius = None
+            self.mask   = None
+            self.outside = None
+
+        self.origin = None                                  # "cached", "detected" or "default"
+
+    # --------------------------------------------------------------------
+
+    def cut( self, frame ):
+        '''
+        OUTPUT:-
+            - The aperture's bounding box out of a full capture (a view)
+        '''
+
+        y1, y2, x1, x2 = self.crop
+        return( frame[ y1:y2, x1:x2 ] )
+
+    # --------------------------------------------------------------------
+
+    def fill( self, img ):
+        '''
+        Overwrite the pixels outside the aperture (in place) with the mean
+        of the pixels inside, so the vignette's edge gives the thresholds
+        and detectors nothing to find.
+
+        INPUTS:-
+            - img       : Cropped frame (gray or BGR), self.shape
+        '''
+
+        if( self.mask is None ):
+            return( img )
+
+        mean = cv2.mean( img, mask=self.mask )
+        img[ self.outside ] = mean[0] if img.ndim == 2 else mean[:img.shape[2]]
+        return( img )
+
+    # --------------------------------------------------------------------
+
+    def clear( self, img ):
+        '''
+        Zero the pixels outside the aperture. For binary images (e.g.
+        cv2.inRange output), where fill() would paint a grey ring.
+
+        INPUTS:-
+            - img       : Cropped frame, self.shape
+
+        OUTPUT:-
+            - Masked copy (img itself if there is no mask)
+        '''
+
+        if( self.mask is None ):
+            return( img )
+
+        return( cv2.bitwise_and( img, img, mask=self.mask ) )
+
+    # --------------------------------------------------------------------
+
+    def to_dict( self ):
+        return( { "size"    : list( self.size ),
+                  "circle"  : list( self.circle ) if self.circle is not None else None,
+                  "crop"    : list( self.crop ) } )
+
+    # --------------------------------------------------------------------
+
+    def __repr__( self ):
+        if( self.circle is None ):
+            return( "Aperture(not found, crop {} at {}x{}, {})".format(
+                    self.crop, self.size[0], self.size[1], self.origin) )
+        return( "Aperture(centre {:.1f}, {:.1f} r {:.1f}, crop {} at {}x{}, {})".format(
+                self.circle[0], self.circle[1], self.circle[2], self.crop,
+                self.size[0], self.size[1], self.origin) )
+
+# ************************************************************************
+# =============================> DETECTION <=============================
+# ************************************************************************
+
+def detect_aperture( frames, threshold=20, min_radius=0.25, min_fill=0.85 ):
+    '''
+    Fit the aperture circle to a few frames.
+
+    INPUTS:-
+        - frames    : BGR (or gray) full captures, all the same size
+        - threshold : Gray level below which a pixel is vignette
+        - min_radius: Smallest plausible radius, fraction of min(w, h)
+        - min_fill  : Fraction of the circle (within the frame) that must
+                      be lit for the fit to be accepted
+
+    OUTPUT:-
+        - Aperture, or None if no aperture-like circle was found
+    '''
+
+    mean = None
+    for frame in frames:
+        gray = cv2.cvtColor( frame, cv2.COLOR_BGR2GRAY ) if frame.ndim == 3 else frame
+        if( mean is None ):
+            mean = np.zeros( gray.shape, dtype=np.float32 )
+        cv2.accumulate( gray, mean )
+    if( mean is None ):
+        return( None )
+
+    h, w = mean.shape
+    mean = ( mean / len(frames) ).astype( np.uint8 )
+    lit  = cv2.threshold( mean, threshold, 255, cv2.THRESH_BINARY )[1]
+    kernel = cv2.getStructuringElement( cv2.MORPH_ELLIPSE, (7, 7) )
+    lit  = cv2.morphologyEx( cv2.morphologyEx( lit, cv2.MORPH_OPEN, kernel ), cv2.MORPH_CLOSE, kernel )
+
+    contours = cv2.findContours( lit.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE )[-2]
+    if( not contours ):
+        return( None )
+    edge = max( contours, key=cv2.contourArea ).reshape( -1, 2 ).astype( np.float64 )
+
+    # Only the real edge of the aperture, not where the frame clips it
+    x, y = edge[:, 0], edge[:, 1]
+    keep = ( x > 1 ) & ( x < w - 2 ) & ( y > 1 ) & ( y < h - 2 )
+    if( keep.sum() < 20 ):
+        return( None )
+    x, y = x[keep], y[keep]
+
+    # Least-squares circle: x^2 + y^2 + D x + E y + F = 0
+    A = np.column_stack( (x, y, np.ones(len(x))) )
+    D, E, F = np.linalg.lstsq( A, -(x*x + y*y), rcond=None )[0]
+    cx, cy = -D/2, -E/2
+    r2 = cx*cx + cy*cy - F
+    if( r2 <= 0 or np.sqrt(r2) < min_radius*min(w, h) ):
+        return( None )
+
+    aperture = Aperture( (w, h), (cx, cy, np.sqrt(r2)) )
+    inside   = aperture.mask > 0
+    if( np.count_nonzero( aperture.cut(lit)[inside] ) < min_fill*np.count_nonzero( inside ) ):
+        return( None )
+
+    return( aperture )
+
+# ------------------------------------------------------------------------
+
+def locate_aperture( stream, device, cache=APERTURE_CACHE, frames=8, interval=0.05,
+                     redetect=False, debug=False ):
+    '''
+    Cached aperture of a device, detected from the stream if there is none.
+
+    INPUTS:-
+        - stream    : Started frame source (read() --> full capture,
+                      None until the camera warms up or once a replay
+                      source is exhausted)
+        - device    : Name of the camera (e.g. the --source argument),
+                      cached together with the capture resolution
+        - cache     : Cache file (None = do not cache)
+        - frames    : Frames averaged for the detection
+        - interval  : Seconds between those frames
+        - redetect  : Ignore the cached aperture
+
+    OUTPUT:-
+        - Aperture (the scaled legacy crop if none was found)
+    '''
+
+    frame = stream.read()
+    for i in range( 40 ):                                   # Camera warm-up: wait for a first frame
+        if( frame is not None ):
+            break
+        sleep( interval )
+        frame = stream.read()
+    if( frame is None ):
+        raise IOError( "No frames from {}".format(device) )
+
+    h, w  = frame.shape[:2]
+    key   = "{}@{}x{}".format( device, w, h )
+
+    entries = {}
+    if( cache is not None and os.path.exists( cache ) ):
+        try:
+            with open( cache, "r" ) as f:
+                entries = json.load( f )
+        except ValueError:                                  # Corrupt cache: detect again
+            entries = {}
+
+    entry = entries.get( key )
+    if( entry is not None and not redetect ):
+        aperture = Aperture( entry["size"], entry["circle"], entry["crop"] )
+        aperture.origin = "cached"
+        return( aperture )
+
+    captured = [ frame ]
+    while( len(captured) < frames ):
+        sleep( interval )
+        frame = stream.read()
+        if( frame is None ):                                # Replay ran out: use what we have
+            break
+        captured.append( frame )
+
+    aperture = detect_aperture( captured )
+    if( aperture is None ):
+        if( debug ):
+            print( fullStamp() + " [INFO] No aperture found, using the default crop" )
+        aperture = Aperture( (w, h) )
+        aperture.origin = "default"
+        return( aperture )
+
+    aperture.origin = "detected"
+    if( cache is not None ):
+        entries[ key ] = dict( aperture.to_dict(), created=fullStamp() )
+        folder = os.path.dirname( cache )
+        if( folder and not os.path.exists(folder) ):
+            os.makedirs( folder )
+        with open( cache, "w" ) as f:
+            json.dump( entries, f, indent=4, sort_keys=True )
+
+    return( aperture )
@@ -0,0 +1,183 @@
+'''
+* calibration.py
+*
+* Camera distance calibration profile, as written by BETA/calibrate.py
+* --batch (least-squares fit over the Images/Calibration set), so the
+* live feeds load the fit at startup instead of recalibrating.
+*
+* PROFILE (JSON):
+*   version     : PROFILE_VERSION
+*   image_size  : [width, height] the radii were measured at
+*   model       : {"type": "inverse", "a": a, "b": b}
+*                 distance_mm = a / radius_px + b
+*   known_width_mm : Diameter of the calibration marker
+*   focal_px    : a / known_width_mm
+*   rms_mm      : RMS residual of the fit
+*   samples     : Per-image distance, radius, fit and residual
+*
+* The fit is for the marker: a scales with the diameter of whatever is
+* ranged, so distances of a pupil or iris use a * target_mm /
+* known_width_mm (b, the optical offset, does not change).
+*
+* RadiusTable precomputes the model for every integer radius HoughCircles
+* can report, so the live feeds turn a pupil radius into a distance with
+* a single table lookup (camera-only ranging when the ToF sensor is out).
+*
+* USAGE:
+*   profile = load_profile()                # None if not calibrated yet
+*   mm      = profile.distance( r, size=(w, h), target_mm=IRIS_MM )
+*   table   = RadiusTable( profile, max_radius=250, size=aperture.size, target_mm=IRIS_MM )
+*   mm      = table.distance( r )           # Per frame: one lookup
+'''
+
+import  os, json
+import  numpy                                               as  np
+
+PROFILE_VERSION = 1
+PROFILE_PATH    = os.path.join( os.path.expanduser("~"), ".ophthalmoscope", "calibration.json" )
+MARKER_MM       = 2.0 * 25.4                                # calibrate.py KNOWN_WIDTH (2 inch), older profiles
+IRIS_MM         = 11.8                                      # Average human iris diameter
+
+# ************************************************************************
+# ========================> CALIBRATION PROFILE <========================
+# ************************************************************************
+
+class CalibrationProfile( object ):
+    '''
+    Radius (px) to distance (mm) model of one camera.
+    '''
+
+    def __init__( self, data, path=None ):
+        '''
+        INPUTS:-
+            - data      : Decoded profile (dict)
+            - path      : File it was loaded from (for messages)
+        '''
+
+        if( data.get( "version" ) != PROFILE_VERSION ):
+            raise ValueError( "{}: calibration profile version {}, expected {} (re-run calibrate.py --batch)".format(
+                              path, data.get("version"), PROFILE_VERSION) )
+
+        model = data[ "model" ]
+        if( model.get( "type" ) != "inverse" ):
+            raise ValueError( "{}: unknown calibration model {}".format(path, model.get("type")) )
+
+        self.path       = path
+        self.data       = data
+        self.a          = float( model["a"] )
+        self.b          = float( model["b"] )
+        self.image_size = tuple( data["image_size"] )
+        self.known_width = float( data.get( "known_width_mm", MARKER_MM ) )
+        self.focal      = data.get( "focal_px" )
+        self.rms        = data.get( "rms_mm" )
+
+    # --------------------------------------------------------------------
+
+    def scale( self, size ):
+        '''
+        OUTPUT:-
+            - Factor taking radii measured at size=(w, h) to the
+              calibration image size
+        '''
+
+        return( float( self.image_size[0] ) / size[0] if size else 1.0 )
+
+    # --------------------------------------------------------------------
+
+    def gain( self, target_mm=None ):
+        '''
+        OUTPUT:-
+            - The model's a for a target of diameter target_mm (None =
+              the calibration marker itself)
+        '''
+
+        return( self.a if target_mm is None else self.a * target_mm / self.known_width )
+
+    # --------------------------------------------------------------------
+
+    def distance( self, radius, size=None, target_mm=None ):
+        '''
+        INPUTS:-
+            - radius    : Apparent radius (px)
+            - size      : (w, h) of the image it was measured in
+                          (None = the calibration image size)
+            - target_mm : Physical diameter of what was measured (None =
+                          the calibration marker)
+
+        OUTPUT:-
+            - Distance (mm), None for a non-positive radius
+        '''
+
+        r = radius * self.scale( size )
+        if( r <= 0 ):
+            return( None )
+
+        return( self.gain( target_mm ) / r + self.b )
+
+    # --------------------------------------------------------------------
+
+    def __repr__( self ):
+        return( "CalibrationProfile(distance_mm = {:.1f}/r + {:.1f} at {}x{}, RMS {} mm)".format(
+                self.a, self.b, self.image_size[0], self.image_size[1], self.rms) )
+
+# ************************************************************************
+# ============================> RADIUS TABLE <===========================
+# ************************************************************************
+
+class RadiusTable( object ):
+    '''
+    Radius (px) to distance (mm) lookup table built from a profile.
+    '''
+
+    def __init__( self, profile, max_radius=250, size=None, target_mm=None ):
+        '''
+        INPUTS:-
+            - profile   : CalibrationProfile
+            - max_radius: Largest radius in the table (larger radii read
+                          as max_radius)
+            - size      : (w, h) of the full capture the radii are
+                          measured in (None = the calibration image size)
+            - target_mm : Physical diameter of the ranged circle (e.g.
+                          IRIS_MM; None = the calibration marker)
+        '''
+
+        radii       = np.arange( max_radius+1, dtype=np.float64 ) * profile.scale( size )
+        radii[0]    = np.inf                                # r = 0 has no distance
+        self.mm     = np.maximum( profile.gain( target_mm ) / radii + profile.b, 0.0 )
+        self.mm[0]  = np.nan
+        self.last   = max_radius
+
+    # --------------------------------------------------------------------
+
+    def distance( self, radius ):
+        '''
+        OUTPUT:-
+            - Distance (mm), None for a non-positive radius
+        '''
+
+        i = int( radius + 0.5 )
+        if( i <= 0 ):
+            return( None )
+
+        return( float( self.mm[ min(i, self.last) ] ) )
+
+# ------------------------------------------------------------------------
+
+def load_profile( path=PROFILE_PATH, required=False ):
+    '''
+    INPUTS:-
+        - path      : Profile file ("~" is expanded)
+        - required  : Raise IOError instead of returning None if missing
+
+    OUTPUT:-
+        - CalibrationProfile, or None if there is no profile yet
+    '''
+
+    path = os.path.expanduser( path )
+    if( not os.path.exists( path ) ):
+        if( required ):
+            raise IOError( "No calibration profile at {} (run calibrate.py --batch)".format(path) )
+        return( None )
+
+    with open( path, "r" ) as f:
+        return( CalibrationProfile( json.load(f), path ) )
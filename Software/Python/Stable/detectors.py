@@ -0,0 +1,158 @@
+'''
+* detectors.py
+*
+* Cache of constructed cv2.SimpleBlobDetector instances.
+*
+* cv2.SimpleBlobDetector_create() is not free, and dragging a trackbar
+* fires dozens of callbacks per second. DetectorCache keeps the most
+* recently used detectors keyed by their quantized parameters (area in
+* whole px^2, ratios to 0.01, minimum blob distance in whole px), so
+* switching back to a preset or sliding over values that were already
+* visited never rebuilds a detector. The module-level blob_detector()
+* shares one cache between the live feeds and the offline tools.
+*
+* USAGE:
+*   detector = blob_detector( 15, 40, 0.26, 0.43, 0.41 )    # r_min, r_max, ratios
+*   keypoints = detector.detect( gray )
+*   warm_up( [ (15, 40, 0.26, 0.43, 0.41), (15, 45, 0.42, 0.43, 0.41) ] )
+'''
+
+import  cv2
+import  numpy                                               as  np
+from    collections                 import  OrderedDict
+from    threading                   import  Lock
+
+# ************************************************************************
+# ==========================> DETECTOR CACHE <===========================
+# ************************************************************************
+
+class DetectorCache( object ):
+    '''
+    LRU cache of SimpleBlobDetectors keyed by quantized parameters.
+    '''
+
+    def __init__( self, maxsize=32 ):
+        '''
+        INPUTS:-
+            - maxsize   : Number of detectors kept alive
+        '''
+
+        self.maxsize    = maxsize
+        self.detectors  = OrderedDict()                     # key --> detector (LRU order)
+        self.lock       = Lock()
+        self.hits       = 0
+        self.misses     = 0                                 # Detectors constructed
+
+    # --------------------------------------------------------------------
+
+    def get( self, r_min, r_max, circularity, convexity, inertia, min_dist=20000 ):
+        '''
+        Return a detector for the given parameters, constructing it only
+        if an equivalent one is not cached.
+
+        INPUTS:-
+            - r_min, r_max  : Blob radius limits (px), filter by area
+            - circularity   : Minimum circularity   (0.0 - 1.0)
+            - convexity     : Minimum convexity     (0.0 - 1.0)
+            - inertia       : Minimum inertia ratio (0.0 - 1.0)
+            - min_dist      : Minimum distance between blobs (px)
+
+        OUTPUT:-
+            - detector      : cv2.SimpleBlobDetector
+        '''
+
+        key = blob_key( r_min, r_max, circularity, convexity, inertia, min_dist )
+
+        with self.lock:
+            detector = self.detectors.pop( key, None )
+            if( detector is not None ):
+                self.hits += 1
+                self.detectors[ key ] = detector            # Mark as most recently used
+                return( detector )
+
+        detector = cv2.SimpleBlobDetector_create( blob_params( *key ) )
+
+        with self.lock:
+            self.misses += 1
+            self.detectors[ key ] = detector
+            while( len(self.detectors) > self.maxsize ):
+                self.detectors.popitem( last=False )        # Evict least recently used
+
+        return( detector )
+
+    # --------------------------------------------------------------------
+
+    def clear( self ):
+        with self.lock:
+            self.detectors.clear()
+
+# ************************************************************************
+# ============================> HELPERS <================================
+# ************************************************************************
+
+def blob_key( r_min, r_max, circularity, convexity, inertia, min_dist=20000 ):
+    '''
+    Quantize detector parameters into a hashable cache key.
+
+    OUTPUT:-
+        - (min_area, max_area, circularity, convexity, inertia, min_dist)
+    '''
+
+    return( int( round(np.pi * r_min**2) ), int( round(np.pi * r_max**2) ),
+            round( circularity, 2 ), round( convexity, 2 ), round( inertia, 2 ),
+            int( round(min_dist) ) )
+
+# ------------------------------------------------------------------------
+
+def blob_params( min_area, max_area, circularity, convexity, inertia, min_dist ):
+    '''
+    Build the SimpleBlobDetector parameters used by the live feeds
+    (dark, round-ish blobs of a given area).
+    '''
+
+    parameters = cv2.SimpleBlobDetector_Params()
+
+    parameters.filterByArea         = True
+    parameters.minArea              = min_area
+    parameters.maxArea              = max_area
+
+    parameters.filterByColor        = True
+    parameters.blobColor            = 0
+
+    parameters.filterByCircularity  = True
+    parameters.minCircularity       = circularity
+
+    parameters.filterByConvexity    = True
+    parameters.minConvexity         = convexity
+
+    parameters.filterByInertia      = True
+    parameters.minInertiaRatio      = inertia
+
+    parameters.minDistBetweenBlobs  = min_dist
+
+    return( parameters )
+
+# ------------------------------------------------------------------------
+
+_cache = DetectorCache()                                    # Shared by every caller in the process
+
+def blob_detector( r_min, r_max, circularity, convexity, inertia, min_dist=20000 ):
+    '''
+    Fetch a detector from the shared cache (see DetectorCache.get()).
+    '''
+
+    return( _cache.get( r_min, r_max, circularity, convexity, inertia, min_dist ) )
+
+# ------------------------------------------------------------------------
+
+def warm_up( presets ):
+    '''
+    Construct the detectors for a list of presets ahead of time so the
+    first switch to any of them does not stall the frame loop.
+
+    INPUTS:-
+        - presets   : Iterable of blob_detector() argument tuples
+    '''
+
+    for preset in presets:
+        blob_detector( *preset )
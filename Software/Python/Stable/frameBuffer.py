@@ -0,0 +1,133 @@
+'''
+* frameBuffer.py
+*
+* Ring of preallocated BGRA frame + overlay buffers for the live feeds.
+*
+* The capture loop used to build a BGRA frame with numpy.dstack() and a
+* blank overlay layer with numpy.zeros() on every iteration. FrameRing
+* allocates those buffers once: the alpha plane is filled at startup,
+* capture copies the BGR pixels into the next slot in place, and only
+* the part of the overlay that was actually drawn on is cleared when a
+* slot is reused.
+*
+* USAGE:
+*   ring = FrameRing( (h, w), size=8 )
+*   slot = ring.acquire( frame )            # frame: (h, w, 3) BGR
+*   slot.paste( resized, x1, y1 )           # Draw into the overlay layer
+*   cv2.addWeighted( slot.overlay, alpha, slot.frame, 1.0, 0 )
+*
+* NOTE: A slot is handed out again after `size` acquisitions, so size
+*       must exceed the number of frames in flight in the pipeline.
+*
+* NOTE: Feeds that blend with overlay.composite() write straight into
+*       slot.frame and can skip the overlay layers with overlay=False.
+'''
+
+import  numpy                                               as  np
+
+# ************************************************************************
+# =============================> FRAME SLOT <============================
+# ************************************************************************
+
+class FrameSlot( object ):
+    '''
+    One preallocated BGRA frame and its overlay layer.
+    '''
+
+    def __init__( self, shape, overlay=True ):
+        h, w = shape
+
+        self.frame      = np.empty( (h, w, 4), dtype=np.uint8 )
+        self.frame[:, :, 3] = 255                           # Alpha plane, filled ONCE
+        self.overlay    = np.zeros( (h, w, 4), dtype=np.uint8 ) if overlay else None
+        self.dirty      = None                              # (y1, y2, x1, x2) drawn on overlay
+        self.stamp      = None                              # Capture time of the current frame
+
+    # --------------------------------------------------------------------
+
+    def load( self, bgr ):
+        '''
+        Copy a BGR frame into the slot in place and reset the overlay.
+        '''
+
+        np.copyto( self.frame[:, :, :3], bgr )
+        self.clear_overlay()
+
+    # --------------------------------------------------------------------
+
+    def paste( self, img, x, y ):
+        '''
+        Write img into the overlay layer with its top-left corner at
+        (x, y) and remember the region so it can be cleared on reuse.
+
+        INPUTS:-
+            - img       : (h, w, 4) overlay image
+            - x, y      : Top-left corner in frame co-ordinates
+        '''
+
+        h, w = img.shape[:2]
+        self.overlay[ y:y+h, x:x+w ] = img
+
+        if( self.dirty is None ):
+            self.dirty = ( y, y+h, x, x+w )
+        else:
+            y1, y2, x1, x2 = self.dirty
+            self.dirty = ( min(y1, y), max(y2, y+h), min(x1, x), max(x2, x+w) )
+
+    # --------------------------------------------------------------------
+
+    def clear_overlay( self ):
+        '''
+        Zero only the region of the overlay that was drawn on.
+        '''
+
+        if( self.dirty is not None ):
+            y1, y2, x1, x2 = self.dirty
+            self.overlay[ y1:y2, x1:x2 ] = 0
+            self.dirty = None
+
+# ************************************************************************
+# =============================> FRAME RING <============================
+# ************************************************************************
+
+class FrameRing( object ):
+    '''
+    Fixed-size ring of FrameSlots.
+    '''
+
+    def __init__( self, shape, size=8, overlay=True ):
+        '''
+        INPUTS:-
+            - shape     : (h, w) of the (cropped) frames
+            - size      : Number of slots (> frames in flight)
+            - overlay   : Also allocate an overlay layer per slot
+        '''
+
+        self.shape  = tuple( shape[:2] )
+        self.slots  = [ FrameSlot(self.shape, overlay) for i in range(size) ]
+        self.index  = 0
+
+    # --------------------------------------------------------------------
+
+    def acquire( self, bgr, stamp=None ):
+        '''
+        Load a captured BGR frame into the next slot.
+
+        INPUTS:-
+            - bgr       : (h, w, 3) BGR frame
+            - stamp     : Capture time (e.g. monotonicStamp()), kept on
+                          the slot for time-aligned sensor fusion
+
+        OUTPUT:-
+            - slot      : FrameSlot holding the BGRA frame + clean overlay
+        '''
+
+        if( bgr.shape[:2] != self.shape ):
+            raise ValueError( "Frame shape {} does not match ring shape {}".format(bgr.shape[:2], self.shape) )
+
+        slot = self.slots[ self.index ]
+        self.index = ( self.index + 1 ) % len( self.slots )
+
+        slot.load( bgr )
+        slot.stamp = stamp
+        return( slot )
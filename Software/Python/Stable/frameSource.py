@@ -0,0 +1,422 @@
+'''
+* frameSource.py
+*
+* Pluggable frame sources for the live feeds. Every source exposes the
+* same start()/read()/stop() interface as imutils' PiVideoStream so the
+* live-feed scripts can swap the camera for a replay backend without
+* touching the rest of the pipeline.
+*
+* BACKENDS:
+*   - PiCameraSource        : Threaded PiCam (default, Raspberry Pi only)
+*   - ImageDirectorySource  : Cycle through the images in a directory
+*                             (e.g. Images/Ophthalmoscope_images)
+*   - VideoFileSource       : Replay a video file
+*   - RecordedSessionSource : Replay a raw session recorded with
+*                             record_session() (.npz of frames+stamps)
+*
+* TIMESTAMPS:
+*   read_stamped() returns ( frame, stamp ), stamp being monotonicStamp()
+*   at the moment the frame was grabbed (by the PiCam capture thread, or
+*   when a replay frame comes due), not when the caller got round to
+*   reading it.
+*
+* RATE CONTROL:
+*   - fps=None/0 replays as fast as possible (deterministic profiling)
+*   - fps=N paces read() to N frames per second
+*   - For the PiCam, fps is the camera framerate (None/0 = 32)
+*   - Recorded sessions can also be paced by their own timestamps
+*     (realtime=True)
+*
+* USAGE:
+*   stream = open_source( "picamera", resolution=(384, 288) ).start()
+*   stream = open_source( "../../../Images/Ophthalmoscope_images", fps=30 ).start()
+*   frame  = stream.read()
+*   frame, stamp = stream.read_stamped()                # Capture time too
+*   stream.stop()
+'''
+
+import  os
+import  cv2
+import  numpy                                               as  np
+from    threading                   import  Thread
+from    time                        import  sleep, time
+from    timeStamp                   import  monotonicStamp  # Capture time of frames
+
+VALID_IMAGES    = [ ".png", ".jpg", ".jpeg", ".bmp" ]       # Allowable image extensions
+VALID_SESSIONS  = [ ".npz" ]                                # Allowable recorded session extensions
+
+# ************************************************************************
+# ===========================> BASE SOURCE <=============================
+# ************************************************************************
+
+class FrameSource( object ):
+    '''
+    Base class for replay backends. Subclasses override the _next_frame()
+    and _rewind() hooks, and optionally _frame_time() for timestamp-driven
+    pacing.
+    '''
+
+    def __init__( self, resolution=(384, 288), fps=None, loop=True ):
+        '''
+        INPUTS:-
+            - resolution: (width, height) every frame is resized to
+            - fps       : Target frame rate, None/0 for as-fast-as-possible
+            - loop      : Restart from the first frame at the end
+        '''
+
+        self.resolution = resolution
+        self.fps        = fps
+        self.loop       = loop
+        self.count      = 0                                 # Frames handed out so far
+        self.t0         = None                              # Time of first read()
+        self.stamp      = None                              # monotonicStamp() of the last frame
+        self.stopped    = False
+
+    # --------------------------------------------------------------------
+
+    def start( self ):
+        self.t0 = None
+        self.count = 0
+        return( self )
+
+    # --------------------------------------------------------------------
+
+    def stop( self ):
+        self.stopped = True
+
+    # --------------------------------------------------------------------
+
+    def read( self ):
+        '''
+        Return the next frame (BGR, resized to resolution), pacing the
+        caller according to the configured rate.
+
+        OUTPUT:-
+            - frame     : numpy array, or None once the source is exhausted
+        '''
+
+        if( self.stopped ):
+            return( None )
+
+        frame = self._next_frame()
+        if( frame is None and self.loop and self.count > 0 ):
+            self._rewind()
+            frame = self._next_frame()
+        if( frame is None ):
+            return( None )
+
+        self._pace()
+        self.stamp = monotonicStamp()                       # Frame is "captured" when due
+        self.count += 1
+
+        return( self._resize( frame ) )
+
+    # --------------------------------------------------------------------
+
+    def read_stamped( self ):
+        '''
+        OUTPUT:-
+            - ( frame, stamp ) as read() and the frame's capture time,
+              ( None, None ) once the source is exhausted
+        '''
+
+        frame = self.read()
+        return( ( frame, self.stamp if frame is not None else None ) )
+
+    # --------------------------------------------------------------------
+
+    def _pace( self ):
+        '''
+        Sleep until the current frame is due.
+        '''
+
+        now = time()
+        if( self.t0 is None ):
+            self.t0 = now
+            return
+
+        due = self._frame_time()
+        if( due is None ):
+            return
+
+        delay = ( self.t0 + due ) - now
+        if( delay > 0 ):
+            sleep( delay )
+
+    # --------------------------------------------------------------------
+
+    def _frame_time( self ):
+        '''
+        Offset (sec) from the first frame at which the current frame is
+        due, or None to read as fast as possible.
+        '''
+
+        if( not self.fps ):
+            return( None )
+
+        return( self.count / float(self.fps) )
+
+    # --------------------------------------------------------------------
+
+    def _resize( self, frame ):
+        if( self.resolution is None ):
+            return( frame )
+
+        if( frame.ndim == 3 and frame.shape[2] == 4 ):
+            frame = frame[:, :, :3]                         # Drop alpha, live feeds expect BGR
+
+        w, h = self.resolution
+        if( frame.shape[1] != w or frame.shape[0] != h ):
+            frame = cv2.resize( frame, (w, h), interpolation=cv2.INTER_AREA )
+
+        return( frame )
+
+    # --------------------------------------------------------------------
+
+    def _next_frame( self ):
+        '''
+        Hook: the next raw frame, or None at the end of the source. The
+        base class has no frames.
+        '''
+
+        return( None )
+
+    # --------------------------------------------------------------------
+
+    def _rewind( self ):
+        '''
+        Hook: go back to the first frame (only called with loop=True).
+        '''
+
+        pass
+
+# ************************************************************************
+# ==========================> PICAMERA SOURCE <==========================
+# ************************************************************************
+
+class PiCameraSource( object ):
+    '''
+    Threaded PiCam, as imutils' PiVideoStream, except that the capture
+    thread stamps every frame as it arrives.
+    '''
+
+    def __init__( self, resolution=(384, 288), fps=32 ):
+        from picamera.array import PiRGBArray               # Only importable on a Pi
+        from picamera       import PiCamera
+
+        self.camera     = PiCamera()
+        self.camera.resolution = resolution
+        self.camera.framerate  = fps
+        self.raw        = PiRGBArray( self.camera, size=resolution )
+        self.frames     = self.camera.capture_continuous( self.raw, format="bgr", use_video_port=True )
+
+        self.latest     = ( None, None )                    # ( frame, stamp ), swapped in one assignment
+        self.stopped    = False
+
+    def start( self ):
+        t = Thread( target=self._update, name="PiCameraSource" )
+        t.daemon = True
+        t.start()
+        return( self )
+
+    def read( self ):
+        return( self.latest[0] )
+
+    def read_stamped( self ):
+        return( self.latest )
+
+    def stop( self ):
+        self.stopped = True
+
+    def _update( self ):
+        for f in self.frames:
+            latest = ( f.array, monotonicStamp() )          # Grabbed: stamp before anything else
+            self.raw.truncate( 0 )
+            self.latest = latest
+
+            if( self.stopped ):
+                self.frames.close()
+                self.raw.close()
+                self.camera.close()
+                return
+
+# ************************************************************************
+# =======================> IMAGE DIRECTORY SOURCE <======================
+# ************************************************************************
+
+class ImageDirectorySource( FrameSource ):
+    '''
+    Replay every image in a directory (sorted by name). Images are
+    decoded once and kept in memory so replay cost is not dominated
+    by disk I/O.
+    '''
+
+    def __init__( self, path, resolution=(384, 288), fps=None, loop=True ):
+        FrameSource.__init__( self, resolution, fps, loop )
+
+        self.frames = []
+        for name in sorted( os.listdir(path) ):
+            if( os.path.splitext(name)[1].lower() not in VALID_IMAGES ):
+                continue
+
+            img = cv2.imread( os.path.join(path, name), cv2.IMREAD_COLOR )
+            if( img is not None ):
+                self.frames.append( self._resize(img) )
+
+        if( len(self.frames) == 0 ):
+            raise IOError( "No images found in {}".format(path) )
+
+        self.index = 0
+
+    def _next_frame( self ):
+        if( self.index >= len(self.frames) ):
+            return( None )
+
+        frame = self.frames[ self.index ]
+        self.index += 1
+        return( frame.copy() )                              # Callers are free to draw on frames
+
+    def _rewind( self ):
+        self.index = 0
+
+# ************************************************************************
+# =========================> VIDEO FILE SOURCE <=========================
+# ************************************************************************
+
+class VideoFileSource( FrameSource ):
+    '''
+    Replay a video file through cv2.VideoCapture.
+    '''
+
+    def __init__( self, path, resolution=(384, 288), fps=None, loop=True ):
+        FrameSource.__init__( self, resolution, fps, loop )
+
+        self.path    = path
+        self.capture = cv2.VideoCapture( path )
+        if( not self.capture.isOpened() ):
+            raise IOError( "Unable to open {}".format(path) )
+
+    def _next_frame( self ):
+        grabbed, frame = self.capture.read()
+        return( frame if grabbed else None )
+
+    def _rewind( self ):
+        self.capture.set( cv2.CAP_PROP_POS_FRAMES, 0 )
+
+    def stop( self ):
+        FrameSource.stop( self )
+        self.capture.release()
+
+# ************************************************************************
+# ======================> RECORDED SESSION SOURCE <======================
+# ************************************************************************
+
+class RecordedSessionSource( FrameSource ):
+    '''
+    Replay a raw session saved by record_session(). The .npz holds a
+    "frames" array (N, h, w, 3) and optionally a "timestamps" array (N,)
+    in seconds. With realtime=True and no explicit fps, the recorded
+    timestamps drive the pacing.
+    '''
+
+    def __init__( self, path, resolution=(384, 288), fps=None, loop=True, realtime=False ):
+        FrameSource.__init__( self, resolution, fps, loop )
+
+        data            = np.load( path )
+        self.frames     = data[ "frames" ]
+        self.timestamps = data[ "timestamps" ] if "timestamps" in data.files else None
+        self.realtime   = realtime
+        self.index      = 0
+        self.loops      = 0                                 # Completed passes, used for pacing
+
+        if( len(self.frames) == 0 ):
+            raise IOError( "No frames found in {}".format(path) )
+
+    def _next_frame( self ):
+        if( self.index >= len(self.frames) ):
+            return( None )
+
+        frame = self.frames[ self.index ]
+        self.index += 1
+        return( np.array(frame) )
+
+    def _rewind( self ):
+        self.index = 0
+        self.loops += 1
+
+    def _frame_time( self ):
+        if( self.fps or not self.realtime or self.timestamps is None ):
+            return( FrameSource._frame_time( self ) )
+
+        stamps   = self.timestamps
+        duration = stamps[-1] - stamps[0]
+        return( self.loops*duration + stamps[ self.index-1 ] - stamps[0] )
+
+# ************************************************************************
+# ============================> HELPERS <================================
+# ************************************************************************
+
+def open_source( spec, resolution=(384, 288), fps=None, loop=True, realtime=False ):
+    '''
+    Create a frame source from a command-line style specifier.
+
+    INPUTS:-
+        - spec      : "picamera", a directory, a .npz session, or a video file
+        - resolution: (width, height) of the returned frames
+        - fps       : Target frame rate, None/0 for as-fast-as-possible
+                      (PiCam: camera framerate, None/0 for 32)
+        - loop      : Restart replay sources at the end
+        - realtime  : Pace recorded sessions using their timestamps
+
+    OUTPUT:-
+        - source    : An (unstarted) frame source
+    '''
+
+    if( spec is None or spec == "picamera" ):
+        return( PiCameraSource( resolution, fps or 32 ) )
+
+    if( os.path.isdir(spec) ):
+        return( ImageDirectorySource( spec, resolution, fps, loop ) )
+
+    if( os.path.splitext(spec)[1].lower() in VALID_SESSIONS ):
+        return( RecordedSessionSource( spec, resolution, fps, loop, realtime ) )
+
+    return( VideoFileSource( spec, resolution, fps, loop ) )
+
+# ------------------------------------------------------------------------
+
+def record_session( source, path, n_frames, timeout=1.0 ):
+    '''
+    Record n_frames from a started source into a raw session file that
+    RecordedSessionSource can replay. The PiCam's read_stamped() returns
+    its latest frame without blocking, so every frame is waited for
+    (new stamp) and copied out of the camera's buffer.
+
+    INPUTS:-
+        - source    : A started frame source
+        - path      : Destination .npz file
+        - n_frames  : Number of frames to record
+        - timeout   : Longest wait (sec) for a new frame before stopping
+                      (source exhausted or camera stalled)
+
+    OUTPUT:-
+        - n         : Number of frames actually recorded
+    '''
+
+    frames, stamps, last = [], [], None
+    while( len(frames) < n_frames ):
+        deadline = time() + timeout
+        frame, stamp = source.read_stamped()
+        while( ( frame is None or stamp == last ) and time() < deadline ):
+            sleep( 0.001 )
+            frame, stamp = source.read_stamped()
+        if( frame is None or stamp == last ):
+            break
+
+        frames.append( frame.copy() )
+        stamps.append( stamp )
+        last = stamp
+
+    np.savez( path, frames=np.array(frames), timestamps=np.array(stamps) )
+
+    return( len(frames) )
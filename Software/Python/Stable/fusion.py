@@ -0,0 +1,277 @@
+'''
+* fusion.py
+*
+* Time-aligned fusion of ToF distance samples with camera frames.
+*
+* Both sides are stamped with the same monotonic clock (monotonicStamp):
+* frames when they are captured, ToF samples when they are measured.
+* Device timestamps (millis() in the framed protocol) are mapped onto the
+* host clock with ClockSync, so batching and USB latency do not smear the
+* sample times. Samples are kept in a small time-indexed SampleRing and
+* every frame gets the distance interpolated at its capture time. The
+* overlay decision goes through a hysteresis RangeGate, so a distance
+* hovering at the threshold no longer makes the overlay flicker. An
+* optional tofFilter.DistanceFilter cleans the samples up on the way in.
+*
+* Camera-only distance estimates (pupil radius through a calibration
+* RadiusTable) can be added as well. They are kept apart from the ToF
+* samples and only gate the frames the sensor has no fresh sample for,
+* so a unit with a missing or dead sensor still switches the overlay.
+*
+* USAGE:
+*   fusion = ToFFusion( enter=15, exit=18 )
+*   parser = FrameParser( listener=fusion.add_samples )    # Reader thread
+*   fusion.add_estimate( slot.stamp, table.distance(r) )   # Optional fallback
+*   in_range, mm, skew = fusion.gate( slot.stamp )         # Per frame
+*   fusion.source                                           # "tof", "camera" or None
+*   fusion.skew_stats()                                     # Sensor-to-frame skew
+'''
+
+from    bisect                      import  bisect_left
+from    collections                 import  deque
+from    threading                   import  Lock
+from    timeStamp                   import  monotonicStamp  # Monotonic clock
+
+# ************************************************************************
+# ============================> CLOCK SYNC <=============================
+# ************************************************************************
+
+class ClockSync( object ):
+    '''
+    Map device timestamps (ms) onto the host clock (sec).
+
+    The offset host - device is estimated from the sample that arrived
+    with the least delay: every arrival bounds the offset from above, so
+    the minimum over a window is the tightest estimate. The window lets
+    the estimate follow slow drift between the two oscillators.
+    '''
+
+    def __init__( self, window=256 ):
+        self.offsets    = deque( maxlen=window )
+        self.offset     = None
+        self.last       = None                              # Newest device timestamp seen
+
+    def update( self, device_ms, host_rx ):
+        '''
+        INPUTS:-
+            - device_ms : Device timestamp of the newest sample in a batch
+            - host_rx   : Host time the batch was received
+        '''
+
+        if( self.last is not None and device_ms < self.last ):   # Device rebooted (reconnect), start over
+            self.offsets.clear()
+        self.last = device_ms
+
+        self.offsets.append( host_rx - device_ms/1000.0 )
+        self.offset = min( self.offsets )
+
+    def host_time( self, device_ms ):
+        return( device_ms/1000.0 + self.offset )
+
+# ************************************************************************
+# ============================> SAMPLE RING <============================
+# ************************************************************************
+
+class SampleRing( object ):
+    '''
+    Fixed-size, time-ordered ring of (t, value) samples.
+    '''
+
+    def __init__( self, size=64 ):
+        self.times      = deque( maxlen=size )
+        self.values     = deque( maxlen=size )
+
+    def __len__( self ):
+        return( len(self.times) )
+
+    def append( self, t, value ):
+        if( self.times and t < self.times[-1] ):            # Out of order (device reboot), start over
+            self.times.clear()
+            self.values.clear()
+
+        self.times.append( t )
+        self.values.append( value )
+
+    def at( self, t ):
+        '''
+        Value at time t, linearly interpolated between the samples that
+        bracket it (held at either end of the ring).
+
+        OUTPUT:-
+            - value     : Interpolated value, None if the ring is empty
+            - skew      : t minus the time of the nearest sample (sec)
+        '''
+
+        if( not self.times ):
+            return( None, None )
+
+        times, values = list( self.times ), list( self.values )
+        i = bisect_left( times, t )
+
+        if( i == 0 ):
+            return( values[0], t - times[0] )
+        if( i == len(times) ):
+            return( values[-1], t - times[-1] )
+
+        t0, t1 = times[i-1], times[i]
+        v0, v1 = values[i-1], values[i]
+        k      = ( t - t0 ) / ( t1 - t0 ) if t1 > t0 else 1.0
+        skew   = t - t0 if k < 0.5 else t - t1
+
+        return( v0 + k*(v1 - v0), skew )
+
+# ************************************************************************
+# =============================> RANGE GATE <============================
+# ************************************************************************
+
+class RangeGate( object ):
+    '''
+    Hysteresis on the scan distance: switch on at or below enter, switch
+    off only above exit (exit > enter).
+    '''
+
+    def __init__( self, enter=15, exit=18 ):
+        self.enter      = enter
+        self.exit       = exit
+        self.on         = False
+
+    def update( self, mm ):
+        if( mm is None ):
+            self.on = False
+        elif( self.on ):
+            self.on = mm <= self.exit
+        else:
+            self.on = mm <= self.enter
+
+        return( self.on )
+
+# ************************************************************************
+# ==============================> FUSION <===============================
+# ************************************************************************
+
+class ToFFusion( object ):
+    '''
+    Thread-safe glue: the ToF reader adds samples, the frame pipeline
+    asks for the gated distance at each frame's capture time.
+    '''
+
+    def __init__( self, enter=15, exit=18, size=64, max_age=0.25, window=256, smooth=None ):
+        '''
+        INPUTS:-
+            - enter     : Overlay switches on at or below (mm)
+            - exit      : Overlay switches off above (mm)
+            - size      : Samples kept in the ring
+            - max_age   : Frames further than this (sec) from any sample
+                          are treated as out of range (sensor stalled)
+            - window    : Batches used for clock offset estimation
+            - smooth    : Optional filter with update_many( mms ) applied
+                          to the samples as they arrive (DistanceFilter)
+        '''
+
+        self.ring       = SampleRing( size )
+        self.estimates  = SampleRing( size )                # Camera-only fallback distances
+        self.source     = None                              # Where the last gate()'s distance came from
+        self.fallbacks  = 0                                 # Frames gated on a camera estimate
+        self.sync       = ClockSync( window )
+        self.range_gate = RangeGate( enter, exit )
+        self.max_age    = max_age
+        self.smooth     = smooth
+        self.lock       = Lock()
+        self.skews      = deque( maxlen=1024 )              # Recent sensor-to-frame skews (sec)
+
+    # --------------------------------------------------------------------
+
+    def add_samples( self, samples ):
+        '''
+        Add decoded framed-protocol samples (seq, device ms, mm); called
+        by the reader thread right after they are received.
+        '''
+
+        if( not samples ):
+            return
+
+        rx  = monotonicStamp()
+        mms = [ mm for ( seq, device_ms, mm ) in samples ]
+        if( self.smooth is not None ):
+            mms = self.smooth.update_many( mms )
+
+        with self.lock:
+            self.sync.update( samples[-1][1], rx )
+            for ( seq, device_ms, _ ), mm in zip( samples, mms ):
+                self.ring.append( self.sync.host_time(device_ms), mm )
+
+    # --------------------------------------------------------------------
+
+    def add( self, t, mm ):
+        '''
+        Add a sample already stamped on the host clock.
+        '''
+
+        if( self.smooth is not None ):
+            mm = self.smooth.update_many( [mm] )[-1]
+
+        with self.lock:
+            self.ring.append( t, mm )
+
+    # --------------------------------------------------------------------
+
+    def add_estimate( self, t, mm ):
+        '''
+        Add a camera-only distance estimate (e.g. from the pupil radius)
+        for the frame captured at t. Used only while there is no ToF data.
+        '''
+
+        if( mm is None ):
+            return
+
+        with self.lock:
+            self.estimates.append( t, mm )
+
+    # --------------------------------------------------------------------
+
+    def gate( self, t ):
+        '''
+        Gated distance at a frame's capture time.
+
+        INPUTS:-
+            - t         : Frame capture time (monotonicStamp())
+
+        OUTPUT:-
+            - in_range  : Hysteresis-gated overlay decision
+            - mm        : Interpolated distance (None if unknown)
+            - skew      : Frame time minus nearest sample time (sec)
+        '''
+
+        with self.lock:
+            mm, skew = self.ring.at( t )
+            if( skew is not None ):
+                self.skews.append( skew )
+                if( abs(skew) > self.max_age ):
+                    mm = None
+            self.source = "tof" if mm is not None else None
+
+            if( mm is None and self.estimates ):            # No fresh ToF sample: camera fallback
+                mm, skew = self.estimates.at( t )
+                if( abs(skew) > self.max_age ):
+                    mm = None
+                else:
+                    self.source = "camera"
+                    self.fallbacks += 1
+
+            return( self.range_gate.update( mm ), mm, skew )
+
+    # --------------------------------------------------------------------
+
+    def skew_stats( self ):
+        '''
+        OUTPUT:-
+            - (mean, min, max) skew in ms over recent frames, or None
+        '''
+
+        with self.lock:
+            skews = list( self.skews )
+
+        if( not skews ):
+            return( None )
+
+        return( 1000.0*sum(skews)/len(skews), 1000.0*min(skews), 1000.0*max(skews) )
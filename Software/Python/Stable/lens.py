@@ -0,0 +1,161 @@
+'''
+* lens.py
+*
+* Lens undistortion for the live feeds.
+*
+* The ophthalmoscope optics add strong radial distortion, worst near the
+* aperture edge where it bends the pupil out of round for HoughCircles.
+* BETA/lensCalibrate.py estimates the camera intrinsics from images of a
+* checkerboard or circle grid and writes them as a versioned JSON lens
+* profile. Undistorter builds the initUndistortRectifyMap maps for the
+* cropped frame ONCE, in OpenCV's fixed-point format (CV_16SC2), so the
+* capture stage pays a single remap per frame from the full capture
+* straight into a preallocated, crop-sized buffer (no separate cut).
+*
+* PROFILE (JSON):
+*   version       : LENS_VERSION
+*   image_size    : [width, height] of the calibration images (the full
+*                   capture, before cropping)
+*   camera_matrix : 3x3 intrinsics
+*   dist_coeffs   : k1, k2, p1, p2, k3
+*   rms_px        : RMS reprojection error of the calibration
+*
+* USAGE:
+*   lens  = load_lens()                         # None if not calibrated yet
+*   fix   = Undistorter( lens, size=aperture.size, crop=aperture.crop )
+*   frame = fix.apply( stream.read() )          # Replaces aperture.cut()
+'''
+
+import  os, json
+import  numpy                                               as  np
+import  cv2
+
+LENS_VERSION    = 1
+LENS_PATH       = os.path.join( os.path.expanduser("~"), ".ophthalmoscope", "lens.json" )
+
+# ************************************************************************
+# ============================> LENS PROFILE <============================
+# ************************************************************************
+
+class LensProfile( object ):
+    '''
+    Camera intrinsics and distortion coefficients of one camera.
+    '''
+
+    def __init__( self, data, path=None ):
+        '''
+        INPUTS:-
+            - data      : Decoded profile (dict)
+            - path      : File it was loaded from (for messages)
+        '''
+
+        if( data.get( "version" ) != LENS_VERSION ):
+            raise ValueError( "{}: lens profile version {}, expected {} (re-run lensCalibrate.py)".format(
+                              path, data.get("version"), LENS_VERSION) )
+
+        self.path       = path
+        self.data       = data
+        self.matrix     = np.array( data["camera_matrix"], dtype=np.float64 ).reshape( 3, 3 )
+        self.coeffs     = np.array( data["dist_coeffs"], dtype=np.float64 ).ravel()
+        self.image_size = tuple( data["image_size"] )
+        self.rms        = data.get( "rms_px" )
+
+    # --------------------------------------------------------------------
+
+    def scaled( self, size ):
+        '''
+        OUTPUT:-
+            - Camera matrix for captures of size=(w, h) (the distortion
+              coefficients do not depend on the resolution)
+        '''
+
+        K = self.matrix.copy()
+        if( size is not None and tuple(size) != self.image_size ):
+            K[0] *= float( size[0] ) / self.image_size[0]
+            K[1] *= float( size[1] ) / self.image_size[1]
+        return( K )
+
+    # --------------------------------------------------------------------
+
+    def __repr__( self ):
+        K = self.matrix
+        return( "LensProfile(f = {:.1f}, {:.1f} px, c = {:.1f}, {:.1f} at {}x{}, k = {}, RMS {} px)".format(
+                K[0,0], K[1,1], K[0,2], K[1,2], self.image_size[0], self.image_size[1],
+                np.round( self.coeffs, 4 ).tolist(), self.rms) )
+
+# ************************************************************************
+# ============================> UNDISTORTER <============================
+# ************************************************************************
+
+class Undistorter( object ):
+    '''
+    Precomputed undistortion of the full capture into the crop.
+    '''
+
+    def __init__( self, profile, size=None, crop=None, interpolation=cv2.INTER_LINEAR ):
+        '''
+        INPUTS:-
+            - profile   : LensProfile
+            - size      : (w, h) of the full capture (None = the
+                          calibration image size)
+            - crop      : (y1, y2, x1, x2) part of the capture apply()
+                          returns (None = the whole capture)
+            - interpolation : remap interpolation
+        '''
+
+        size = tuple( size ) if size is not None else profile.image_size
+        y1, y2, x1, x2 = crop if crop is not None else ( 0, size[1], 0, size[0] )
+
+        # Source: the full capture. Output: same intrinsics with the origin
+        # moved to the crop's corner, so the crop's pixel grid is kept and
+        # pixels pulled in from outside the crop are still sampled
+        K   = profile.scaled( size )
+        out = K.copy()
+        out[0, 2] -= x1
+        out[1, 2] -= y1
+
+        self.shape  = ( y2 - y1, x2 - x1 )
+        self.interpolation = interpolation
+        self.map1, self.map2 = cv2.initUndistortRectifyMap( K, profile.coeffs, None, out,
+                                                            ( self.shape[1], self.shape[0] ), cv2.CV_16SC2 )
+        self.out    = None                                  # Preallocated on the first frame
+
+    # --------------------------------------------------------------------
+
+    def apply( self, frame ):
+        '''
+        INPUTS:-
+            - frame     : Full capture, size
+
+        OUTPUT:-
+            - Undistorted crop, self.shape. The buffer is reused by the
+              next call, so copy it (FrameRing.acquire() does) before then
+        '''
+
+        shape = self.shape + frame.shape[2:]
+        if( self.out is None or self.out.shape != shape ):
+            self.out = np.empty( shape, dtype=frame.dtype )
+
+        cv2.remap( frame, self.map1, self.map2, self.interpolation, dst=self.out )
+        return( self.out )
+
+# ------------------------------------------------------------------------
+
+def load_lens( path=LENS_PATH, required=False ):
+    '''
+    INPUTS:-
+        - path      : Profile file ("~" is expanded)
+        - required  : Raise IOError instead of returning None if missing
+
+    OUTPUT:-
+        - LensProfile, or None if there is no profile yet
+    '''
+
+    path = os.path.expanduser( path )
+    if( not os.path.exists( path ) ):
+        if( required ):
+            raise IOError( "No lens profile at {} (run lensCalibrate.py)".format(path) )
+        return( None )
+
+    with open( path, "r" ) as f:
+        return( LensProfile( json.load(f), path ) )
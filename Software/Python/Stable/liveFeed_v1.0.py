@@ -10,6 +10,14 @@
 *   -o/--overlay: Specify overlay file
 *   -a/--alpha  : Specify transperancy level (0.0 - 1.0)
 *   -d/--debug  : Enable debugging
+*   -s/--source : picamera (default), image directory, video or .npz session
+*   -f/--fps    : Replay rate for non-camera sources (default: unthrottled),
+*                 PiCam framerate for picamera (default: 32)
+*   -r/--redetect: Locate the optical aperture again (ignore the cache)
+*   -t/--track  : ROI tracking, full-frame search after N misses (0 = off)
+*   -n/--detect-every: Detect on 1 of every N frames, track in between
+*   -c/--config : JSON file with trackbar values ({"minRadius": 15, ...})
+*   -p/--control-port: Set/get trackbar values over a local socket
 *
 * VERSION: 1.1.1a
 *   - ADDED   : Overlay an image/pathology
@@ -42,7 +50,16 @@ print __doc__
 import  cv2                                                                     # OpenCV, the meat & potatoes
 import  numpy                                                       as  np      # Image manipulation
 from    timeStamp                       import  fullStamp           as  FS      # Show date/time on console output
-from    imutils.video.pivideostream     import  PiVideoStream                   # Import threaded PiCam module
+from    frameSource                     import  open_source                     # PiCam or replay frame source
+from    aperture                        import  locate_aperture                 # Aperture crop + mask
+from    frameBuffer                     import  FrameRing                       # Preallocated BGRA frame buffers
+from    overlay                         import  OverlayCache, premultiply       # Pre-resized overlay renditions
+from    overlay                         import  composite                       # ROI-only alpha compositing
+from    tracking                        import  ROITracker                      # Tracked-ROI detection
+from    tracking                        import  PupilTracker, DetectionScheduler# Predict pupil between detections
+from    parameters                      import  ParameterStore, Derived         # Trackbar values, event-driven
+from    detectors                       import  blob_detector       as  get_detector# Cached SimpleBlobDetectors
+from    detectors                       import  warm_up                         # ...
 from    imutils.video                   import  FPS                             # Benchmark FPS
 from    argparse                        import  ArgumentParser                  # Pass flags/parameters to script
 ##from    LEDRing                         import  *                               # Let there be light
@@ -70,6 +87,27 @@ ap.add_argument( "-a", "--alpha", type=float, default=0.85,
 ap.add_argument( "-d", "--debug", action='store_true',
                  help="Enable debugging" )
 
+ap.add_argument( "-s", "--source", default="picamera",
+                 help="Frame source: picamera, image directory, video or .npz session" )
+
+ap.add_argument( "-f", "--fps", type=float, default=None,
+                 help="Replay rate for non-camera sources (Default=as fast as possible),\nPiCam framerate (Default=32)" )
+
+ap.add_argument( "-r", "--redetect", action='store_true',
+                 help="Locate the optical aperture again instead of using the cached one" )
+
+ap.add_argument( "-t", "--track", type=int, default=0,
+                 help="Detect only around the last pupil; full-frame search after TRACK misses.\nDefault=0 (OFF)" )
+
+ap.add_argument( "-n", "--detect-every", type=int, default=1,
+                 help="Run detection on 1 of every N frames, track the pupil in between.\nDefault=1" )
+
+ap.add_argument( "-c", "--config", default=None,
+                 help="JSON file with initial trackbar values" )
+
+ap.add_argument( "-p", "--control-port", type=int, default=0,
+                 help="Listen for parameter changes on this localhost port.\nDefault=0 (OFF)" )
+
 args = vars( ap.parse_args() )
 
 ##args["debug"] = True
@@ -103,6 +141,8 @@ def control( event, x, y, flags, param ):
     elif( event == cv2.EVENT_LBUTTONDOWN ):                                     # If left-click, switch overlays
         print( "[INFO] Loading {}".format(overlay_name_list[counter]) ) ,       # [INFO] ...
         overlayImg = prepare_overlay( overlay_path_list[counter] )              # Switch overlay
+        overlays.load( overlay_path_list[counter], overlayImg,                  # Pre-render it for the
+                       overlays.r_min, overlays.r_max )                         # current radius range
         print( "...DONE" )                                                      # [INFO] ...
         counter += 1
         
@@ -111,16 +151,6 @@ def control( event, x, y, flags, param ):
 
 # ------------------------------------------------------------------------
 
-def placeholder( x ):
-    '''
-    Place holder function for trackbars. This is required
-    for the trackbars to function properly.
-    '''
-    
-    return()
-
-# ------------------------------------------------------------------------
-
 def setup_windows():
     '''
     Create windows and trackbars.
@@ -133,98 +163,46 @@ def setup_windows():
     cv2.namedWindow( ver, cv2.WND_PROP_FULLSCREEN )                                                      # Start a named window for output
     cv2.setWindowProperty( ver, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN )
     cv2.setMouseCallback( ver, control )                                        # Connect mouse events to actions
-    cv2.createTrackbar( "minRadius"     , ver, 15 , 100, update_detector )      # Trackbars for blob detector
-    cv2.createTrackbar( "maxRadius"     , ver, 40 , 100, update_detector )      # parameters.
-    cv2.createTrackbar( "Circularity"   , ver, 26 , 100, update_detector )#40   #     (used in find_pupil)
-    cv2.createTrackbar( "Convexity"     , ver, 43 , 100, update_detector )#15   # ...
-    cv2.createTrackbar( "InertiaRatio"  , ver, 41 , 100, update_detector )      # ...
+    params.bind_trackbar( "minRadius"   , ver, 100 )                            # Trackbars for blob detector
+    params.bind_trackbar( "maxRadius"   , ver, 100 )                            # parameters.
+    params.bind_trackbar( "Circularity" , ver, 100 )                            #     (used in find_pupil)
+    params.bind_trackbar( "Convexity"   , ver, 100 )                            # ...
+    params.bind_trackbar( "InertiaRatio", ver, 100 )                            # ...
 
     # Setup window and trackbars for CV window
     CV_win = "CV Window"                                                        # Window's name
     cv2.namedWindow( CV_win )                                                   # Start a named window for CV
-    cv2.createTrackbar( "0.BiMean\n1.BiGaussian\n2.BiMean-Inv\n3.BiGaussian-Inv",
-                        CV_win, 2, 3, placeholder )                             # ...
-    cv2.createTrackbar( "maxValue"      , CV_win, 255, 255, placeholder )       # Trackbars to modify adaptive
-    cv2.createTrackbar( "blockSize"     , CV_win, 102, 254, placeholder )#58    # thresholding parameters
-    cv2.createTrackbar( "cte"           , CV_win, 100, 100, placeholder )       #   (used in procFrame)
-    cv2.createTrackbar( "GaussianBlur"  , CV_win,  50, 50 , placeholder )       # ...
+    params.bind_trackbar( "threshType"  , CV_win, 3,                            # ...
+                          label="0.BiMean\n1.BiGaussian\n2.BiMean-Inv\n3.BiGaussian-Inv" )
+    params.bind_trackbar( "maxValue"    , CV_win, 255 )                         # Trackbars to modify adaptive
+    params.bind_trackbar( "blockSize"   , CV_win, 254 )                         # thresholding parameters
+    params.bind_trackbar( "cte"         , CV_win, 100 )                         #   (used in procFrame)
+    params.bind_trackbar( "GaussianBlur", CV_win,  50 )                         # ...
 
     return()
 
 # ------------------------------------------------------------------------
 
-def setup_detector():
+def setup_detector( r_min, r_max, circle_min, convex_min, inertia_min ):
     '''
-    Setup blob detector.
+    Setup blob detector. Fetched (through blob_detector) only when
+    one of its trackbars is moved, and constructed only if those
+    values were not used before (see detectors.DetectorCache).
 
     INPUTS:-
-        - NONE
+        - r_min     : Minimum blob radius
+        - r_max     : Maximum blob radius
+        - circle_min: Minimum circularity  (%)
+        - convex_min: Minimum convexity    (%)
+        - inertia_min: Minimum inertia ratio (%)
 
     OUTPUT:-
-        - parameters: BLOB detector's parameters
         - detector  : BLOB detector
     '''
-    
-    parameters = cv2.SimpleBlobDetector_Params()                                # Parameters
-	 
-    # Filter by Area.
-    parameters.filterByArea = True                                              # ...
-    parameters.minArea = np.pi * 15**2                                          # ...
-    parameters.maxArea = np.pi * 40**2                                          # ...
-
-    # Filter by color
-    parameters.filterByColor = True                                             # ...
-    parameters.blobColor = 0                                                    # ...
-
-    # Filter by Circularity
-    parameters.filterByCircularity = True                                       # ...
-    parameters.minCircularity = 0.26                                            # ...
-     
-    # Filter by Convexity
-    parameters.filterByConvexity = True                                         # ...
-    parameters.minConvexity = 0.43                                              # ...
-             
-    # Filter by Inertia
-    parameters.filterByInertia = True                                           # ...
-    parameters.minInertiaRatio = 0.41                                           # ...
-
-    # Distance Between Blobs
-    parameters.minDistBetweenBlobs = 20000                                       # ...
-             
-    # Create a detector with the parameters
-    detector = cv2.SimpleBlobDetector_create( parameters )                      # Create detector
-
-    return( parameters, detector )
-    
-# ------------------------------------------------------------------------
-
-def update_detector( x ):
-    '''
-    Update blob detector parameters. Gets called whenever
-    trackbars are updated
-
-    INPUTS:-
-        - x: nothing
 
-    OUTPUT:-
-        - NONE
-    '''
-    
-    global detector, params
-
-    r_min       = cv2.getTrackbarPos( "minRadius"    , ver )                    # Get updated blob detector
-    r_max       = cv2.getTrackbarPos( "maxRadius"    , ver )                    # parameters
-    circle_min  = cv2.getTrackbarPos( "Circularity"  , ver )                    # ...
-    convex_min  = cv2.getTrackbarPos( "Convexity"    , ver )                    # ...
-    inertia_min = cv2.getTrackbarPos( "InertiaRatio" , ver )                    # ...
-
-    params.minArea          = np.pi * r_min**2                                  # Update parameters
-    params.maxArea          = np.pi * r_max**2                                  # ...
-    params.minCircularity   = circle_min/100.                                   # ...
-    params.minConvexity     = convex_min/100.                                   # ...
-    params.minInertiaRatio  = inertia_min/100.                                  # ...
-    
-    detector = cv2.SimpleBlobDetector_create( params )                          # Reflect changes to detector
+    return( get_detector( r_min, r_max,                                         # Cached BLOB detector
+                          circle_min/100., convex_min/100., inertia_min/100.,   # ...
+                          min_dist=20000 ) )                                    # ...
     
 # ------------------------------------------------------------------------
 
@@ -242,13 +220,13 @@ def procFrame( image ):
 
     # Error handling (1/3)
     try:
-        # Get trackbar position and reflect its threshold type and values
-        threshType      = cv2.getTrackbarPos( "0.BiMean\n1.BiGaussian\n2.BiMean-Inv\n3.BiGaussian-Inv",
-                                              CV_win )                          # ...
-        maxValue        = cv2.getTrackbarPos( "maxValue"    , CV_win )          # Update parameters
-        blockSize       = cv2.getTrackbarPos( "blockSize"   , CV_win )          # ...
-        cte             = cv2.getTrackbarPos( "cte"         , CV_win )          # from trackbars
-        GaussianBlur    = cv2.getTrackbarPos( "GaussianBlur", CV_win )          # ...
+        # Read threshold type and values (written by the trackbar callbacks)
+        p               = params.snapshot()                                     # ...
+        threshType      = p.threshType                                          # ...
+        maxValue        = p.maxValue                                            # Update parameters
+        blockSize       = p.blockSize                                           # ...
+        cte             = p.cte                                                 # from trackbars
+        GaussianBlur    = p.GaussianBlur                                        # ...
 
         # blockSize must be an odd number
         if( blockSize%2 == 0 ):                                                 # Ensure that blockSize
@@ -256,6 +234,7 @@ def procFrame( image ):
         
         # Dissolve noise while maintaining edge sharpness
         processed = cv2.inRange( image, lower_bound, upper_bound )
+        processed = aperture.clear( processed )                                 # Zero everything outside aperture
         processed = cv2.bilateralFilter( processed, 5, 17, 17 )
         processed = cv2.GaussianBlur( processed, (5, 5), GaussianBlur )
         
@@ -282,22 +261,20 @@ def procFrame( image ):
                                                cte )                            # ...
 
         # Use erosion and dilation combination to eliminate false positives.
-        kernel      = cv2.getStructuringElement( cv2.MORPH_ELLIPSE, ( 3, 3 ) )  # Define kernel for filters                         
-        processed   = cv2.erode ( processed, kernel, iterations=6 )             # Erode over 6 passes
-        processed   = cv2.dilate( processed, kernel, iterations=3 )             # Dilate over 3 passes
+        processed   = cv2.erode ( processed, KERNEL, iterations=6 )             # Erode over 6 passes
+        processed   = cv2.dilate( processed, KERNEL, iterations=3 )             # Dilate over 3 passes
 
-        morphed     = cv2.morphologyEx( processed, cv2.MORPH_GRADIENT, kernel ) # Morph image for shits and gigs
+        morphed     = cv2.morphologyEx( processed, cv2.MORPH_GRADIENT, KERNEL ) # Morph image for shits and gigs
         
     # Error handling (2/3) 
     except:
-        kernel      = cv2.getStructuringElement( cv2.MORPH_ELLIPSE, ( 3, 3 ) )  # Define kernel for filters
         processed   = image                                                     # Reset image in case...
-        morphed     = cv2.morphologyEx( processed, cv2.MORPH_GRADIENT, kernel ) # function done fucked up!
+        morphed     = cv2.morphologyEx( processed, cv2.MORPH_GRADIENT, KERNEL ) # function done fucked up!
         
-        cv2.createTrackbar( "maxValue"    , CV_win, 255, 255, placeholder )     # Reset trackbars
-        cv2.createTrackbar( "blockSize"   , CV_win,  93, 254, placeholder )#107 # ...
-        cv2.createTrackbar( "cte"         , CV_win,  50, 100, placeholder )     # ...
-        cv2.createTrackbar( "GaussianBlur", CV_win,  50,  50, placeholder )     # ...
+        params.assign( { "maxValue"     : 255,                                  # Reset trackbars
+                         "blockSize"    :  93,                                  # ...
+                         "cte"          :  50,                                  # ...
+                         "GaussianBlur" :  50 } )                               # ...
 
     # Error handling (3/3)
     finally:
@@ -307,14 +284,13 @@ def procFrame( image ):
 # ------------------------------------------------------------------------
 initC = True
 initK = True
-def find_pupil( processed, overlay_frame, overlay_img, frame ):
+def find_pupil( processed, overlays, frame ):
     '''
     Find pupil by scanning for circles within an image
 
     INPUTS:-
         - processed     : Processed image
-        - overlay_frame : The overlay empty frame
-        - overlay_img   : The overlay image
+        - overlays      : OverlayCache of the current overlay
         - frame         : Frame to which we should attach overlay
 
     OUTPUT:-
@@ -329,12 +305,13 @@ def find_pupil( processed, overlay_frame, overlay_img, frame ):
     
     frame_failed = bool( True )                                                 # Boolean flag 1
     within_ROI   = bool( False )                                                # Boolean flag 2
+    found        = None                                                         # Detected (x, y, r)
 
     # Error handling (1/3)
     try:
         # BLOB Detector
         gray = cv2.cvtColor( frame, cv2.COLOR_BGR2GRAY )                        # Convert to grayscale
-        keypoints = detector.detect( gray )                                     # Launch blob detector
+        keypoints = tracker.detect( gray, detect_blobs )                        # Launch blob detector (ROI)
 
         if( len(keypoints) > 0 ):                                               # If blobs are found
             if( args["debug"] ):
@@ -343,53 +320,53 @@ def find_pupil( processed, overlay_frame, overlay_img, frame ):
                     initK = False
                     print( "[INFO] cv2.SimpleBlobDetector()" )
                     
-            for k in keypoints:                                                 # Iterate over found blobs
-                x, y, r = int(k.pt[0]), int(k.pt[1]), int(k.size/2)             # Get co-ordinates
-                pos = ( x, y, r )                                               # Pack co-ordinates
+            for pos in keypoints:                                               # Iterate over found blobs
                 
                 if( is_inROI( pos ) ):                                          # Check if we are within ROI
 ##                if( True ): 
-                    frame = add_overlay( overlay_frame,                         # Add overlay
-                                         overlay_img,                           # ...
-                                         frame, pos )                           # ...
+                    found = pos                                                 # Keep first pupil found
                     
                     frame_failed = bool( False )                                # Set flag to false
                     within_ROI   = bool( True  )                                # Set flag to true
+                    break                                                       # ...
                     
         else:
             # Contour Detector
-            r_min   = cv2.getTrackbarPos( "minRadius", ver )                    # Get current r_min ...
-            r_max   = cv2.getTrackbarPos( "maxRadius", ver )                    # and r_max values
+            p       = params.snapshot()                                         # Get current r_min ...
+            r_min, r_max = p.minRadius, p.maxRadius                             # and r_max values
              
-            _, contours, _ = cv2.findContours( processed,                       # Find contours based on their...
-                                               cv2.RETR_EXTERNAL,               # external edges and keep only...
-                                               cv2.CHAIN_APPROX_SIMPLE )        # intermediate points (SIMPLE)
+            circles = tracker.detect( processed, detect_contours )              # Find contours (ROI)
             
             # If circles are found draw them
-            if( len(contours) > 0 ):                                            # Check if we detected anything
+            if( len(circles) > 0 ):                                             # Check if we detected anything
                 if( args["debug"] ):
                     if( initC ):
                         initC = False
                         initK = True                    
                         print( "[INFO] cv2.findContours()" )
                         
-                for c in contours:                                              # Iterate over all contours
-                    (x, y) ,r = cv2.minEnclosingCircle(c)                       # Min enclosing circle inscribing contour
-                    xy = (int(x), int(y))                                       # Get circle's center...
-                    r = int(r)                                                  # and radius
-                    pos = ( xy[0], xy[1], r )                                   # Pack co-ordinates
+                for pos in circles:                                             # Iterate over all contours
+                    r = pos[2]                                                  # Get radius
                     
                     if( is_inROI( pos ) ):                                      # Check if we are within ROI
 ##                    if( True ):
                         if( r_min <= r and r <= r_max ):                        # Check if within desired limit
-                            frame = add_overlay( overlay_frame,                 # Add overlay
-                                                 overlay_img,                   # ...
-                                                 frame, pos )                   # ...
+                            found = pos                                         # Keep first pupil found
 
                             frame_failed = bool( False )                        # Set flag to false
                             within_ROI   = bool( True  )                        # Set flag to true
+                            break                                               # ...
 
 
+        pos = pupil.step( found )                                               # Smooth/gate detection (or
+        if( pos is not None ):                                                  # predict if it failed)
+            frame = add_overlay( overlays, frame, pos )                         # Add overlay
+
+        if( not pupil.coasting ):                                               # Detection accepted...
+            tracker.confirm( pos )                                              #   track this pupil
+        else:                                                                   # Else...
+            tracker.miss()                                                      #   widen search if lost
+
         if( frame_failed and not within_ROI ):
             ROI = is_inROI( update_ROI=True )                                   # Reset ROI if necessary
 
@@ -399,11 +376,11 @@ def find_pupil( processed, overlay_frame, overlay_img, frame ):
             print( "{} Error caught in find_pupil()".format(FS()) )             # Specify error type
             print( "{0} {1}".format(FS(), error) )                              # ...
 
-        cv2.createTrackbar( "minRadius"    , ver, 15 , 150, update_detector )   # Reset trackbars
-        cv2.createTrackbar( "maxRadius"    , ver, 45 , 150, update_detector )   # ...
-        cv2.createTrackbar( "Circularity"  , ver, 42 , 100, update_detector )   # ...
-        cv2.createTrackbar( "Convexity"    , ver, 43 , 100, update_detector )   # ...
-        cv2.createTrackbar( "InertiaRatio" , ver, 41 , 100, update_detector )   # ...
+        params.assign( { "minRadius"    : 15,                                   # Reset trackbars
+                         "maxRadius"    : 45,                                   # ...
+                         "Circularity"  : 42,                                   # ...
+                         "Convexity"    : 43,                                   # ...
+                         "InertiaRatio" : 41 } )                                # ...
 
     # Error handling (3/3)
     finally:
@@ -411,13 +388,75 @@ def find_pupil( processed, overlay_frame, overlay_img, frame ):
     
 # ------------------------------------------------------------------------
 
-def add_overlay( overlay_frame, overlay_img, frame, pos ):
+def track_pupil( overlays, frame ):
+    '''
+    Place overlay at the predicted pupil location on frames where
+    detection is skipped
+
+    INPUTS:-
+        - overlays      : OverlayCache of the current overlay
+        - frame         : Frame to which we should attach overlay
+
+    OUTPUT:-
+        - frame         : Image with/without overlay
+                (depends whether the pupil is still tracked)
+    '''
+
+    pos = pupil.step()                                                          # Predict pupil position
+    if( pos is not None ):                                                      # If still tracked
+        frame = add_overlay( overlays, frame, pos )                             # Add overlay
+
+    return( frame )
+
+# ------------------------------------------------------------------------
+
+def detect_blobs( img ):
+    '''
+    Run the blob detector on an image (or ROI)
+
+    INPUTS:-
+        - img           : Grayscale image
+
+    OUTPUT:-
+        - circles       : List of (x, y, r) co-ordinates
+    '''
+
+    keypoints = blob_detector.get().detect( img )                               # Launch blob detector
+
+    return( [ (int(k.pt[0]), int(k.pt[1]), int(k.size/2)) for k in keypoints ] )
+
+# ------------------------------------------------------------------------
+
+def detect_contours( img ):
+    '''
+    Find contours in an image (or ROI) and fit a circle to each
+
+    INPUTS:-
+        - img           : Processed (binary) image
+
+    OUTPUT:-
+        - circles       : List of (x, y, r) co-ordinates
+    '''
+
+    _, contours, _ = cv2.findContours( img,                                     # Find contours based on their...
+                                       cv2.RETR_EXTERNAL,                       # external edges and keep only...
+                                       cv2.CHAIN_APPROX_SIMPLE )                # intermediate points (SIMPLE)
+
+    circles = []
+    for c in contours:                                                          # Iterate over all contours
+        (x, y) ,r = cv2.minEnclosingCircle(c)                                   # Min enclosing circle inscribing contour
+        circles.append( (int(x), int(y), int(r)) )                              # Pack co-ordinates
+
+    return( circles )
+
+# ------------------------------------------------------------------------
+
+def add_overlay( overlays, frame, pos ):
     '''
     Resize and add overlay image into detected pupil location 
 
     INPUTS:
-        - overlay_frame : The overlay empty frame
-        - overlay_img   : The overlay image
+        - overlays      : OverlayCache of the current overlay
         - frame         : Frame to which we should attach overlay
         - pos           : Co-ordinates where pupil is
 
@@ -433,17 +472,10 @@ def add_overlay( overlay_frame, overlay_img, frame, pos ):
     if( x_min > 0 and y_min > 0 ):
         if( x_max < w and y_max < h ):
             
-            overlay_img = cv2.resize( overlay_img, ( 2*r, 2*r ),                # Resize overlay image to fit
-                                      interpolation = cv2.INTER_AREA )          # ...
+            overlay_img = overlays.get( r )                                     # Pre-resized overlay image
             
-            overlay_frame[ y_min:y_max, x_min:x_max] = overlay_img              # Place overlay image into overlay frame
-            r_min       = cv2.getTrackbarPos( "minRadius"    , ver )                    # Get updated blob detector
-            r_max       = cv2.getTrackbarPos( "maxRadius"    , ver )                    # parameters
-            alpha_val = np.interp( r, [r_min, r_max], [0.0, 1.0] )
-            args["alpha"] = alpha_val
-            frame = cv2.addWeighted( overlay_frame,                             # Join overlay frame (alpha)
-                                     0.50,                             # with actual frame (RGB)
-                                     frame, 1.0, 0 )            # ...
+            frame = composite( frame, overlay_img,                              # Blend overlay (alpha) into
+                               x_min, y_min )                                   # its bounding box, in place
 
             if( args["debug"] ):
                 cv2.circle( frame, (x, y), r, (0, 255, 0), 2 )                  # Draw a circle
@@ -573,23 +605,55 @@ for file in os.listdir( overlay_path ):
         overlay_path_list.append( os.path.join(overlay_path, file) )            # to list.
         overlay_name_list.append( os.path.splitext(file)[0] )                   # ...
         
+# Trackbar values, written by the trackbar callbacks (or the config
+# file/control socket) and read through immutable snapshots
+params = ParameterStore( { "minRadius"      : 15 ,
+                           "maxRadius"      : 40 ,
+                           "Circularity"    : 26 ,  #40
+                           "Convexity"      : 43 ,  #15
+                           "InertiaRatio"   : 41 ,
+                           "threshType"     : 2  ,
+                           "maxValue"       : 255,
+                           "blockSize"      : 102,  #58
+                           "cte"            : 100,
+                           "GaussianBlur"   : 50  } )
+
+KERNEL = cv2.getStructuringElement( cv2.MORPH_ELLIPSE, ( 3, 3 ) )               # Kernel for filters (built once)
+
 # Prepare overlay
 global overlayImg, counter
 counter     = 0                                                                 # Overlay switcher counter
 overlayImg  = prepare_overlay( args["overlay"] )                                # Prepare and process overlay
+overlays    = OverlayCache( transform=lambda img: premultiply(img, 0.50) )      # Pre-render overlay for the
+overlays.load( args["overlay"], overlayImg, 15, 40 )                            # minRadius/maxRadius trackbars
 
 # Setup camera (x,y)
-stream = PiVideoStream( resolution=(384, 288) ).start()                         # Start PiCam
+stream = open_source( args["source"], resolution=(384, 288),                    # Start PiCam
+                      fps=args["fps"] ).start()                                 # (or replay source)
 sleep( 0.25 )                                                                   # Sleep for stability
+aperture = locate_aperture( stream, args["source"],                             # Crop to the optical aperture
+                            redetect=args["redetect"] )                         # (detected once, then cached)
+print( "{} [INFO] {}".format(FS(), aperture) )                                  # ...
 realDisplay = True                                                              # Start with a normal display
 ##colorWipe( strip, Color(255, 255, 255, 255), 0 )                                # Turn ON LED ring
 
 # Setup main window
 setup_windows()                                                                 # Create window and trackbars
 
+# Optional config file and control socket
+if( args["config"] is not None ):
+    params.load_file( args["config"] )                                          # Initial trackbar values
+if( args["control_port"] ):
+    params.serve( args["control_port"] )                                        # Live tuning over a socket
+
 # Setup BlobDetector
-global detector, params
-params, detector = setup_detector()                                             # Create BLOB detector + define params
+blob_detector = Derived( params, ( "minRadius", "maxRadius", "Circularity",    # Create BLOB detector, rebuilt
+                                   "Convexity", "InertiaRatio" ),               # only when its trackbars move
+                         setup_detector )                                       # ...
+warm_up( [ (15, 40, 0.26, 0.43, 0.41, 20000),                                   # Build default and error-reset
+           (15, 45, 0.42, 0.43, 0.41, 20000) ] )                                # presets ahead of time
+overlay_range = Derived( params, ( "minRadius", "maxRadius" ),                  # Re-render overlay only when
+                         overlays.set_range )                                   # the radius range changes
 
 
 ######
@@ -599,8 +663,25 @@ global ROI, startTime
 startTime = time()
 timeout = 1.5
 dx, dy, dROI = 35, 35, 65
-ROI_0 = [ (144-dROI, 108-dROI), (144+dROI, 108+dROI) ]
-ROI   = [ (144-dROI, 108-dROI), (144+dROI, 108+dROI) ]
+cx, cy = aperture.center                                                        # Centred on the aperture
+ROI_0 = [ (cx-dROI, cy-dROI), (cx+dROI, cy+dROI) ]
+ROI   = [ (cx-dROI, cy-dROI), (cx+dROI, cy+dROI) ]
+
+######
+### Setup tracked-ROI detection (disabled when --track is 0)
+######
+tracker = ROITracker( max_misses=args["track"] )
+
+######
+### Setup pupil tracker ("detect every N frames, track in between")
+######
+pupil     = PupilTracker( max_coast=max( 5, 2*args["detect_every"] ) )
+scheduler = DetectionScheduler( every=args["detect_every"] )
+
+######
+### Setup frame buffers
+######
+ring = FrameRing( aperture.shape, size=2, overlay=False )                       # Matches the aperture crop
 
 # ************************************************************************
 # =========================> MAKE IT ALL HAPPEN <=========================
@@ -623,21 +704,27 @@ upper_bound = np.array( [255, 255, 195], dtype = np.uint8 )
 ##upper_bound = np.array( [180, 255,  30], dtype = np.uint8 )
 
 while( True ):
+    params.sync_trackbars()                                                     # Queued trackbar moves (GUI thread)
+
     # Capture frame
-    frame = stream.read()[36:252, 48:336]                                       # Capture frame and crop it
+    capture = stream.read()                                                     # Capture frame
+    if( capture is None ):                                                      # Replay source exhausted:
+        control( cv2.EVENT_RBUTTONDOWN, 0, 0, 0, None )                         # shut down as on right-click
+    frame = aperture.cut( capture )                                             # Crop to the aperture
     image = frame                                                               # Save a copy of captured frame
 
     # Add a 4th dimension (Alpha) to the captured frame
     (h, w) = frame.shape[:2]                                                    # Determine width and height
-    frame = np.dstack([ frame, np.ones((h, w),                                  # Stack the arrays in sequence, 
-                                       dtype="uint8")*255 ])                    # depth-wise ( along the z-axis )
-
-    # Create an overlay layer
-    overlay = np.zeros( ( h, w, 4 ), "uint8" )                                  # Empty np array w\ same dimensions as the frame
+    slot  = ring.acquire( frame )                                               # Copy into preallocated BGRA slot
+    frame = slot.frame                                                          # ...
+    overlay_range.get()                                                         # Follow radius trackbars
 
     # Find circles
-    mask, closing = procFrame( image )                                          # Process image
-    image = find_pupil( closing, overlay, overlayImg, frame )                   # Scan for pupil
+    if( scheduler.due( pupil.locked() ) ):                                      # Detect on this frame
+        mask, closing = procFrame( image )                                      # Process image
+        image = find_pupil( closing, overlays, frame )                          # Scan for pupil
+    else:                                                                       # Else
+        image = track_pupil( overlays, frame )                                  # Use predicted pupil
     
     if( args["debug"] ):
         cv2.rectangle( image, ROI_0[0], ROI_0[1], (0, 0, 255) ,2 )              # Draw initial ROI box
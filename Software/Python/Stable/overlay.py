@@ -0,0 +1,244 @@
+'''
+* overlay.py
+*
+* Overlay (pathology) image helpers for the live feeds.
+*
+* OverlayCache keeps pre-resized renditions of an overlay keyed by
+* (overlay id, radius). The pupil radius only takes the integer values
+* between the minRadius and maxRadius trackbars, so every rendition is
+* computed once when the overlay (or the radius range) is loaded, and
+* compositing does no resampling at runtime.
+*
+* composite() blends a rendition into the frame in place, touching only
+* its 2r x 2r bounding box. Renditions are stored premultiplied by their
+* per-pixel alpha in 8.8 fixed point (see premultiply()), so the blend
+* is one multiply-add and a shift per pixel and its cost scales with the
+* pupil size rather than the frame size.
+*
+* USAGE:
+*   overlays = OverlayCache( transform=lambda img: premultiply(img, 0.85) )
+*   overlays.load( path, overlayImg, r_min, r_max )     # Eager fill
+*   composite( frame, overlays.get( r ), x-r, y-r )     # Blend in place
+*   overlays.set_range( r_min, r_max )                  # Trackbars moved
+'''
+
+import  cv2
+import  numpy                                               as  np
+from    collections                 import  OrderedDict
+from    threading                   import  RLock
+
+# ************************************************************************
+# ===========================> OVERLAY CACHE <===========================
+# ************************************************************************
+
+class OverlayCache( object ):
+    '''
+    Memory-bounded, radius-indexed cache of resized overlay images.
+    Safe to share between the capture thread and pipeline workers.
+    '''
+
+    def __init__( self, max_bytes=16*1024*1024, interpolation=cv2.INTER_AREA, transform=None ):
+        '''
+        INPUTS:-
+            - max_bytes     : Upper bound on the memory held by renditions
+            - interpolation : cv2.resize() interpolation flag
+            - transform     : Optional function applied to every resized
+                              image before it is cached (e.g. premultiply)
+        '''
+
+        self.max_bytes      = max_bytes
+        self.interpolation  = interpolation
+        self.transform      = transform
+
+        self.overlay_id     = None                          # Currently loaded overlay
+        self.image          = None                          # Full resolution overlay
+        self.r_min          = 0                             # Eagerly cached radius range
+        self.r_max          = -1
+
+        self.renditions     = OrderedDict()                 # (overlay_id, r) --> image (LRU order)
+        self.nbytes         = 0
+        self.misses         = 0                             # Resizes done at runtime
+        self.lock           = RLock()
+
+    # --------------------------------------------------------------------
+
+    def load( self, overlay_id, image, r_min, r_max ):
+        '''
+        Switch to a new overlay and pre-render it for every radius in
+        [r_min, r_max]. Renditions of the previous overlay are dropped.
+
+        INPUTS:-
+            - overlay_id: Hashable id of the overlay (e.g. its path)
+            - image     : BGRA overlay image (see prepare_overlay())
+            - r_min     : Smallest radius to pre-render
+            - r_max     : Largest  radius to pre-render
+        '''
+
+        with self.lock:
+            if( overlay_id != self.overlay_id or image is not self.image ):
+                self.clear()
+                self.overlay_id = overlay_id
+                self.image      = image
+
+            self.set_range( r_min, r_max )
+
+    # --------------------------------------------------------------------
+
+    def set_range( self, r_min, r_max ):
+        '''
+        Update the pre-rendered radius range. Radii that fell out of the
+        range are evicted, new ones are rendered. No-op if unchanged.
+        '''
+
+        r_min, r_max = max( 1, int(r_min) ), int( r_max )
+
+        with self.lock:
+            if( (r_min, r_max) == (self.r_min, self.r_max) or self.image is None ):
+                return
+
+            self.r_min, self.r_max = r_min, r_max
+
+            for key in list( self.renditions.keys() ):
+                if( not (r_min <= key[1] <= r_max) ):
+                    self._evict( key )
+
+            for r in range( r_min, r_max+1 ):
+                self._render( r )
+
+    # --------------------------------------------------------------------
+
+    def get( self, r ):
+        '''
+        Return the overlay resized to (2r, 2r). Radii outside the cached
+        range are rendered on demand (and kept if memory allows).
+
+        INPUTS:-
+            - r         : Radius in pixels
+
+        OUTPUT:-
+            - resized   : (2r, 2r, 4) overlay image (or its transform)
+        '''
+
+        with self.lock:
+            key = ( self.overlay_id, int(r) )
+            resized = self.renditions.get( key )
+
+            if( resized is None ):
+                self.misses += 1
+                resized = self._render( int(r) )
+            else:
+                self.renditions[ key ] = self.renditions.pop( key ) # Mark as most recently used
+
+            return( resized )
+
+    # --------------------------------------------------------------------
+
+    def clear( self ):
+        with self.lock:
+            self.renditions.clear()
+            self.nbytes = 0
+            self.r_min, self.r_max = 0, -1
+
+    # --------------------------------------------------------------------
+
+    def _render( self, r ):
+        key = ( self.overlay_id, r )
+        if( key in self.renditions ):
+            return( self.renditions[key] )
+
+        resized = cv2.resize( self.image, ( 2*r, 2*r ),
+                              interpolation=self.interpolation )
+        if( self.transform is not None ):
+            resized = self.transform( resized )
+
+        # Make room, evicting the least recently used renditions first
+        while( self.renditions and self.nbytes + resized.nbytes > self.max_bytes ):
+            self._evict( next(iter(self.renditions)) )
+
+        if( resized.nbytes <= self.max_bytes ):
+            self.renditions[ key ] = resized
+            self.nbytes += resized.nbytes
+
+        return( resized )
+
+    # --------------------------------------------------------------------
+
+    def _evict( self, key ):
+        resized = self.renditions.pop( key )
+        self.nbytes -= resized.nbytes
+
+# ************************************************************************
+# ============================> COMPOSITING <============================
+# ************************************************************************
+
+class Premultiplied( object ):
+    '''
+    Overlay rendition ready for composite(). Colour is premultiplied by
+    the effective per-pixel alpha, both in 8.8 fixed point (256 == 1.0)
+    '''
+
+    def __init__( self, color, inverse ):
+        self.color      = color                             # (h, w, 3) uint16, BGR * a
+        self.inverse    = inverse                           # (h, w, 1) uint16, 256 - a
+        self.shape      = color.shape[:2]
+        self.nbytes     = color.nbytes + inverse.nbytes
+
+# ------------------------------------------------------------------------
+
+def premultiply( img, alpha=1.0 ):
+    '''
+    Premultiply a BGRA overlay by its own alpha channel scaled by a
+    global transparency level.
+
+    INPUTS:-
+        - img       : (h, w, 4) BGRA overlay
+        - alpha     : Global transparency level (0.0 - 1.0)
+
+    OUTPUT:-
+        - rendition : Premultiplied rendition
+    '''
+
+    level   = int( round( min(max(alpha, 0.0), 1.0) * 256 ) )
+    a       = ( img[:, :, 3:4].astype(np.uint16) * level ) >> 8   # 0 - 255
+    a      += a >> 7                                            # Map 255 --> 256
+
+    color   = img[:, :, :3].astype(np.uint16) * a
+    inverse = 256 - a
+
+    return( Premultiplied( color, inverse ) )
+
+# ------------------------------------------------------------------------
+
+def composite( frame, rendition, x, y ):
+    '''
+    Blend a premultiplied rendition into frame, in place, with its
+    top-left corner at (x, y). Only the rendition's bounding box is
+    touched; parts falling outside the frame are clipped.
+
+    INPUTS:-
+        - frame     : (H, W, 3 or 4) uint8 frame, modified in place
+        - rendition : Premultiplied rendition (see premultiply())
+        - x, y      : Top-left corner in frame co-ordinates
+
+    OUTPUT:-
+        - frame     : The same frame, for convenience
+    '''
+
+    h, w    = rendition.shape
+    H, W    = frame.shape[:2]
+
+    x1, y1  = max( x, 0 ), max( y, 0 )                          # Clip to frame
+    x2, y2  = min( x+w, W ), min( y+h, H )
+    if( x1 >= x2 or y1 >= y2 ):
+        return( frame )
+
+    roi     = frame[ y1:y2, x1:x2, :3 ]
+    color   = rendition.color  [ y1-y:y2-y, x1-x:x2-x ]
+    inverse = rendition.inverse[ y1-y:y2-y, x1-x:x2-x ]
+
+    blended  = roi * inverse                                    # uint16, never overflows
+    blended += color
+    blended >>= 8
+    roi[...] = blended
+
+    return( frame )
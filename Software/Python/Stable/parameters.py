@@ -0,0 +1,361 @@
+'''
+* parameters.py
+*
+* Thread-safe, event-driven parameter store for the live feeds.
+*
+* Instead of polling cv2.getTrackbarPos() several times per frame, the
+* trackbar callbacks (and optionally a JSON config file or a local
+* control socket) write into a ParameterStore. Hot-path stages read an
+* immutable Snapshot, which is a single attribute read. Every write
+* bumps a version counter so that derived objects (kernels, detectors,
+* caches) are only rebuilt when one of their inputs actually changed
+* (see Derived).
+*
+* USAGE:
+*   params = ParameterStore( {"minRadius": 15, "maxRadius": 40} )
+*   params.bind_trackbar( "minRadius", window, 100 )    # Trackbar --> store
+*   params.load_file( "liveFeed.json" )                 # Optional config
+*   params.serve( 5005 )                                # Optional control socket
+*   params.assign( {"minRadius": 10} )                  # Store --> trackbar (queued)
+*   params.sync_trackbars()                             # GUI thread, per frame
+*
+*   p = params.snapshot()                               # Per frame
+*   p.minRadius, p["maxRadius"], p.version
+*
+*   detector = Derived( params, ("minRadius", "maxRadius"), build )
+*   detector.get()                                      # Rebuilt on change only
+*
+* CONTROL SOCKET (localhost, one command per line):
+*   get <name>          --> <value>
+*   set <name> <value>  --> OK (ERR if outside a bound trackbar's range)
+*   dump                --> JSON of every parameter
+*
+* HighGUI may only be called from the thread that owns the windows, so
+* assign() (which the control socket and worker threads also call) only
+* queues the trackbar moves; the main loop applies them with
+* sync_trackbars().
+'''
+
+import  json
+import  socket
+import  cv2
+from    threading                   import  Thread, Lock
+from    timeStamp                   import  fullStamp       # Show date/time on console output
+
+# ************************************************************************
+# =============================> SNAPSHOT <==============================
+# ************************************************************************
+
+class Snapshot( object ):
+    '''
+    Immutable view of every parameter at a given version.
+    '''
+
+    __slots__ = ( "_values", "version" )
+
+    def __init__( self, values, version ):
+        object.__setattr__( self, "_values" , dict(values) )
+        object.__setattr__( self, "version" , version      )
+
+    def __getattr__( self, name ):
+        try:
+            return( self._values[name] )
+        except KeyError:
+            raise AttributeError( name )
+
+    def __getitem__( self, name ):
+        return( self._values[name] )
+
+    def __setattr__( self, name, value ):
+        raise AttributeError( "Snapshot is read-only" )
+
+    def get( self, name, default=None ):
+        return( self._values.get(name, default) )
+
+    def as_dict( self ):
+        return( dict(self._values) )
+
+# ************************************************************************
+# ==========================> PARAMETER STORE <==========================
+# ************************************************************************
+
+class ParameterStore( object ):
+    '''
+    Versioned key/value store. Writes are serialized by a lock; reads go
+    through snapshot() and never block.
+    '''
+
+    def __init__( self, defaults ):
+        '''
+        INPUTS:-
+            - defaults  : {name: value} initial (and reset) values
+        '''
+
+        self.defaults   = dict( defaults )
+        self.lock       = Lock()
+        self.trackbars  = {}                                # name --> (label, window)
+        self.moves      = {}                                # name --> position, for sync_trackbars()
+        self.ranges     = {}                                # name --> (0, count) of the bound trackbar
+        self.listeners  = []                                # Called with the new snapshot
+        self._snapshot  = Snapshot( self.defaults, 0 )
+
+    # --------------------------------------------------------------------
+
+    @property
+    def version( self ):
+        return( self._snapshot.version )
+
+    # --------------------------------------------------------------------
+
+    def snapshot( self ):
+        '''
+        OUTPUT:-
+            - Current immutable Snapshot (cheap, safe from any thread)
+        '''
+
+        return( self._snapshot )
+
+    # --------------------------------------------------------------------
+
+    def set( self, name, value ):
+        self.update( {name: value} )
+
+    # --------------------------------------------------------------------
+
+    def update( self, values ):
+        '''
+        Write several parameters at once. The version is only bumped if
+        at least one value actually changed.
+
+        INPUTS:-
+            - values    : {name: value}
+        '''
+
+        with self.lock:
+            current = self._snapshot.as_dict()
+            changed = dict( (k, v) for (k, v) in values.items() if current.get(k) != v )
+            if( not changed ):
+                return
+
+            current.update( changed )
+            self._snapshot = Snapshot( current, self._snapshot.version + 1 )
+            snapshot = self._snapshot
+
+        for listener in self.listeners:
+            listener( snapshot )
+
+    # --------------------------------------------------------------------
+
+    def subscribe( self, listener ):
+        '''
+        Call listener( snapshot ) after every change.
+        '''
+
+        self.listeners.append( listener )
+
+    # --------------------------------------------------------------------
+
+    def assign( self, values ):
+        '''
+        Write parameters from outside the GUI (config file, socket,
+        error recovery) and queue the bound trackbars to follow. Safe
+        from any thread; the moves happen in sync_trackbars().
+
+        INPUTS:-
+            - values    : {name: value}
+        '''
+
+        self.update( values )
+
+        with self.lock:
+            for name, value in values.items():
+                if( name in self.trackbars ):
+                    self.moves[ name ] = value
+
+    # --------------------------------------------------------------------
+
+    def sync_trackbars( self ):
+        '''
+        Move the trackbars queued by assign(). Call from the GUI thread
+        (the one running cv2.waitKey), once per frame.
+        '''
+
+        if( not self.moves ):
+            return
+
+        with self.lock:
+            moves, self.moves = self.moves, {}
+
+        for name, value in moves.items():
+            label, window = self.trackbars[ name ]
+            cv2.setTrackbarPos( label, window, value )
+
+    # --------------------------------------------------------------------
+
+    def reset( self, names=None ):
+        '''
+        Restore defaults (all, or only names).
+        '''
+
+        names = self.defaults.keys() if names is None else names
+        self.assign( dict( (k, self.defaults[k]) for k in names ) )
+
+    # --------------------------------------------------------------------
+
+    def bind_trackbar( self, name, window, count, label=None ):
+        '''
+        Create a trackbar whose callback writes into the store.
+
+        INPUTS:-
+            - name      : Parameter name
+            - window    : Window the trackbar belongs to
+            - count     : Maximum trackbar position
+            - label     : Trackbar label (defaults to name)
+        '''
+
+        label = name if label is None else label
+        self.trackbars[ name ] = ( label, window )
+        self.ranges[ name ]    = ( 0, count )
+
+        cv2.createTrackbar( label, window, self._snapshot[name], count,
+                            lambda value: self.set( name, value ) )
+
+    # --------------------------------------------------------------------
+
+    def clamp( self, name, value ):
+        '''
+        OUTPUT:-
+            - value limited to the range of name's trackbar (unchanged
+              if name has none)
+        '''
+
+        if( name not in self.ranges ):
+            return( value )
+
+        low, high = self.ranges[ name ]
+        return( min( max( value, low ), high ) )
+
+    # --------------------------------------------------------------------
+
+    def load_file( self, path ):
+        '''
+        Update parameters from a JSON file ({name: value}). Unknown
+        names are ignored; values are clamped to their trackbar's range,
+        so bind the trackbars first.
+        '''
+
+        with open( path, "r" ) as f:
+            values = json.load( f )
+
+        self.assign( dict( (k, self.clamp( k, v )) for (k, v) in values.items() if k in self.defaults ) )
+
+    # --------------------------------------------------------------------
+
+    def save_file( self, path ):
+        with open( path, "w" ) as f:
+            json.dump( self._snapshot.as_dict(), f, indent=4, sort_keys=True )
+
+    # --------------------------------------------------------------------
+
+    def serve( self, port, host="127.0.0.1" ):
+        '''
+        Start a local control socket in a daemon thread.
+
+        OUTPUT:-
+            - thread    : The server thread
+        '''
+
+        server = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        server.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        server.bind( (host, port) )
+        server.listen( 1 )
+
+        t = Thread( target=self._serve, args=(server,), name="ParameterStore-{}".format(port) )
+        t.daemon = True
+        t.start()
+
+        return( t )
+
+    # --------------------------------------------------------------------
+
+    def _serve( self, server ):
+        while( True ):
+            conn, addr = server.accept()
+            f = conn.makefile( "rw" )
+            try:
+                for line in f:
+                    f.write( self._command( line ) + "\n" )
+                    f.flush()
+            except Exception as error:
+                print( "{} Control socket error: {}".format(fullStamp(), error) )
+            finally:
+                f.close()
+                conn.close()
+
+    # --------------------------------------------------------------------
+
+    def _command( self, line ):
+        words = line.split()
+        if( len(words) == 0 ):
+            return( "" )
+
+        if( words[0] == "dump" ):
+            return( json.dumps( self._snapshot.as_dict(), sort_keys=True ) )
+
+        if( words[0] == "get" and len(words) == 2 and words[1] in self.defaults ):
+            return( str( self._snapshot[ words[1] ] ) )
+
+        if( words[0] == "set" and len(words) == 3 and words[1] in self.defaults ):
+            name  = words[1]
+            try:
+                value = type( self.defaults[name] )( json.loads(words[2]) )
+            except ( ValueError, TypeError ):               # e.g. "set dp abc"
+                return( "ERR {}".format(line.strip()) )
+            if( self.clamp( name, value ) != value ):       # Outside the trackbar's range
+                return( "ERR {}".format(line.strip()) )
+            self.assign( {name: value} )
+            return( "OK" )
+
+        return( "ERR {}".format(line.strip()) )
+
+# ************************************************************************
+# =========================> DERIVED OBJECTS <===========================
+# ************************************************************************
+
+class Derived( object ):
+    '''
+    Object built from a few parameters and rebuilt only when one of
+    them changes (e.g. a structuring element or a blob detector).
+    '''
+
+    def __init__( self, store, names, build ):
+        '''
+        INPUTS:-
+            - store     : ParameterStore
+            - names     : Parameter names the object depends on
+            - build     : Function(*values) --> object
+        '''
+
+        self.store      = store
+        self.names      = tuple( names )
+        self.build      = build
+        self.version    = -1                                # Store version last checked
+        self.key        = None                              # Values last built with
+        self.value      = None
+        self.builds     = 0
+
+    # --------------------------------------------------------------------
+
+    def get( self, snapshot=None ):
+        snapshot = self.store.snapshot() if snapshot is None else snapshot
+        if( snapshot.version == self.version ):
+            return( self.value )
+
+        key = tuple( snapshot[name] for name in self.names )
+        if( key != self.key ):
+            self.value  = self.build( *key )
+            self.key    = key
+            self.builds += 1
+
+        self.version = snapshot.version
+        return( self.value )
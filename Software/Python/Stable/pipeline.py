@@ -0,0 +1,355 @@
+'''
+* pipeline.py
+*
+* Long-lived, staged frame processing pipeline for the live feeds.
+*
+* Each stage owns a fixed set of worker threads that are started ONCE
+* and kept alive for the whole session. Stages are chained through
+* bounded queues, so a slow stage blocks its producer (back-pressure)
+* instead of letting work pile up in memory.
+*
+*   capture --> procFrame --> scan4circles --> composite/display
+*   (main)      (Stage)       (Stage)          (main)
+*
+* USAGE:
+*   pipe = Pipeline()
+*   pipe.add_stage( "procFrame"   , procFrame    )
+*   pipe.add_stage( "scan4circles", scan4circles )
+*   pipe.start()
+*
+*   pipe.put( packet )              # From the capture loop
+*   result = pipe.get()             # None if nothing is ready yet
+*
+*   pipe.stop()                     # Clean shutdown
+*
+* NOTE: A stage function receives one item and returns the item to be
+*       passed downstream. Returning None drops the item.
+*
+* NOTE: Pipeline( latest=True ) connects the stages with LatestQueue
+*       channels instead. Producers never block; when a consumer lags
+*       the oldest (stale) item is discarded and counted, so latency
+*       and memory stay flat. Drop counts are reported by dropped().
+*       add_stage( ..., keep=f ) protects the items a stage outputs for
+*       which f( item ) is true: a newer item only evicts one of them if
+*       it is kept as well (e.g. frames that run the detectors are never
+*       replaced by frames that skip them).
+'''
+
+from    threading                   import  Thread, Event, Condition
+from    Queue                       import  Queue, Empty, Full
+from    collections                 import  deque
+from    time                        import  time
+from    timeStamp                   import  fullStamp       # Show date/time on console output
+
+POLL_INTERVAL = 0.05                                        # How often idle workers check for shutdown
+
+# ************************************************************************
+# ========================> LATEST-VALUE CHANNEL <=======================
+# ************************************************************************
+
+class LatestQueue( object ):
+    '''
+    Bounded, latest-value-wins channel. Exposes the subset of the
+    Queue interface used by the pipeline, but put() never blocks:
+    when full, the oldest item is discarded and counted as dropped.
+    '''
+
+    def __init__( self, maxsize=1, keep=None ):
+        '''
+        INPUTS:-
+            - maxsize   : Number of items retained (>= 1)
+            - keep      : Optional function( item ) --> True for items
+                          that only a newer kept item may evict
+        '''
+
+        self.maxsize    = max( 1, maxsize )
+        self.keep       = keep
+        self.items      = deque( maxlen=self.maxsize )
+        self.cond       = Condition()
+        self.dropped    = 0                                 # Number of stale items discarded
+        self.accepted   = 0                                 # Number of items put
+
+    # --------------------------------------------------------------------
+
+    def put( self, item, block=True, timeout=None ):
+        '''
+        Store item, evicting the oldest one if full (the oldest one not
+        kept, see keep). block and timeout are accepted for Queue
+        compatibility and ignored.
+        '''
+
+        with self.cond:
+            self.accepted += 1
+            if( len(self.items) == self.maxsize ):
+                self.dropped += 1
+                if( self.keep is not None ):
+                    stale = [ i for ( i, old ) in enumerate( self.items ) if not self.keep( old ) ]
+                    if( stale ):
+                        del self.items[ stale[0] ]
+                    elif( not self.keep( item ) ):          # Everything waiting is kept: drop the new item
+                        return
+            self.items.append( item )                       # deque evicts the oldest if still full
+            self.cond.notify()
+
+    # --------------------------------------------------------------------
+
+    def get( self, block=True, timeout=None ):
+        '''
+        Retrieve the oldest retained item. Raises Empty like Queue.get()
+        '''
+
+        with self.cond:
+            if( not block ):
+                if( not self.items ):
+                    raise Empty
+            elif( timeout is None ):
+                while( not self.items ):
+                    self.cond.wait()
+            else:
+                deadline = time() + timeout
+                while( not self.items ):
+                    remaining = deadline - time()
+                    if( remaining <= 0 ):
+                        raise Empty
+                    self.cond.wait( remaining )
+
+            return( self.items.popleft() )
+
+    # --------------------------------------------------------------------
+
+    def qsize( self ):
+        with self.cond:
+            return( len(self.items) )
+
+# ************************************************************************
+# =========================> PIPELINE STAGE <============================
+# ************************************************************************
+
+class Stage( object ):
+    '''
+    A single pipeline stage backed by persistent worker threads.
+    '''
+
+    def __init__( self, name, work, inbox, outbox, stop_event, workers=1, debug=False ):
+        '''
+        INPUTS:-
+            - name      : Name of the stage (used for thread names/logging)
+            - work      : Function applied to every item
+            - inbox     : Queue the stage consumes from
+            - outbox    : Queue the stage produces into
+            - stop_event: Shared threading.Event used to signal shutdown
+            - workers   : Number of worker threads (ordering is only
+                          preserved when workers == 1)
+            - debug     : Print errors raised by the work function
+        '''
+
+        self.name       = name
+        self.work       = work
+        self.inbox      = inbox
+        self.outbox     = outbox
+        self.stop_event = stop_event
+        self.debug      = debug
+
+        self.processed  = 0                                 # Number of items processed
+        self.errors     = 0                                 # Number of items that raised
+
+        self.threads    = []
+        for i in range( workers ):
+            t = Thread( target=self._run, name="{}-{}".format(name, i) )
+            t.daemon = True                                 # Never keep the interpreter alive
+            self.threads.append( t )
+
+    # --------------------------------------------------------------------
+
+    def start( self ):
+        for t in self.threads:
+            t.start()
+
+    # --------------------------------------------------------------------
+
+    def join( self, timeout=None ):
+        for t in self.threads:
+            t.join( timeout )
+
+    # --------------------------------------------------------------------
+
+    def is_alive( self ):
+        return( any( t.is_alive() for t in self.threads ) )
+
+    # --------------------------------------------------------------------
+
+    def _run( self ):
+        '''
+        Worker loop. Wait for work, process it, and hand it downstream.
+        '''
+
+        while( not self.stop_event.is_set() ):
+            try:
+                item = self.inbox.get( timeout=POLL_INTERVAL )
+            except Empty:
+                continue
+
+            try:
+                result = self.work( item )
+                self.processed += 1
+            except Exception as error:
+                self.errors += 1
+                result = None
+                if( self.debug ):
+                    print( "{} Error caught in {}".format(fullStamp(), self.name) )
+                    print( "{0} {1}".format(fullStamp(), type(error)) )
+
+            if( result is not None ):
+                self._forward( result )
+
+    # --------------------------------------------------------------------
+
+    def _forward( self, item ):
+        '''
+        Blocking put that still honours a shutdown request.
+        '''
+
+        while( not self.stop_event.is_set() ):
+            try:
+                self.outbox.put( item, timeout=POLL_INTERVAL )
+                return
+            except Full:
+                continue
+
+# ************************************************************************
+# ============================> PIPELINE <===============================
+# ************************************************************************
+
+class Pipeline( object ):
+    '''
+    Chain of stages connected by bounded queues.
+    '''
+
+    def __init__( self, maxsize=2, latest=False, debug=False ):
+        '''
+        INPUTS:-
+            - maxsize   : Capacity of every inter-stage queue
+            - latest    : Use LatestQueue channels (drop stale items)
+                          instead of blocking queues
+            - debug     : Print errors raised inside stages
+        '''
+
+        self.maxsize    = maxsize
+        self.latest     = latest
+        self.debug      = debug
+        self.stop_event = Event()
+        self.stages     = []
+        self.inbox      = self._channel()                   # Capture --> first stage
+        self.outbox     = self.inbox                        # Last stage --> consumer
+
+    # --------------------------------------------------------------------
+
+    def _channel( self, keep=None ):
+        if( self.latest ):
+            return( LatestQueue( maxsize=self.maxsize, keep=keep ) )
+        else:
+            return( Queue( maxsize=self.maxsize ) )
+
+    # --------------------------------------------------------------------
+
+    def add_stage( self, name, work, workers=1, keep=None ):
+        '''
+        Append a stage to the end of the pipeline.
+
+        INPUTS:-
+            - name      : Name of the stage
+            - work      : Function applied to every item
+            - workers   : Number of worker threads
+            - keep      : function( item ) --> True for output items that
+                          must not be evicted by newer ones that are not
+                          (latest=True only)
+
+        OUTPUT:-
+            - stage     : The created Stage
+        '''
+
+        outbox = self._channel( keep )
+        stage  = Stage( name, work, self.outbox, outbox,
+                        self.stop_event, workers, self.debug )
+
+        self.stages.append( stage )
+        self.outbox = outbox
+
+        return( stage )
+
+    # --------------------------------------------------------------------
+
+    def start( self ):
+        for stage in self.stages:
+            stage.start()
+
+        return( self )
+
+    # --------------------------------------------------------------------
+
+    def put( self, item, block=True, timeout=None ):
+        '''
+        Feed an item into the first stage. Blocks while the first stage
+        is saturated unless block=False.
+
+        OUTPUT:-
+            - True if the item was accepted, False otherwise
+        '''
+
+        try:
+            self.inbox.put( item, block, timeout )
+            return( True )
+        except Full:
+            return( False )
+
+    # --------------------------------------------------------------------
+
+    def get( self, block=False, timeout=None ):
+        '''
+        Retrieve a finished item from the last stage.
+
+        OUTPUT:-
+            - item, or None if nothing is available
+        '''
+
+        try:
+            return( self.outbox.get( block, timeout ) )
+        except Empty:
+            return( None )
+
+    # --------------------------------------------------------------------
+
+    def dropped( self ):
+        '''
+        Number of stale items discarded at the input of every stage
+        (and at the output of the last one, keyed "output").
+
+        OUTPUT:-
+            - counts    : {name: dropped} (empty unless latest=True)
+        '''
+
+        counts = {}
+        if( not self.latest ):
+            return( counts )
+
+        for stage in self.stages:
+            counts[ stage.name ] = stage.inbox.dropped
+        counts[ "output" ] = self.outbox.dropped
+
+        return( counts )
+
+    # --------------------------------------------------------------------
+
+    def stop( self, timeout=5.0 ):
+        '''
+        Signal every stage to stop and wait for the workers to exit.
+
+        OUTPUT:-
+            - True if every worker exited within the timeout
+        '''
+
+        self.stop_event.set()
+        for stage in self.stages:
+            stage.join( timeout )
+
+        return( not any( stage.is_alive() for stage in self.stages ) )
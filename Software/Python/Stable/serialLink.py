@@ -0,0 +1,213 @@
+'''
+* serialLink.py
+*
+* Self-healing serial connection for the sensor links.
+*
+* A SerialLink owns the port returned by a connect() function (e.g.
+* createUSBPort() followed by the device's start sequence). Whoever uses
+* the port reports I/O errors or a dead link with lost(); a background
+* thread then closes the port and calls connect() again, backing off
+* exponentially between failed attempts, until the device is back.
+* Nothing on the frame loop ever waits for the link: readers pick up
+* the new port with wait() and health() reports the link state and its
+* drop/reconnect counters.
+*
+* USAGE:
+*   link = SerialLink( connect ).start()                # Connects in the background
+*   tof  = ToFReader( link=link, parse=FrameParser(15), idle=2.0 ).start()
+*   link.health()                                       # State, drops, reconnects
+*   link.stop( 5.0 )                                    # Also closes the port
+'''
+
+from    threading                   import  Thread, Event, Lock
+from    time                        import  time
+from    timeStamp                   import  fullStamp       # Show date/time on console output
+
+# ************************************************************************
+# ============================> SERIAL LINK <============================
+# ************************************************************************
+
+class SerialLink( object ):
+    '''
+    Serial port that reconnects itself in the background.
+    '''
+
+    def __init__( self, connect, backoff=0.5, max_backoff=10.0, name="link", debug=False ):
+        '''
+        INPUTS:-
+            - connect   : Function() --> open, ready-to-use port; raises
+                          (e.g. serial.SerialException) on failure
+            - backoff   : Wait (sec) after the first failed attempt
+            - max_backoff: Longest wait (sec) between attempts
+            - name      : Name used in messages
+            - debug     : Print every state change
+        '''
+
+        self.connect    = connect
+        self.backoff    = backoff
+        self.max_backoff= max_backoff
+        self.name       = name
+        self.debug      = debug
+
+        self.port       = None                              # Open port while the link is up (atomic read)
+        self.since      = None                              # time() of the last state change
+        self.error      = None                              # Last error seen
+        self.drops      = 0                                 # Times the link went down
+        self.reconnects = 0                                 # Successful connects after the first
+        self.failures   = 0                                 # Failed connect attempts
+
+        self.lock       = Lock()
+        self.connected  = Event()
+        self.broken     = Event()                           # Set while a (re)connect is needed
+        self.stopped    = Event()
+        self.thread     = None
+
+    # --------------------------------------------------------------------
+
+    def start( self ):
+        self.stopped.clear()
+        self.broken.set()
+        self.thread = Thread( target=self._run, name="SerialLink " + self.name )
+        self.thread.daemon = True
+        self.thread.start()
+        return( self )
+
+    # --------------------------------------------------------------------
+
+    def stop( self, timeout=None ):
+        '''
+        Stop reconnecting and close the port.
+
+        OUTPUT:-
+            - True if the thread has exited
+        '''
+
+        self.stopped.set()
+        self.broken.set()                                   # Wake the thread up
+
+        exited = True
+        if( self.thread is not None ):
+            self.thread.join( timeout )
+            exited = not self.thread.is_alive()
+
+        with self.lock:
+            port, self.port = self.port, None
+            self.connected.clear()
+        _close( port )
+
+        return( exited )
+
+    # --------------------------------------------------------------------
+
+    def wait( self, timeout=None ):
+        '''
+        OUTPUT:-
+            - The open port, or None if the link is still down after timeout
+        '''
+
+        self.connected.wait( timeout )
+        return( self.port )
+
+    # --------------------------------------------------------------------
+
+    def lost( self, port, error=None ):
+        '''
+        Report a dead port (I/O error, disconnect, no data). Reports about
+        a port that was already replaced are ignored.
+        '''
+
+        with self.lock:
+            if( port is None or port is not self.port ):
+                return
+            self.port = None
+            self.connected.clear()
+            self.drops += 1
+            self.error = error
+            self.since = time()
+            self.broken.set()
+
+        _close( port )
+        self._log( "lost ({})".format(error) )
+
+    # --------------------------------------------------------------------
+
+    def health( self ):
+        '''
+        OUTPUT:-
+            - Dict with the link state and counters
+        '''
+
+        port = self.port
+        return( { "connected"   : port is not None,
+                  "port"        : getattr( port, "port", None ),
+                  "for"         : time() - self.since if self.since else 0.0,
+                  "drops"       : self.drops,
+                  "reconnects"  : self.reconnects,
+                  "failures"    : self.failures,
+                  "error"       : None if self.error is None else str( self.error ) } )
+
+    # --------------------------------------------------------------------
+
+    def _run( self ):
+        delay = self.backoff
+        first = True
+        up    = None                                        # time() the current connection came up
+
+        while( not self.stopped.is_set() ):
+            if( not self.broken.wait( 0.5 ) ):              # Link is up, nothing to do
+                continue
+            if( self.stopped.is_set() ):
+                break
+
+            if( up is not None ):                           # Dropped: back off too if it
+                if( time() - up < self.max_backoff ):       # keeps dying right after connecting
+                    self.stopped.wait( delay )
+                    delay = min( 2*delay, self.max_backoff )
+                else:
+                    delay = self.backoff
+                up = None
+
+            try:
+                port = self.connect()
+
+            except Exception as error:
+                self.failures += 1
+                self.error = error
+                self._log( "connect failed ({}), retrying in {:.1f}s".format(error, delay) )
+                self.stopped.wait( delay )
+                delay = min( 2*delay, self.max_backoff )
+                continue
+
+            with self.lock:
+                stopped = self.stopped.is_set()
+                if( not stopped ):
+                    self.port = port
+                    self.since = time()
+                    self.broken.clear()
+                    self.connected.set()
+                    if( not first ):
+                        self.reconnects += 1
+
+            if( stopped ):                                  # Stopped while connecting
+                _close( port )
+                break
+
+            self._log( "connected" if first else "reconnected" )
+            first = False
+            up    = time()
+
+    # --------------------------------------------------------------------
+
+    def _log( self, message ):
+        if( self.debug ):
+            print( "{} SerialLink {}: {}".format(fullStamp(), self.name, message) )
+
+# ------------------------------------------------------------------------
+
+def _close( port ):
+    if( port is None ):
+        return
+    try:
+        port.close()
+    except Exception:                                       # Already gone with the device
+        pass
@@ -25,6 +25,25 @@ def stampedFolder():
     folderName = "/" + fullStamp()
     return folderName
 
+# Monotonic clock in seconds, unaffected by wall-clock changes (used to align ToF samples with camera frames)
+try:
+    monotonicStamp = time.monotonic
+except AttributeError:                                      # Python 2: CLOCK_MONOTONIC through librt
+    import ctypes
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    _librt = ctypes.CDLL("librt.so.1", use_errno=True)
+    _CLOCK_MONOTONIC = 1
+
+    def monotonicStamp():
+        t = _timespec()
+        if _librt.clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
 
 """
 References
@@ -0,0 +1,129 @@
+'''
+* tofFilter.py
+*
+* Streaming filter for the ToF distance samples.
+*
+* Raw VL6180 readings are noisy and now and then wildly off (specular
+* reflections, the scope brushing an eyelash), which made the overlay
+* trigger chatter. DistanceFilter keeps the last `window` samples in a
+* fixed-size NumPy ring and, per sample:
+*   - rejects outliers: samples further than `reject` x MAD from the
+*     median of the samples before them hold the previous output
+*   - takes the running median over the window
+*   - smooths it with an exponential moving average (alpha)
+* Every stage is optional. A batch of samples (one protocol frame) is
+* filtered in one go: the sliding medians/MADs of the whole batch are
+* computed on a strided view of the ring, so the per-sample cost is a
+* bounded window of NumPy work, never Python list juggling.
+*
+* USAGE:
+*   smooth = DistanceFilter( window=5, alpha=0.5, reject=3.0 )
+*   mm     = smooth.update( 17 )                # One sample
+*   mms    = smooth.update_many( [17, 16, 90] ) # A batch, in order
+*   fusion = ToFFusion( enter=15, exit=18, smooth=smooth )
+'''
+
+import  numpy                                               as  np
+from    numpy.lib.stride_tricks     import  as_strided
+
+# ************************************************************************
+# ==========================> DISTANCE FILTER <==========================
+# ************************************************************************
+
+class DistanceFilter( object ):
+    '''
+    Outlier rejection --> running median --> EMA over a sample stream.
+    '''
+
+    def __init__( self, window=5, alpha=None, reject=None, min_dev=1.0 ):
+        '''
+        INPUTS:-
+            - window    : Samples in the median window (1 = no median)
+            - alpha     : EMA weight of a new sample, 0-1 (None = no EMA)
+            - reject    : Reject samples further than reject x MAD from
+                          the preceding window's median (None = off)
+            - min_dev   : Floor on the MAD (mm), so a flat window does not
+                          reject ordinary sensor noise
+        '''
+
+        self.window     = max( 1, int(window) )
+        self.alpha      = alpha
+        self.reject     = reject
+        self.min_dev    = min_dev
+
+        self.ring       = np.zeros( self.window, dtype=np.float64 )
+        self.head       = 0                                 # Next slot to write
+        self.count      = 0                                 # Valid samples in the ring
+        self.value      = None                              # Latest output
+        self.rejected   = 0                                 # Outliers rejected so far
+
+    # --------------------------------------------------------------------
+
+    def update( self, mm ):
+        return( float( self.update_many( [mm] )[-1] ) )
+
+    # --------------------------------------------------------------------
+
+    def update_many( self, values ):
+        '''
+        INPUTS:-
+            - values    : Distances (mm), oldest first
+
+        OUTPUT:-
+            - Filtered distances, one per input (numpy array)
+        '''
+
+        x = np.asarray( values, dtype=np.float64 ).ravel()
+        n = len( x )
+        if( n == 0 ):
+            return( x )
+
+        # Windows ending right before/at every new sample. The ring is
+        # padded with its oldest value until it has seen `window` samples
+        w       = self.window
+        hist    = self._history()
+        pad     = np.empty( w - len(hist) )
+        pad.fill( hist[0] if len(hist) else x[0] )
+        full    = np.concatenate( (pad, hist, x) )          # w + n samples
+        step    = full.strides[0]
+        rows    = as_strided( full, shape=(n+1, w), strides=(step, step) )
+        med     = np.median( rows, axis=1 )                 # med[j]: before sample j, med[j+1]: with it
+
+        base    = med[1:] if w > 1 else x
+        if( self.reject is not None ):
+            mad     = np.median( np.abs( rows[:n] - med[:n, None] ), axis=1 )
+            outlier = np.abs( x - med[:n] ) > self.reject * np.maximum( mad, self.min_dev )
+        else:
+            outlier = np.zeros( n, dtype=bool )
+
+        # Hold on outliers, EMA on the rest (sequential, scalar math only)
+        out = np.empty( n )
+        y   = self.value
+        for j in range( n ):
+            if( y is None or not outlier[j] ):
+                y = base[j] if ( self.alpha is None or y is None ) else y + self.alpha*( base[j] - y )
+            out[j] = y
+
+        self.value = y
+        self.rejected += int( outlier.sum() )
+        self._push( x )                                     # Outliers too: a real step wins the median
+
+        return( out )
+
+    # --------------------------------------------------------------------
+
+    def reset( self ):
+        self.head, self.count, self.value = 0, 0, None
+
+    # --------------------------------------------------------------------
+
+    def _history( self ):
+        idx = ( self.head - self.count + np.arange(self.count) ) % self.window
+        return( self.ring[ idx ] )
+
+    def _push( self, x ):
+        x   = x[ -self.window: ]
+        idx = ( self.head + np.arange(len(x)) ) % self.window
+        self.ring[ idx ] = x
+        self.head  = ( self.head + len(x) ) % self.window
+        self.count = min( self.window, self.count + len(x) )
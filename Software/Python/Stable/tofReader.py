@@ -0,0 +1,228 @@
+'''
+* tofReader.py
+*
+* Event-driven reader for the VL6180 ToF sensor on the serial port.
+*
+* The old getDist() thread spun on `if ToF.in_waiting > 0` and pinned a
+* core at 100%, starving the OpenCV threads. ToFReader instead blocks in
+* select() on the port's file descriptor (with a timeout, so it notices
+* a stop request or a closed port), drains every pending byte in one
+* read and publishes the latest state with a single attribute write,
+* which readers on other threads see atomically.
+*
+* The sensor speaks the framed binary protocol from usbProtocol.py
+* (millimetre distances with device timestamps); FrameParser turns the
+* latest distance into the 0/1 "within scan distance" state. The old
+* single-character ASCII stream is still understood by parse_state().
+*
+* Given a serialLink.SerialLink instead of a port, the reader survives
+* disconnects: I/O errors (and, with idle, a silent port) are reported
+* to the link, which reconnects in the background while the reader
+* waits for the new port.
+*
+* USAGE:
+*   tof = ToFReader( ToF, parse=FrameParser(15) ).start()  # ToF: open serial.Serial
+*   tof = ToFReader( link=link, idle=2.0 ).start()          # Or a SerialLink
+*   if( tof.value == 1 ): ...               # Latest state, never blocks
+*   tof.parse.sample                        # Latest (seq, device ms, mm)
+*   tof.stop( 5.0 )                         # Also stops if the port closes
+'''
+
+import  select
+from    threading                   import  Thread, Event
+from    time                        import  time
+from    timeStamp                   import  fullStamp       # Show date/time on console output
+from    usbProtocol                 import  FrameDecoder    # Framed ToF protocol
+
+MAX_BUFFER  = 256                                           # Bytes of unparsed text kept between reads
+
+# ************************************************************************
+# ============================> TOF READER <=============================
+# ************************************************************************
+
+class ToFReader( object ):
+    '''
+    Background thread publishing the latest ToF state read from a port.
+    '''
+
+    def __init__( self, port=None, parse=None, timeout=0.1, initial=0, debug=False,
+                  link=None, idle=None ):
+        '''
+        INPUTS:-
+            - port      : Open serial.Serial (or anything with fileno(),
+                          in_waiting, read() and is_open)
+            - parse     : Function(buffer) --> (value or None, leftover);
+                          defaults to parse_state()
+            - timeout   : Longest time (sec) to block before re-checking
+                          the stop flag and the port
+            - initial   : Value published until the first reading
+            - debug     : Print every new value
+            - link      : SerialLink to read from instead of port; the
+                          reader then keeps going across reconnects
+            - idle      : With a link, treat this long (sec) without any
+                          data as a dead link (None = never)
+        '''
+
+        self.port       = port
+        self.link       = link
+        self.idle       = idle
+        self.parse      = parse_state if parse is None else parse
+        self.timeout    = timeout
+        self.debug      = debug
+
+        self.value      = initial                           # Latest state (atomic read)
+        self.stamp      = None                              # time() of the latest state
+        self.updates    = 0                                 # Number of states parsed
+
+        self.stopped    = Event()
+        self.thread     = None
+
+    # --------------------------------------------------------------------
+
+    def start( self ):
+        self.stopped.clear()
+        self.thread = Thread( target=self._run, name="ToFReader" )
+        self.thread.daemon = True
+        self.thread.start()
+        return( self )
+
+    # --------------------------------------------------------------------
+
+    def stop( self, timeout=None ):
+        '''
+        Ask the reader to exit and wait for it.
+
+        OUTPUT:-
+            - True if the thread has exited
+        '''
+
+        self.stopped.set()
+        if( self.thread is not None ):
+            self.thread.join( timeout )
+            return( not self.thread.is_alive() )
+
+        return( True )
+
+    # --------------------------------------------------------------------
+
+    def alive( self ):
+        return( self.thread is not None and self.thread.is_alive() )
+
+    # --------------------------------------------------------------------
+
+    def _run( self ):
+        buf = ""
+        last = time()                                       # Last time any data arrived
+
+        while( not self.stopped.is_set() ):
+            port = self.port if self.link is None else self.link.wait( self.timeout )
+            if( port is None ):                             # Link down, reconnecting
+                buf, last = "", time()
+                continue
+
+            try:
+                if( not port.is_open ):
+                    raise IOError( "port closed" )
+
+                data = self._wait_read( port )
+                if( not data ):
+                    if( self.link is not None and self.idle and time() - last > self.idle ):
+                        raise IOError( "no data for {}s".format(self.idle) )
+                    continue
+                last = time()
+
+            except Exception as error:                      # Port closed/unplugged under us
+                if( self.debug ):
+                    print( "{} ToFReader: {}".format(fullStamp(), error) )
+                if( self.link is None ):
+                    break
+                self.link.lost( port, error )
+                continue
+
+            value, buf = self.parse( buf + data )
+            buf = buf[ -MAX_BUFFER: ]
+
+            if( value is not None ):
+                self.value = value                          # Publish (single store)
+                self.stamp = time()
+                self.updates += 1
+                if( self.debug ):
+                    print( value )
+
+    # --------------------------------------------------------------------
+
+    def _wait_read( self, port ):
+        '''
+        Block until the port is readable (or timeout), then drain it.
+        '''
+
+        ready, _, _ = select.select( [port], [], [], self.timeout )
+        if( not ready ):
+            return( "" )
+
+        return( port.read( max(1, port.in_waiting) ) )
+
+# ************************************************************************
+# =============================> PARSERS <===============================
+# ************************************************************************
+
+def parse_state( buf ):
+    '''
+    Parse the sensor's threshold stream: single '0'/'1' characters,
+    possibly interleaved with text lines ("Range: 12\\n", "[INFO] ...").
+    Only characters at the start of a line count as states, so digits
+    inside a text line are ignored.
+
+    INPUTS:-
+        - buf       : Unparsed text (leftover + new bytes)
+
+    OUTPUT:-
+        - value     : Latest state (0/1), or None if none was found
+        - leftover  : Incomplete trailing line, kept for the next call
+    '''
+
+    value    = None
+    segments = buf.split( "\n" )
+
+    for i, segment in enumerate( segments ):
+        segment = segment.lstrip( "\0" )
+        states  = len( segment ) - len( segment.lstrip("01") )
+        if( states ):
+            value = int( segment[states-1] )
+        segments[i] = segment[states:]
+
+    return( value, segments[-1] )
+
+# ------------------------------------------------------------------------
+
+class FrameParser( object ):
+    '''
+    Parser for the framed binary protocol (see usbProtocol.FrameDecoder).
+    Publishes 1 while the latest distance is within threshold, else 0.
+    '''
+
+    def __init__( self, threshold=15, listener=None, replies=None ):
+        '''
+        INPUTS:-
+            - threshold : Scan distance in mm (at or below --> 1)
+            - listener  : Optional function( samples ) called with every
+                          decoded batch (e.g. fusion.ToFFusion.add_samples)
+            - replies   : Optional function( bytes ) called with the bytes
+                          between frames (e.g. usbProtocol.CommandChannel.feed)
+        '''
+
+        self.threshold  = threshold
+        self.listener   = listener
+        self.decoder    = FrameDecoder( unframed=replies )
+        self.sample     = None                              # Latest (seq, device ms, mm)
+
+    def __call__( self, buf ):
+        samples = self.decoder.feed( buf )                  # Decoder keeps partial frames itself
+        if( not samples ):
+            return( None, "" )
+
+        if( self.listener is not None ):
+            self.listener( samples )
+
+        self.sample = samples[-1]
+        return( int( self.sample[2] <= self.threshold ), "" )
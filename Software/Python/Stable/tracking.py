@@ -0,0 +1,302 @@
+'''
+* tracking.py
+*
+* Pupil tracking helpers for the live feeds.
+*
+* ROITracker restricts the (expensive) detectors -- HoughCircles,
+* SimpleBlobDetector.detect() and findContours() -- to a padded window
+* around the last confirmed pupil. Detections are mapped back to full
+* frame co-ordinates, and after `max_misses` consecutive frames without
+* a hit the tracker falls back to a full-frame search.
+*
+* USAGE:
+*   tracker = ROITracker( max_misses=5 )
+*   found   = tracker.detect( img, detect )     # detect(img) --> [(x, y, r), ...]
+*   if( found ): tracker.confirm( found[0] )    # Lock onto the chosen pupil
+*   else       : tracker.miss()                 # No pupil on this frame
+*
+* NOTE: detect() may be called more than once per frame (e.g. blob
+*       detector, then contours as a fallback), so misses are recorded
+*       by the caller, once per frame, through miss().
+*
+* PupilTracker is an alpha-beta filter over (x, y, r) and its velocity.
+* It smooths detections (less overlay jitter), rejects detections that
+* jump too far from the prediction, and predicts the pupil on frames
+* where detection was skipped or failed. DetectionScheduler decides on
+* which frames the detectors run ("detect every N, track in between").
+*
+* USAGE:
+*   pupil     = PupilTracker()
+*   scheduler = DetectionScheduler( every=3 )
+*   if( scheduler.due( pupil.locked() ) ): found = ...   # Run detectors
+*   else                                 : found = None
+*   pos = pupil.step( found )           # (x, y, r) estimate or None
+'''
+
+# ************************************************************************
+# ===========================> ROI TRACKER <=============================
+# ************************************************************************
+
+class ROITracker( object ):
+    '''
+    Run a detector on a padded crop around the last confirmed pupil.
+    '''
+
+    def __init__( self, pad=20, pad_scale=1.0, max_misses=5 ):
+        '''
+        INPUTS:-
+            - pad       : Minimum padding (px) around the pupil
+            - pad_scale : Padding as a multiple of the pupil radius
+                          (the larger of the two is used)
+            - max_misses: Consecutive misses before a full-frame search
+        '''
+
+        self.pad        = pad
+        self.pad_scale  = pad_scale
+        self.max_misses = max_misses
+
+        self.last       = None                              # Last confirmed (x, y, r)
+        self.misses     = 0                                 # Consecutive misses
+        self.window     = None                              # (x1, y1, x2, y2) used last
+
+        self.roi_runs   = 0                                 # Detector runs on a crop
+        self.full_runs  = 0                                 # Detector runs on the full frame
+
+    # --------------------------------------------------------------------
+
+    def tracking( self ):
+        '''
+        True while a pupil is locked and the crop is being used.
+        '''
+
+        return( self.last is not None and self.misses < self.max_misses )
+
+    # --------------------------------------------------------------------
+
+    def roi( self, shape ):
+        '''
+        Padded search window around the last pupil, clipped to shape.
+
+        INPUTS:-
+            - shape     : (h, w) of the image being searched
+
+        OUTPUT:-
+            - (x1, y1, x2, y2), or None for a full-frame search
+        '''
+
+        if( not self.tracking() ):
+            return( None )
+
+        h, w    = shape[:2]
+        x, y, r = self.last
+        half    = r + max( self.pad, int(self.pad_scale*r) )
+
+        x1, y1  = max( x-half, 0 ), max( y-half, 0 )
+        x2, y2  = min( x+half, w ), min( y+half, h )
+        if( x2-x1 <= 2*r or y2-y1 <= 2*r ):                 # Pupil can't fit, search everything
+            return( None )
+
+        return( x1, y1, x2, y2 )
+
+    # --------------------------------------------------------------------
+
+    def detect( self, img, detect ):
+        '''
+        Run detect() on the search window and map the results back.
+
+        INPUTS:-
+            - img       : Image to search (grayscale or processed)
+            - detect    : Function img --> list of (x, y, r)
+
+        OUTPUT:-
+            - found     : List of (x, y, r) in full-frame co-ordinates
+        '''
+
+        self.window = self.roi( img.shape )
+
+        if( self.window is None ):
+            self.full_runs += 1
+            found = detect( img )
+        else:
+            self.roi_runs += 1
+            x1, y1, x2, y2 = self.window
+            crop  = img[ y1:y2, x1:x2 ].copy()              # Contiguous (findContours writes to it)
+            found = [ (x+x1, y+y1, r) for (x, y, r) in detect( crop ) ]
+
+        return( found )
+
+    # --------------------------------------------------------------------
+
+    def confirm( self, xyr ):
+        '''
+        Lock onto a confirmed pupil (x, y, r).
+        '''
+
+        self.last   = tuple( int(v) for v in xyr )
+        self.misses = 0
+
+    # --------------------------------------------------------------------
+
+    def miss( self ):
+        '''
+        Record a frame without a confirmed pupil. After max_misses the
+        lock is dropped and the next search covers the full frame.
+        '''
+
+        self.misses += 1
+        if( self.misses >= self.max_misses ):
+            self.last = None
+
+    # --------------------------------------------------------------------
+
+    def reset( self ):
+        self.last, self.misses, self.window = None, 0, None
+
+# ************************************************************************
+# ==========================> PUPIL TRACKER <============================
+# ************************************************************************
+
+class PupilTracker( object ):
+    '''
+    Alpha-beta filter for the pupil's (x, y, r), one step per frame.
+    '''
+
+    def __init__( self, alpha=0.6, beta=0.2, gate=1.5, min_gate=10, max_coast=5 ):
+        '''
+        INPUTS:-
+            - alpha     : Position correction gain (1.0 = no smoothing)
+            - beta      : Velocity correction gain
+            - gate      : Reject detections further than gate*r from the
+                          prediction (outliers)
+            - min_gate  : Minimum gate size in pixels
+            - max_coast : Frames to keep predicting without an accepted
+                          detection before the pupil is considered lost
+        '''
+
+        self.alpha      = alpha
+        self.beta       = beta
+        self.gate       = gate
+        self.min_gate   = min_gate
+        self.max_coast  = max_coast
+
+        self.state      = None                              # [x, y, r]
+        self.velocity   = [ 0.0, 0.0, 0.0 ]                 # Per frame
+        self.coast      = 0                                 # Frames since last accepted detection
+        self.coasting   = True                              # Last step had no accepted detection
+        self.rejected   = 0                                 # Number of gated outliers
+
+    # --------------------------------------------------------------------
+
+    def locked( self ):
+        '''
+        True while the tracker has a usable estimate.
+        '''
+
+        return( self.state is not None )
+
+    # --------------------------------------------------------------------
+
+    def step( self, measurement=None ):
+        '''
+        Advance one frame: predict, then correct with measurement if it
+        passes the gate.
+
+        INPUTS:-
+            - measurement: Detected (x, y, r), or None if detection was
+                           skipped or failed on this frame
+
+        OUTPUT:-
+            - pos        : Estimated (x, y, r) as ints, or None if lost
+        '''
+
+        if( self.state is None ):                           # Not locked, wait for a detection
+            if( measurement is None ):
+                self.coasting = True
+                return( None )
+
+            self.state      = [ float(v) for v in measurement ]
+            self.velocity   = [ 0.0, 0.0, 0.0 ]
+            self.coast      = 0
+            self.coasting   = False
+            return( self._pos() )
+
+        predicted = [ s+v for (s, v) in zip(self.state, self.velocity) ]
+
+        if( measurement is not None and not self._gated( predicted, measurement ) ):
+            residual        = [ m-p for (m, p) in zip(measurement, predicted) ]
+            self.state      = [ p + self.alpha*e for (p, e) in zip(predicted, residual) ]
+            self.velocity   = [ v + self.beta *e for (v, e) in zip(self.velocity, residual) ]
+            self.coast      = 0
+            self.coasting   = False
+
+        else:
+            if( measurement is not None ):
+                self.rejected += 1
+
+            self.state      = predicted
+            self.coast     += 1
+            self.coasting   = True
+            if( self.coast > self.max_coast ):              # Lost it
+                self.reset()
+                return( None )
+
+        return( self._pos() )
+
+    # --------------------------------------------------------------------
+
+    def reset( self ):
+        self.state, self.velocity, self.coast = None, [ 0.0, 0.0, 0.0 ], 0
+        self.coasting = True
+
+    # --------------------------------------------------------------------
+
+    def _gated( self, predicted, measurement ):
+        dx      = measurement[0] - predicted[0]
+        dy      = measurement[1] - predicted[1]
+        limit   = max( self.min_gate, self.gate*predicted[2] )
+
+        return( dx*dx + dy*dy > limit*limit )
+
+    # --------------------------------------------------------------------
+
+    def _pos( self ):
+        x, y, r = self.state
+        return( int(round(x)), int(round(y)), max(1, int(round(r))) )
+
+# ************************************************************************
+# =======================> DETECTION SCHEDULER <=========================
+# ************************************************************************
+
+class DetectionScheduler( object ):
+    '''
+    Run the detectors on every Nth frame while the pupil is tracked,
+    and on every frame while it is not.
+    '''
+
+    def __init__( self, every=1 ):
+        '''
+        INPUTS:-
+            - every     : Detect on 1 of every `every` frames (1 = always)
+        '''
+
+        self.every  = max( 1, int(every) )
+        self.count  = 0
+
+    # --------------------------------------------------------------------
+
+    def due( self, locked=True ):
+        '''
+        OUTPUT:-
+            - True if the detectors should run on this frame
+        '''
+
+        if( not locked ):
+            self.count = 0
+            return( True )
+
+        self.count += 1
+        if( self.count >= self.every ):
+            self.count = 0
+            return( True )
+
+        return( False )
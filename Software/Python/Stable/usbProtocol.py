@@ -17,8 +17,14 @@ Fluvio L Lobo Fenoglietto
         >> sudp apt-get install python-bluez
 """
 import os
+import glob
+import json
+import Queue
 import serial
+import struct
+import threading
 import time
+from collections import deque
 from timeStamp import *
 
 # Find RF Device
@@ -79,24 +85,170 @@ def findSmartDevice(smartDeviceName, availableDeviceNames, availableDeviceBTAddr
     print fullStamp() + " Smart Devices found (addresses): " + str(smartDeviceBTAddresses)
     return smartDeviceNames, smartDeviceBTAddresses                                                                      # Return RFObject or list of objects
 
+# USB Port Path
+#   Accepts a port number (/dev/ttyUSB<n>), a full device path (e.g. the pseudo-terminal of BETA/tofEmulator.py)
+#   or a pyserial URL (e.g. socket://host:port)
+#   Input   ::  {int/string}    "portNumber"
+#   Output  ::  {string}        device path
+def usbPortPath(portNumber):
+    if isinstance(portNumber, str) and (portNumber.startswith("/") or "://" in portNumber):
+        return portNumber
+    return "/dev/ttyUSB" + str(portNumber)
+
+# Open Port
+#   Opens a device path or, for "scheme://" URLs (socket://, rfc2217://), a pyserial URL handler
+#   Input   ::  {string}    "path"
+#           ::  {int}       "baudrate"
+#           ::  {float}     "timeout" read timeout in seconds (None = blocking)
+#   Output  ::  {object}    open serial object
+def openPort(path, baudrate, timeout=None):
+    if "://" in path:
+        return serial.serial_for_url(path, baudrate=baudrate, timeout=timeout)
+    return serial.Serial(port=path, baudrate=baudrate, timeout=timeout)
+
+# Serial Device Discovery
+#   Candidate ports are globbed from DEVICE_PATTERNS (plus any socket endpoints given by the caller) and probed
+#   concurrently with the 'n' name query. The port that answered is cached per device name in DEVICE_CACHE and
+#   probed first (alone) on the next boot
+DEVICE_PATTERNS     = ["/dev/ttyUSB*", "/dev/ttyACM*"]                                      # USB-serial and CDC-ACM adapters
+DEVICE_CACHE        = os.path.join(os.path.expanduser("~"), ".usbProtocol.json")            # {deviceName: port} of the last boot
+
+# List Devices
+#   Input   ::  {list}      "patterns" glob patterns of candidate ports
+#   Output  ::  {list}      existing device paths, sorted
+def listDevices(patterns=DEVICE_PATTERNS):
+    return sorted(path for pattern in patterns for path in glob.glob(pattern))
+
+# Load/Save Device Cache
+#   A missing or unreadable cache is treated as empty
+def loadDeviceCache(cache=DEVICE_CACHE):
+    try:
+        with open(cache, "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def saveDeviceCache(deviceName, path, cache=DEVICE_CACHE):
+    devices = loadDeviceCache(cache)
+    if devices.get(deviceName) == path:
+        return
+    devices[deviceName] = path
+    try:
+        with open(cache, "w") as f:
+            json.dump(devices, f, indent=4, sort_keys=True)
+    except (IOError, OSError):
+        print fullStamp() + " Could not write device cache " + cache
+
+# Probe Device
+#   Opens a port and repeats the 'n' name query until the device answers with its name or the timeout expires.
+#   The query is repeated because the device may still be booting (opening the port resets the ESP32) or streaming
+#   Input   ::  {string}    "path" device path or URL
+#           ::  {string}    "deviceName" expected reply to 'n'
+#           ::  {int}       "baudrate"
+#           ::  {float}     "timeout" seconds to wait for the name
+#   Output  ::  {object}    open serial object, or None if the port did not answer with deviceName
+def probeDevice(path, deviceName, baudrate, timeout):
+    try:
+        usbObject = openPort(path, baudrate, timeout=0.05)
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    try:
+        reply = ""
+        nextQuery = 0
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if time.time() >= nextQuery:
+                usbObject.write('n')
+                nextQuery = time.time() + timeout/4.0
+            lines = (reply + usbObject.read(max(1, usbObject.in_waiting))).split("\n")
+            if any(line.rstrip("\0\r").endswith(deviceName) for line in lines[:-1]):      # Reply may follow frame bytes
+                return usbObject
+            reply = lines[-1][-64:]                                                         # Keep the partial line only
+    except (serial.SerialException, OSError):
+        pass
+    usbObject.close()
+    return None
+
+# Discover Device
+#   Finds the port deviceName is connected to: the cached port is tried first, then every candidate concurrently
+#   Input   ::  {string}    "deviceName" expected reply to the 'n' name query
+#           ::  {int}       "baudrate"
+#           ::  {float}     "timeout" seconds each probe waits for the name
+#           ::  {list}      "endpoints" extra candidates, e.g. socket://host:port
+#           ::  {list}      "candidates" ports to probe (default: listDevices())
+#           ::  {string}    "cache" device cache file (None = no caching)
+#   Output  ::  {object}    open serial object, or None if no port answered
+def discoverDevice(deviceName, baudrate, timeout=2.0, endpoints=(), candidates=None, cache=DEVICE_CACHE):
+    print fullStamp() + " discoverDevice()"
+    cached = loadDeviceCache(cache).get(deviceName) if cache is not None else None
+    if cached is not None:
+        usbObject = probeDevice(cached, deviceName, baudrate, timeout)
+        if usbObject is not None:
+            return usbObject
+    if candidates is None:
+        candidates = listDevices()
+    candidates = [path for path in list(candidates) + list(endpoints) if path != cached]
+
+    found = []                                                                              # First port that answered
+    lock = threading.Lock()
+    done = threading.Event()
+    def probe(path):
+        usbObject = probeDevice(path, deviceName, baudrate, timeout)
+        if usbObject is None:
+            return
+        with lock:
+            if found:                                                                       # Someone was faster (or we gave up)
+                usbObject.close()
+                return
+            found.append(usbObject)
+        done.set()
+
+    threads = [threading.Thread(target=probe, args=(path,), name="probe " + path) for path in candidates]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    deadline = time.time() + timeout + 1.0
+    while not done.wait(0.01):
+        if time.time() > deadline or not any(thread.is_alive() for thread in threads):
+            break
+    with lock:
+        usbObject = found[0] if found else None
+        found.append(None)                                                                  # Late answers are closed
+    if usbObject is not None and cache is not None:
+        saveDeviceCache(deviceName, usbObject.port, cache)
+    return usbObject
+
 # Create USB Port
 def createPort(portNumber,baudrate,timeout):
     rfObject = serial.Serial(
-        port = "/dev/ttyUSB" + str(portNumber),
+        port = usbPortPath(portNumber),
         baudrate = baudrate,
         timeout = timeout)
     return rfObject
 
 # Create USB Port
-def createUSBPort(deviceName,portNumber,baudrate,attempts):
+#   Returns the port deviceName answers the 'n' name query on, open and ready to use (blocking reads)
+#   Input   ::  {string}        "deviceName"
+#           ::  {int/string}    "portNumber" port number, device path, URL, or "auto"/None to discover the device
+#           ::  {int}           "baudrate"
+#           ::  {int}           "attempts" number of probe/discovery rounds
+#           ::  {float}         "timeout" seconds each probe waits for the name
+#   Output  ::  {object}        open serial object (raises serial.SerialException if the device never answered)
+def createUSBPort(deviceName,portNumber,baudrate,attempts,timeout=2.0):
     print fullStamp() + " createUSBPort()"
-    usbObject = serial.Serial(
-        port = "/dev/ttyUSB" + str(portNumber),
-        baudrate = baudrate)
-    time.sleep(1)
-    #usbConnectionCheck(usbObject,deviceName,portNumber,baudrate,attempts)
-    usbObject.close()
-    return usbObject
+    for attempt in range(max(1, attempts)):
+        if portNumber is None or portNumber == "auto":
+            usbObject = discoverDevice(deviceName, baudrate, timeout)
+        else:
+            usbObject = probeDevice(usbPortPath(portNumber), deviceName, baudrate, timeout)
+        if usbObject is not None:
+            usbObject.timeout = None
+            print fullStamp() + " Connection successfully established with " + deviceName + " on " + usbObject.port
+            return usbObject
+        print fullStamp() + " Communication attempt " + str(attempt + 1) + "/" + str(attempts) + " failed"
+    print fullStamp() + " Connection Attempts Limit Reached"
+    print fullStamp() + " Please troubleshoot " + deviceName
+    raise serial.SerialException(deviceName + " did not answer on " + str(portNumber))
 
 # Connection Check -Simple
 #   Simplest variant of the connection check functions
@@ -120,7 +272,16 @@ def usbConnectionCheck(usbObject,deviceName,portNumber,baudrate,attempts):
             print fullStamp() + " Connection Attempts Limit Reached"
             print fullStamp() + " Please troubleshoot " + deviceName
 
+# Communication Bytes
+#   Single-byte commands and replies understood by the sketch (see Arduino/main/main.ino)
+SOH                 = chr(0x01)                                                             # Start of Header, device ready
+ENQ                 = chr(0x05)                                                             # Enquiry, systems check
+ACK                 = chr(0x06)                                                             # Acknowledged
+NAK                 = chr(0x15)                                                             # Not Acknowledged
+DC1                 = chr(0x21)                                                             # Device Control 1, reboot system
+
 # Send Until ReaD
+#       Synchronous: blocks the caller for up to timeout, use a CommandChannel from the frame loop
 #       This function sends an input command through the rfcomm port to the remote device
 #       The function sends such command persistently until a timeout or iteration check are met
 #       Input   ::      rfObject                {object}        serial object
@@ -138,11 +299,277 @@ def sendUntilRead(rfObject, outByte, timeout, iterCheck):
         print fullStamp() + " Time = " + str(time.time()-startTime)
         rfObject.write(outByte)                                                                             # Send CHK / System Check request
         inByte = rfObject.read()                                                                            # Read response from remote device
-        if inByte == definitions.ACK:                                                                       # If response equals ACK / Positive Acknowledgement
+        if inByte == ACK:                                                                                   # If response equals ACK / Positive Acknowledgement
             # print fullStamp() + " ACK"                                                                    # Print terminal message, device READY / System Check Successful                                                                             
             return inByte                                                                                   # Return the byte read from the port
             break                                                                                           # Break out of the "while loop"
-        elif inByte == definitions.NAK:                                                                     # If response equals NAK / Negative Acknowledgement
+        elif inByte == NAK:                                                                                 # If response equals NAK / Negative Acknowledgement
             # print fullStamp() + " NAK"                                                                    # Print terminal message, device NOT READY / System Check Failed
             return inByte                                                                                   # Return the byte read from the port
             break                                                                                           # Break out of the "while loop"
+
+# Framed ToF Protocol
+#   Binary frames sent by the ESP32/VL6180 sketch (see Arduino/main/get_dist.h), all fields little-endian
+#       SOH | VER | LEN | SEQ (uint16) | N (uint8) | N x [ T (uint32, device ms) | D (uint16, mm) ] | CHK
+#   LEN is the payload length (3 + 6*N), CHK is the sum of VER..last payload byte (mod 256)
+#   SEQ is the sequence number of the first sample in the frame, so gaps in SEQ are dropped samples
+FRAME_SOH           = 0x01                                                                  # Start of Header
+FRAME_VERSION       = 1                                                                     # Protocol version understood by this module
+FRAME_HEADER        = 3                                                                     # SOH, VER, LEN
+FRAME_SAMPLE        = struct.Struct("<IH")                                                  # Device timestamp (ms), distance (mm)
+FRAME_PREFIX        = struct.Struct("<HB")                                                  # Sequence number, number of samples
+
+# Frame Checksum
+#   Input   ::  {string}    "data" VER..last payload byte
+#   Output  ::  {int}       8-bit checksum
+def frameChecksum(data):
+    return sum(bytearray(data)) & 0xFF
+
+# Encode Frame
+#   Builds a frame the way the sketch does (used by the device emulator and for testing)
+#   Input   ::  {int}       "seq" sequence number of the first sample
+#           ::  {list}      "samples" list of (timestamp_ms, distance_mm)
+#   Output  ::  {string}    encoded frame
+def encodeFrame(seq, samples):
+    payload = FRAME_PREFIX.pack(seq & 0xFFFF, len(samples))
+    payload += "".join(FRAME_SAMPLE.pack(t & 0xFFFFFFFF, d) for (t, d) in samples)
+    body = struct.pack("<BB", FRAME_VERSION, len(payload)) + payload
+    return chr(FRAME_SOH) + body + chr(frameChecksum(body))
+
+# Frame Decoder
+#   Incremental decoder for the framed ToF protocol. Bytes may be fed in arbitrary chunks, corrupt or
+#   foreign bytes (text, ACK/NAK replies) are skipped by re-synchronizing on the next SOH
+#   Input   ::  {string}    chunks of bytes read from the port, through feed()
+#   Output  ::  {list}      decoded samples (seq, timestamp_ms, distance_mm), from feed()
+#   Bytes found outside frames (ACK/NAK replies, text) can be handed to an optional "unframed" function(bytes).
+#   They are only handed over while the decoder is in sync (right after a good frame), so the bytes of a corrupt
+#   frame or of a partial frame at start-up never pass for replies; out-of-sync bytes are discarded
+#   Sequence gaps count as dropped samples, except where the device restarted its count: a backward jump, or the
+#   first frame after the boot banner (SOH + "[INFO] ..."), only re-synchronizes the expected sequence number
+class FrameDecoder(object):
+
+    def __init__(self, unframed=None):
+        self.unframed = unframed                                                            # Receives bytes outside frames
+        self.buffer = bytearray()
+        self.nextSeq = None                                                                 # Expected sequence number
+        self.frames = 0                                                                     # Good frames decoded
+        self.samples = 0                                                                    # Samples decoded
+        self.dropped = 0                                                                    # Samples missing from sequence gaps
+        self.errors = 0                                                                     # Bad length/checksum
+        self.synced = False                                                                 # At a frame boundary we trust
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        samples = []
+        while True:
+            start = self.buffer.find(chr(FRAME_SOH))                                        # Skip to the next start of header
+            if start < 0:
+                self._skip(len(self.buffer))
+                break
+            self._skip(start)
+            if len(self.buffer) < FRAME_HEADER:                                             # Wait for the header
+                break
+            version, length = self.buffer[1], self.buffer[2]
+            if version != FRAME_VERSION:                                                    # Not a frame (e.g. the SOH of the
+                if version == ord('['):                                                     # ready banner), sync unchanged
+                    self.nextSeq = None                                                     # Banner: device (re)booted, seq restarts
+                self._skip(1)
+                continue
+            if (length - FRAME_PREFIX.size) % FRAME_SAMPLE.size != 0:
+                self.errors += 1                                                            # Corrupt, re-synchronize
+                self.synced = False
+                del self.buffer[:1]
+                continue
+            end = FRAME_HEADER + length + 1
+            if len(self.buffer) < end:                                                      # Wait for the rest of the frame
+                break
+            body = self.buffer[1:end-1]
+            if frameChecksum(body) != self.buffer[end-1]:
+                self.errors += 1                                                            # Corrupt: skip the whole frame, its
+                self.synced = False                                                         # bytes are not replies
+                del self.buffer[:end]
+                continue
+            samples.extend(self._unpack(buffer(body, 2)))
+            del self.buffer[:end]
+            self.synced = True
+        return samples
+
+    def _skip(self, n):
+        if n and self.synced and self.unframed is not None:
+            self.unframed(str(self.buffer[:n]))
+        del self.buffer[:n]
+
+    def _unpack(self, payload):
+        seq, n = FRAME_PREFIX.unpack_from(payload, 0)
+        if n * FRAME_SAMPLE.size != len(payload) - FRAME_PREFIX.size:
+            self.errors += 1
+            return []
+        if self.nextSeq is not None:
+            gap = (seq - self.nextSeq) & 0xFFFF                                             # Gap (mod 2^16) = lost samples
+            if gap < 0x8000:                                                                # Backward jump: device restarted,
+                self.dropped += gap                                                         # resync without counting
+        self.nextSeq = (seq + n) & 0xFFFF
+        self.frames += 1
+        self.samples += n
+        samples = []
+        for i in range(n):
+            t, d = FRAME_SAMPLE.unpack_from(payload, FRAME_PREFIX.size + i*FRAME_SAMPLE.size)
+            samples.append(((seq + i) & 0xFFFF, t, d))
+        return samples
+
+# Command Future
+#   Pending result of a command sent through a CommandChannel
+#   Output  ::  {chr}       "reply" ACK, NAK, or None if the command timed out or could not be sent
+class CommandFuture(object):
+
+    def __init__(self, seq, command, timeout, callback=None):
+        self.seq = seq                                                                      # Request sequence number
+        self.command = command
+        self.timeout = timeout
+        self.reply = None
+        self.sentAt = None                                                                  # time.time() it was written
+        self.expired = False                                                                # Timed out while in flight
+        self.callbacks = [] if callback is None else [callback]
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+
+    def done(self):
+        return self.event.is_set()
+
+    def acked(self):
+        return self.reply == ACK
+
+    def wait(self, timeout=None):                                                           # Blocks: not for the frame loop
+        self.event.wait(timeout)
+        return self.reply
+
+    def addCallback(self, callback):                                                        # callback(future), runs on completion
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def _complete(self, reply):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reply = reply
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as error:
+                print fullStamp() + " Command callback failed: " + str(error)
+
+# Command Channel
+#   Asynchronous request/response channel for the single-byte commands the sketch answers with ACK/NAK (ENQ, DC1).
+#   send() only enqueues the command and returns a CommandFuture; a writer thread sends the commands in order, each
+#   with a sequence number. The sketch replies strictly in order, so every ACK/NAK completes the oldest request in
+#   flight. Replies are read by whoever owns the port, which passes them to feed() (e.g. tofReader.FrameParser's
+#   "replies" --> FrameDecoder "unframed"). A request without reply completes with None after its timeout; its late
+#   reply is still consumed (for up to 4 timeouts) so the following requests stay matched. A reply that arrives while
+#   the FrameDecoder is out of sync (after a corrupt frame) is discarded with it: that request times out instead
+#   Input   ::  {object}    "port" open serial object, or
+#           ::  {object}    "link" serialLink.SerialLink to take the current port from
+#           ::  {float}     "timeout" default seconds to wait for a reply
+#   Output  ::  {object}    CommandFuture, from send()
+class CommandChannel(object):
+
+    def __init__(self, port=None, link=None, timeout=1.0):
+        self.port = port
+        self.link = link
+        self.timeout = timeout
+        self.queue = Queue.Queue()                                                          # Waiting to be sent
+        self.inflight = deque()                                                             # Sent, oldest first
+        self.lock = threading.Lock()
+        self.nextSeq = 0
+        self.sent = 0                                                                       # Commands written
+        self.acks = 0                                                                       # Replies received
+        self.naks = 0
+        self.timeouts = 0                                                                   # Commands without reply
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="CommandChannel")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):                                                           # Pending commands complete with None
+        self.stopped.set()
+        exited = True
+        if self.thread is not None:
+            self.thread.join(timeout)
+            exited = not self.thread.is_alive()
+        with self.lock:
+            pending, self.inflight = list(self.inflight), deque()
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for future in pending:
+            future._complete(None)
+        return exited
+
+    def send(self, command, timeout=None, callback=None):
+        with self.lock:
+            seq = self.nextSeq
+            self.nextSeq += 1
+        future = CommandFuture(seq, command, self.timeout if timeout is None else timeout, callback)
+        self.queue.put(future)
+        return future
+
+    def feed(self, data):
+        for inByte in data:
+            if inByte != ACK and inByte != NAK:
+                continue
+            with self.lock:
+                future = self.inflight.popleft() if self.inflight else None
+            if future is None or future.expired:                                            # Unsolicited, or too late
+                continue
+            if inByte == ACK:
+                self.acks += 1
+            else:
+                self.naks += 1
+            future._complete(inByte)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self._expire()
+            try:
+                future = self.queue.get(timeout=0.05)
+            except Queue.Empty:
+                continue
+            port = self.port if self.link is None else self.link.port
+            if port is None:                                                                # Link down
+                future._complete(None)
+                continue
+            with self.lock:                                                                 # In flight before the reply can arrive
+                future.sentAt = time.time()
+                self.inflight.append(future)
+            try:
+                port.write(future.command)
+                self.sent += 1
+            except Exception as error:
+                with self.lock:
+                    if future in self.inflight:
+                        self.inflight.remove(future)
+                future._complete(None)
+                if self.link is not None:
+                    self.link.lost(port, error)
+
+    def _expire(self):
+        now = time.time()
+        expired = []
+        with self.lock:
+            for future in self.inflight:
+                if not future.expired and now - future.sentAt > future.timeout:
+                    future.expired = True
+                    expired.append(future)
+            while self.inflight and self.inflight[0].expired and now - self.inflight[0].sentAt > 4*self.inflight[0].timeout:
+                self.inflight.popleft()                                                     # Reply is never coming
+        self.timeouts += len(expired)
+        for future in expired:
+            future._complete(None)